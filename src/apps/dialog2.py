@@ -4,7 +4,6 @@ import uuid
 from flask import Flask, request, jsonify
 import threading
 from langgraph.graph import MessagesState, START
-from langgraph.checkpoint.memory import MemorySaver
 from langchain_openai import ChatOpenAI
 from langgraph.graph import END, StateGraph
 from langchain_openai import ChatOpenAI
@@ -16,6 +15,7 @@ from flask_cors import CORS
 
 
 import os
+import sys
 from dotenv import load_dotenv
 
 # Load environment variables from the .env file
@@ -24,6 +24,24 @@ load_dotenv()
 
 # Access the API key
 openai_api_key = os.getenv('OPENAI_API_KEY')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from utils.sessions import SessionManager, SessionLimitReached
+from utils.checkpoints import open_checkpointer
+
+# One checkpointer shared by all conversations, keeping only the newest checkpoints of each: durable
+# when DIALOG_CHECKPOINT_DB is set, otherwise an in-memory SQLite database
+checkpointer = open_checkpointer(default=':memory:')
+
+# Graph state: the messages plus everything a conversation tracks between turns, so a conversation
+# resumed from the checkpointer (e.g. after a restart) continues with its issues and loop count
+class ConversationState(MessagesState):
+    health_issues: str
+    medical_history: str
+    current_diagnose: str
+    questions: str
+    loop_num: int
+
 # AIConversation class
 class AIConversation:
     def __init__(self,id,max_loop) -> None:
@@ -31,7 +49,7 @@ class AIConversation:
 
         self.config = {"configurable": {"thread_id": str(id)}}
         # Define a new graph
-        workflow = StateGraph(MessagesState)
+        workflow = StateGraph(ConversationState)
 
         # Define the three nodes we will cycle between
 
@@ -62,7 +80,6 @@ class AIConversation:
         workflow.add_edge("question_to_clarify_issue", "doctor_message")
         workflow.add_edge("final_conclusion", END)
 
-        self.health_issues=None
 
         self.identify_issues_prompt = PromptTemplate(
             input_variables=["health_issues"],
@@ -188,32 +205,25 @@ class AIConversation:
                 If the diagnosis doesn't make sense, reply with: "I can't help you based on information provided."
             """
         )
-        self.current_diagnose=""
-        self.medical_history=""
-        self.questions = {}
-        self.health_issues={}
-        memory = MemorySaver()
-        self.loop_num=0
         self.max_loop=max_loop
-        self.app = workflow.compile(checkpointer=memory,interrupt_before=["doctor_message","patient_message"])
+        self.app = workflow.compile(checkpointer=checkpointer,interrupt_before=["doctor_message","patient_message"])
 
     def identify_issues(self,state):
-        self.loop_num+=1
         # Format the prompt with input
-        formatted_prompt = self.identify_issues_prompt.invoke({"health_issues":self.health_issues})
+        formatted_prompt = self.identify_issues_prompt.invoke({"health_issues":state.get("health_issues") or {}})
         # issue_input=self.identify_issues_prompt.invoke(self.health_issues)
         messages = state["messages"]
         messages[0].content=formatted_prompt.text
         health_issues = self.model.invoke(messages)
-        self.health_issues=health_issues.content
+        return {"health_issues": health_issues.content, "loop_num": state.get("loop_num", 0) + 1}
         # return {"messages": [health_issues]}
     
     def question_to_clarify_issue(self,state):
         
-        question_input=self.question_to_clarify_issue_prompt.invoke({"health_issues":self.health_issues,"medical_history":self.medical_history})
+        question_input=self.question_to_clarify_issue_prompt.invoke({"health_issues":state.get("health_issues") or {},"medical_history":state.get("medical_history", "")})
         messages = state["messages"]
         messages[0].content=question_input.text
-        self.questions = self.model.invoke(messages).content
+        return {"questions": self.model.invoke(messages).content}
         
         # format the questions
         # return {"messages": [questions]}
@@ -224,7 +234,7 @@ class AIConversation:
         # If there is no function call, then we finish
         response=self.model.invoke(messages)
         # print("decision response:",response)
-        if "yes" in response or self.loop_num>=self.max_loop:
+        if "yes" in response or state.get("loop_num", 0)>=self.max_loop:
         # if not last_message.tool_calls:
             return "end"
         else:
@@ -240,14 +250,12 @@ class AIConversation:
         messages[0].content = medical_history_input
         # print("history:",messages)
         history = self.model.invoke(messages)
-        self.medical_history=history.content
+        medical_history=history.content
         #---- update history
-        formatted_prompt = self.diagnostic_prompt.invoke({"health_issues":self.health_issues,"medical_history":self.medical_history})
+        formatted_prompt = self.diagnostic_prompt.invoke({"health_issues":state.get("health_issues") or {},"medical_history":medical_history})
         messages[0].content = formatted_prompt.text
         response = self.model.invoke(messages)
-        self.current_diagnose = response.content
-        # Return the response in the usual format
-        # return {"messages": [response]}
+        return {"medical_history": medical_history, "current_diagnose": response.content}
     def doctor_message(self,state):
         pass
     def patient_message(self,state):
@@ -255,31 +263,59 @@ class AIConversation:
     def invoke(self):
         mes={"messages": [{"content": "Start conversation", "role": "system"}]}
         self.app.invoke(mes,config=self.config)
+    def values(self):
+        # Conversation data of the latest checkpoint
+        return self.app.get_state(self.config).values
     def final_conclusion(self, state):
-        final_input=self.final_summary_prompt.invoke({"diagnosis":self.current_diagnose,"medical_history":self.medical_history})
+        final_input=self.final_summary_prompt.invoke({"diagnosis":state["current_diagnose"],"medical_history":state["medical_history"]})
         final_answer = self.model.invoke(final_input)
         return {"messages": [final_answer]}
 # Build the graph
 # Build the graph
 
-# Initialize and invoke the AI conversation
-conv=None
+# Create and start a new conversation instance
+def new_conversation(session_id):
+    conversation = AIConversation(session_id, 10)
+    # A thread already in the checkpointer (e.g. before a restart) resumes where it stopped
+    if not checkpointer.has_thread(session_id):
+        conversation.invoke()
+    return conversation
+
+# Conversations of all clinicians served by this process, keyed by conversationId
+sessions = SessionManager(
+    new_conversation,
+    max_sessions=int(os.getenv('DIALOG_MAX_SESSIONS', '100')),
+    idle_ttl_seconds=float(os.getenv('DIALOG_SESSION_IDLE_TTL', '1800')),
+    # An in-memory checkpointer cannot resume an evicted session, so its checkpoints go with it
+    on_evict=None if checkpointer.durable else checkpointer.delete_thread,
+)
 # Flask App Setup
 app = Flask(__name__)
 CORS(app)
 # API endpoint to receive the human's message
 @app.route('/api/ask', methods=['POST'])
 def receive_human_answer():
-    global conv  # Use the global keyword to access the global variable
-    
-    # Initialize a new conversation instance if it's not already created
-    if conv is None:
-        uuid1 = uuid.uuid1()
-        conv = AIConversation(uuid1, 10)
-        conv.invoke()
-    # print the conversation id
-    current_id=conv.config.get("configurable").get("thread_id")
     data = request.json
+    # A missing conversationId starts a new conversation
+    try:
+        with sessions.session(data.get('conversationId')) as session:
+            return answer(session, data)
+    except SessionLimitReached as e:
+        return jsonify({"error": str(e)}), 503
+
+@app.route('/api/sessions', methods=['GET'])
+def session_stats():
+    stats = sessions.stats()
+    stats["checkpoints"] = checkpointer.stats()
+    return jsonify(stats)
+
+def end_conversation(session_id):
+    sessions.discard(session_id)
+    checkpointer.delete_thread(session_id)
+
+def answer(session, data):
+    conv = session.conversation
+    current_id = session.session_id
     # Define a message from the doctor
     doctor_message_content = data.get('doctorMessage')
     # Define a message from the patient
@@ -304,14 +340,6 @@ def receive_human_answer():
             content="",
             additional_kwargs={"role": "patient"}
         )
-    # user_message = data.get('userMessage')  # This gets the userMessage part
-    conversation_id = data.get('conversationId')  # This gets the conversationId part
-    # print(f"Conversation ID received: {conversation_id}")
-    # print(f"Conversation ID in the conversation instance: {current_id}")
-    if not conversation_id:
-        uuid1 = uuid.uuid1()
-        conv = AIConversation(uuid1, 10)
-        conv.invoke()
 
     for event in conv.app.stream({"messages": [doctor_message]}, conv.config, stream_mode="values"):
         event["messages"][-1].pretty_print()
@@ -322,11 +350,12 @@ def receive_human_answer():
 
     for event in conv.app.stream(None, conv.config, stream_mode="values"):
         event["messages"][-1].pretty_print()
+    state = conv.values()
     feeebackFromAI=event["messages"][-1].content
-    if 'question_to_clarify' in conv.questions:
-        questions = json.loads(conv.questions)["question_to_clarify"]
-        diagnosis = json.loads(conv.current_diagnose)["diagnoses"]
-        medical_history = conv.medical_history
+    if 'question_to_clarify' in state.get("questions", ""):
+        questions = json.loads(state["questions"])["question_to_clarify"]
+        diagnosis = json.loads(state["current_diagnose"])["diagnoses"]
+        medical_history = state["medical_history"]
         try:
             # Combine both JSON data into one response
             response_data = {
@@ -344,20 +373,15 @@ def receive_human_answer():
         try:
 
             # Combine both JSON data into one response
-            medical_history = conv.medical_history
+            medical_history = state["medical_history"]
             response_data = {
                 "diagnosis":feeebackFromAI,
                 "health_issue_summarization":medical_history,
                 "question_to_clarify": {},
                 "conversationId": current_id,
             }
-            del conv  # This will remove the old instance of the conversation
-        
-            # Create a new conversation with a fresh UUID
-            new_uuid = uuid.uuid1()
-            conv = AIConversation(new_uuid, 10)
-            conv.invoke()
-            print(f"Created new conversation instance with ID: {new_uuid}")
+            # The consultation is over; the next request for this id starts a new conversation
+            end_conversation(current_id)
             # Return the combined JSON response
             return jsonify(response_data)
         except Exception as e:
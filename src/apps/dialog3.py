@@ -1,40 +1,80 @@
 # dialog.py
 
+import asyncio
 import json
-import uuid
-from flask import Flask, request, jsonify
+import queue
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 import os
 from dotenv import load_dotenv
-import yaml
-from threading import Lock
+import sys
+from threading import Lock, Thread
+from concurrent.futures import ThreadPoolExecutor
 
 from langgraph.graph import MessagesState, START, END, StateGraph
 from langgraph.checkpoint.memory import MemorySaver
 from langchain_openai import ChatOpenAI
 from langchain.prompts import PromptTemplate
-from langchain_core.messages import HumanMessage
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.runnables import RunnableLambda
+from typing import Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from utils.sessions import SessionManager, SessionLimitReached
+from utils.checkpoints import open_checkpointer, delete_thread
+from utils.prompt_registry import PromptRegistry
+from utils.llm_cache import cache_key, open_llm_cache
+from utils.history import open_history_compactor, transcript
 
 # Load environment variables from the .env file
 load_dotenv()
 
 # Access the API keys
 openai_api_key = os.getenv('OPENAI_API_KEY')
+# Run independent model calls of a turn concurrently (set DIALOG_PARALLEL_NODES=0 for the serial order).
+# Each step starts its own short-lived worker threads, so concurrent turns never queue behind a shared pool.
+parallel_nodes = os.getenv('DIALOG_PARALLEL_NODES', '1') == '1'
+# How often prompts.yaml is checked for edits
+prompt_poll_seconds = float(os.getenv('DIALOG_PROMPT_POLL_SECONDS', '2'))
+# Durable checkpoints when DIALOG_CHECKPOINT_DB is set, otherwise in memory; shared by all conversations
+checkpointer = open_checkpointer() or MemorySaver()
+# Answers of identical model calls, reused instead of billed again; off unless DIALOG_LLM_CACHE_SIZE > 0
+llm_cache = open_llm_cache()
+# Older turns folded into a running summary so prompts stop growing with the consultation (DIALOG_HISTORY_KEEP_EXCHANGES=0 disables)
+history_compactor = open_history_compactor()
 
 # Flask App Setup
 app = Flask(__name__)
 CORS(app)
 
-# AIConversation class
-class AIConversation:
-    def __init__(self, id, max_loop=10, prompts_file='prompts.yaml') -> None:
+# Per-conversation data, carried in the graph state and checkpointed under the conversation's thread_id
+class ConsultationState(MessagesState):
+    health_issues: Optional[str]
+    medical_history: str
+    current_diagnose: str
+    questions: str
+    loop_num: int
+    # Parallel mode: results of model calls made ahead of the node that consumes them
+    decision: Optional[str]
+    prefetched_questions: Optional[str]
+    # Version of prompts.yaml used for the latest turn
+    prompt_version: str
+    # Summary of the turns no longer sent verbatim, and how many messages after the first it covers
+    history_summary: Optional[str]
+    summarized_messages: int
+
+
+# ConsultationGraph class: prompts, model client and compiled workflow, built once per process
+class ConsultationGraph:
+    def __init__(self, prompts_file='prompts.yaml', parallel=parallel_nodes, checkpointer=checkpointer, cache=llm_cache, compactor=history_compactor) -> None:
         # Get the directory of the current script
         script_dir = os.path.dirname(os.path.realpath(__file__))
         # Construct the full path to prompts.yaml
         self.prompts_file = os.path.join(script_dir, prompts_file)
         self.model = ChatOpenAI(model="gpt-4", api_key=openai_api_key)
-        self.config = {"configurable": {"thread_id": str(id)}}
-        self.lock = Lock()  # To ensure thread safety when updating prompts
+        self.parallel = parallel
+        self.cache = cache
+        self.compactor = compactor
 
         # Initialize instruction variables with default values
         self.identify_issues_prompt_instruction = """
@@ -89,9 +129,11 @@ class AIConversation:
         Suggestions may include appropriate treatments and medications.
         If the diagnosis doesn't make sense, reply with: "I can't help you based on information provided."
         """
-
-        # # Load initial instructions from YAML
-        # self.load_prompts()
+        self.history_summary_prompt_instruction = """
+        Update the summary of a doctor-patient consultation with the new part of the conversation.
+        Keep every symptom with its duration and severity, medications, contacts, medical history and the patient's answers to the doctor's questions.
+        Leave out greetings and repetition. Reply with the updated summary only, as one short paragraph.
+        """
 
         # Define PromptTemplates with hardcoded JSON formatting and {instruction} placeholder
         self.identify_issues_prompt = PromptTemplate(
@@ -214,16 +256,30 @@ class AIConversation:
             """
         )
 
+        self.history_summary_prompt = PromptTemplate(
+            input_variables=["instruction", "summary", "conversation"],
+            template="""
+            Instruction: {instruction}
+
+            Summary so far: {summary}
+
+            New part of the conversation:
+            {conversation}
+            """
+        )
+
         # Define a new graph
-        workflow = StateGraph(MessagesState)
+        workflow = StateGraph(ConsultationState)
 
         # Define the nodes
-        workflow.add_node("identify_issue", self.identify_issues)
-        workflow.add_node("question_to_clarify_issue", self.question_to_clarify_issue)
+        # Model-calling steps have a blocking and an asyncio implementation: invoke()/stream() on the
+        # graph run the first (Flask), ainvoke()/astream() the second (dialog_asgi.py)
+        workflow.add_node("identify_issue", RunnableLambda(self.identify_issues, self.aidentify_issues))
+        workflow.add_node("question_to_clarify_issue", RunnableLambda(self.question_to_clarify_issue, self.aquestion_to_clarify_issue))
         workflow.add_node("doctor_message", self.doctor_message)
         workflow.add_node("patient_message", self.patient_message)
-        workflow.add_node("diagnosis", self.diagnosis)
-        workflow.add_node("final_conclusion", self.final_conclusion)
+        workflow.add_node("diagnosis", RunnableLambda(self.diagnosis, self.adiagnosis))
+        workflow.add_node("final_conclusion", RunnableLambda(self.final_conclusion, self.afinal_conclusion))
 
         # Set the edges
         workflow.add_edge(START, "doctor_message")
@@ -234,7 +290,7 @@ class AIConversation:
         # Conditional edges
         workflow.add_conditional_edges(
             "diagnosis",
-            self.should_continue,
+            RunnableLambda(self.should_continue, self.ashould_continue),
             {
                 "continue": "question_to_clarify_issue",
                 "end": "final_conclusion",
@@ -244,98 +300,271 @@ class AIConversation:
         workflow.add_edge("question_to_clarify_issue", "doctor_message")
         workflow.add_edge("final_conclusion", END)
 
-        # Initialize variables
-        self.health_issues = None
-        self.current_diagnose = ""
-        self.medical_history = ""
-        self.questions = {}
-        self.loop_num = 0
-        self.max_loop = max_loop
-
-        # Initialize memory and compile workflow
-        memory = MemorySaver()
-        self.app = workflow.compile(checkpointer=memory, interrupt_before=["doctor_message", "patient_message"])
+        # Templates with instructions filled in, swapped atomically whenever prompts.yaml changes
+        self.prompts = PromptRegistry(
+            self.prompts_file,
+            templates={
+                "identify_issues": self.identify_issues_prompt,
+                "medical_history": self.medical_history_prompt,
+                "diagnostic": self.diagnostic_prompt,
+                "question_to_clarify_issue": self.question_to_clarify_issue_prompt,
+                "decision": self.decision_prompt,
+                "final_summary": self.final_summary_prompt,
+                "history_summary": self.history_summary_prompt,
+            },
+            default_instructions={
+                "identify_issues": self.identify_issues_prompt_instruction,
+                "medical_history": self.medical_history_prompt_instruction,
+                "diagnostic": self.diagnostic_prompt_instruction,
+                "question_to_clarify_issue": self.question_to_clarify_issue_prompt_instruction,
+                "decision": self.decision_prompt_instruction,
+                "final_summary": self.final_summary_prompt_instruction,
+                "history_summary": self.history_summary_prompt_instruction,
+            },
+            poll_seconds=prompt_poll_seconds,
+        ).start()
 
-    def load_prompts(self):
-        """Load instruction variables from the YAML file."""
-        try:
-            with open(self.prompts_file, 'r') as file:
-                prompts = yaml.safe_load(file)
-        except yaml.YAMLError as e:
-            print(f"Error parsing YAML file: {e}")
-            raise
-        except FileNotFoundError:
-            print(f"YAML file '{self.prompts_file}' not found.")
-            raise
-
-        # Update Instruction variables
-        try:
-            self.identify_issues_prompt_instruction = prompts['identify_issues_prompt_instruction']
-            self.medical_history_prompt_instruction = prompts['medical_history_prompt_instruction']
-            self.diagnostic_prompt_instruction = prompts['diagnostic_prompt_instruction']
-            self.question_to_clarify_issue_prompt_instruction = prompts['question_to_clarify_issue_prompt_instruction']
-            self.decision_prompt_instruction = prompts['decision_prompt_instruction']
-            self.final_summary_prompt_instruction = prompts['final_summary_prompt_instruction']
-        except KeyError as e:
-            print(f"Missing key in YAML file: {e}")
-            raise
+        # Compile workflow; conversations are separated by thread_id in the checkpointer
+        self.checkpointer = checkpointer
+        self.app = workflow.compile(checkpointer=checkpointer, interrupt_before=["doctor_message", "patient_message"])
 
     def update_prompts(self):
-        """Update instruction variables by reloading the YAML configuration."""
-        with self.lock:
-            self.load_prompts()
-            print("Instructions have been updated from the YAML file.")
+        """Pick up prompts.yaml changes now instead of waiting for the next poll."""
+        self.prompts.refresh()
 
-    def identify_issues(self, state):
-        self.loop_num += 1
-        formatted_prompt=self.identify_issues_prompt.invoke({"instruction": self.identify_issues_prompt_instruction, "health_issues": self.health_issues if self.health_issues else "" })
+    def history(self, state, summary=None, summarized=None):
+        """The conversation as the nodes send it: all messages, or with compaction on, a History
+        of the summary and the recent messages."""
         messages = state["messages"]
-        messages[0].content = formatted_prompt.text
-        health_issues_response = self.model.invoke(messages)
-        self.health_issues = health_issues_response.content
+        if self.compactor is None:
+            return messages
+        summary = summary if summary is not None else state.get("history_summary")
+        summarized = summarized if summarized is not None else state.get("summarized_messages", 0)
+        return self.compactor.view(messages, summary, summarized)
+
+    def with_instruction(self, messages, text, name):
+        # Copy of the history with the instruction swapped into the first (system) message,
+        # so concurrent calls never see each other's instruction
+        if self.compactor is None:
+            return [messages[0].model_copy(update={"content": text})] + list(messages[1:])
+        return self.compactor.fit(messages, text, name)
+
+    # Model inputs of each step; ask() and aask() send them with the blocking or the asyncio client,
+    # answering from the cache when the same model saw the same input under the same prompt version
+    def identify_issues_input(self, prompts, messages, health_issues):
+        formatted_prompt=prompts.templates["identify_issues"].invoke({"health_issues": health_issues if health_issues else "" })
+        return self.with_instruction(messages, formatted_prompt.text, "identify_issues")
+
+    def medical_history_input(self, prompts, messages):
+        formatted_prompt = prompts.templates["medical_history"].invoke({})
+        return self.with_instruction(messages, formatted_prompt.text, "medical_history")
+
+    def diagnosis_input(self, prompts, messages, health_issues, medical_history):
+        formatted_prompt = prompts.templates["diagnostic"].invoke(
+            {
+                "health_issues": health_issues if health_issues else "",
+                "medical_history": medical_history if medical_history else ""
+            }
+        )
+        return self.with_instruction(messages, formatted_prompt.text, "diagnostic")
 
-    def question_to_clarify_issue(self, state):
-        formatted_prompt = self.question_to_clarify_issue_prompt.invoke(
+    def decision_input(self, prompts, messages):
+        formatted_prompt = prompts.templates["decision"].invoke({})
+        return self.with_instruction(messages, formatted_prompt.text, "decision")
+
+    def question_to_clarify_issue_input(self, prompts, messages, health_issues, medical_history):
+        formatted_prompt = prompts.templates["question_to_clarify_issue"].invoke(
             {
-                "instruction": self.question_to_clarify_issue_prompt_instruction,
-                "health_issues": self.health_issues if self.health_issues else "",
-                "medical_history": self.medical_history if self.medical_history else ""
+                "health_issues": health_issues if health_issues else "",
+                "medical_history": medical_history if medical_history else ""
             }
         )
-        messages = state["messages"]
-        messages[0].content = formatted_prompt.text
-        questions_response = self.model.invoke(messages)
-        self.questions = questions_response.content
+        return self.with_instruction(messages, formatted_prompt.text, "question_to_clarify_issue")
 
-    def should_continue(self, state):
-        formatted_prompt = self.decision_prompt.invoke({"instruction": self.decision_prompt_instruction})
-        messages = state["messages"]
-        messages[0].content = formatted_prompt.text
-        response = self.model.invoke(messages).content.strip().lower()
-        if response == 'yes' or self.loop_num >= self.max_loop:
+    def final_summary_input(self, prompts, state):
+        formatted_final_summary = prompts.templates["final_summary"].invoke(
+            {
+                "diagnosis": state.get("current_diagnose", ""),
+                "medical_history": state.get("medical_history", "")
+            }
+        )
+        return [{"content": formatted_final_summary.text, "role": "system"}]
+
+    def history_summary_input(self, prompts, summary, messages):
+        formatted_prompt = prompts.templates["history_summary"].invoke(
+            {"summary": summary if summary else "(none yet)", "conversation": transcript(messages)}
+        )
+        return [{"content": formatted_prompt.text, "role": "system"}]
+
+    def cache_key(self, model_input, prompts):
+        if self.cache is None:
+            return None
+        return cache_key(getattr(self.model, "model_name", type(self.model).__name__), prompts.version, model_input)
+
+    def ask(self, model_input, prompts):
+        key = self.cache_key(model_input, prompts)
+        content = self.cache.get(key) if key is not None else None
+        if content is None:
+            content = self.model.invoke(model_input).content
+            if key is not None:
+                self.cache.put(key, content)
+        return content
+
+    async def aask(self, model_input, prompts):
+        key = self.cache_key(model_input, prompts)
+        content = await self.cache.aget(key) if key is not None else None
+        if content is None:
+            content = (await self.model.ainvoke(model_input)).content
+            if key is not None:
+                await self.cache.aput(key, content)
+        return content
+
+    @staticmethod
+    def parse_decision(response):
+        return response.strip().lower()
+
+    def pending_summary(self, state):
+        """Messages to fold into the history summary this turn, or [] when there are none."""
+        if self.compactor is None:
+            return []
+        return self.compactor.pending(state["messages"], state.get("summarized_messages", 0))
+
+    def summary_update(self, state, pending, summary):
+        return {"history_summary": summary, "summarized_messages": state.get("summarized_messages", 0) + len(pending)}
+
+    def identify_issues(self, state):
+        prompts = self.prompts.current
+        health_issues = state.get("health_issues")
+        update = {"loop_num": state.get("loop_num", 0) + 1, "decision": None, "prompt_version": prompts.version}
+        pending = self.pending_summary(state)
+        if not self.parallel:
+            if pending:
+                update.update(self.summary_update(state, pending, self.ask(
+                    self.history_summary_input(prompts, state.get("history_summary"), pending), prompts)))
+            messages = self.history(state, update.get("history_summary"), update.get("summarized_messages"))
+            update["health_issues"] = self.ask(self.identify_issues_input(prompts, messages, health_issues), prompts)
+            return update
+        # Issues, medical history and the continue/end decision only depend on the conversation,
+        # so all three model calls run at once. The summary is updated alongside them; until it is
+        # ready they see the messages being folded verbatim.
+        messages = self.history(state)
+        with ThreadPoolExecutor(max_workers=3) as workers:
+            summary = workers.submit(self.ask, self.history_summary_input(prompts, state.get("history_summary"), pending), prompts) if pending else None
+            history = workers.submit(self.ask, self.medical_history_input(prompts, messages), prompts)
+            decision = workers.submit(self.ask, self.decision_input(prompts, messages), prompts)
+            update["health_issues"] = self.ask(self.identify_issues_input(prompts, messages, health_issues), prompts)
+            update["medical_history"] = history.result()
+            update["decision"] = self.parse_decision(decision.result())
+            if summary is not None:
+                update.update(self.summary_update(state, pending, summary.result()))
+        return update
+
+    async def aidentify_issues(self, state):
+        prompts = self.prompts.current
+        health_issues = state.get("health_issues")
+        update = {"loop_num": state.get("loop_num", 0) + 1, "decision": None, "prompt_version": prompts.version}
+        pending = self.pending_summary(state)
+        if not self.parallel:
+            if pending:
+                update.update(self.summary_update(state, pending, await self.aask(
+                    self.history_summary_input(prompts, state.get("history_summary"), pending), prompts)))
+            messages = self.history(state, update.get("history_summary"), update.get("summarized_messages"))
+            update["health_issues"] = await self.aask(self.identify_issues_input(prompts, messages, health_issues), prompts)
+            return update
+        messages = self.history(state)
+        calls = [
+            self.aask(self.identify_issues_input(prompts, messages, health_issues), prompts),
+            self.aask(self.medical_history_input(prompts, messages), prompts),
+            self.aask(self.decision_input(prompts, messages), prompts),
+        ]
+        if pending:
+            calls.append(self.aask(self.history_summary_input(prompts, state.get("history_summary"), pending), prompts))
+        results = await asyncio.gather(*calls)
+        update["health_issues"], update["medical_history"], decision = results[:3]
+        update["decision"] = self.parse_decision(decision)
+        if pending:
+            update.update(self.summary_update(state, pending, results[3]))
+        return update
+
+    def question_to_clarify_issue(self, state):
+        if state.get("prefetched_questions") is not None:
+            return {"questions": state["prefetched_questions"], "prefetched_questions": None}
+        prompts = self.prompts.current
+        return {"questions": self.ask(self.question_to_clarify_issue_input(
+            prompts, self.history(state), state.get("health_issues"), state.get("medical_history")), prompts)}
+
+    async def aquestion_to_clarify_issue(self, state):
+        if state.get("prefetched_questions") is not None:
+            return {"questions": state["prefetched_questions"], "prefetched_questions": None}
+        prompts = self.prompts.current
+        return {"questions": await self.aask(self.question_to_clarify_issue_input(
+            prompts, self.history(state), state.get("health_issues"), state.get("medical_history")), prompts)}
+
+    def should_continue(self, state, config):
+        response = state.get("decision")
+        if response is None:
+            prompts = self.prompts.current
+            response = self.parse_decision(self.ask(self.decision_input(prompts, self.history(state)), prompts))
+        return self.route(response, state, config)
+
+    async def ashould_continue(self, state, config):
+        response = state.get("decision")
+        if response is None:
+            prompts = self.prompts.current
+            response = self.parse_decision(await self.aask(self.decision_input(prompts, self.history(state)), prompts))
+        return self.route(response, state, config)
+
+    def route(self, response, state, config):
+        if response == 'yes' or state.get("loop_num", 0) >= self.max_loop(config):
             return "end"
         else:
             return "continue"
 
-    def diagnosis(self, state):
-        # Update medical history
-        formatted_medical_history_prompt = self.medical_history_prompt.invoke({"instruction": self.medical_history_prompt_instruction})
-        messages = state["messages"]
-        messages[0].content = formatted_medical_history_prompt.text
-        medical_history_response = self.model.invoke(messages)
-        self.medical_history = medical_history_response.content
-
-        # Generate diagnosis
-        formatted_prompt = self.diagnostic_prompt.invoke(
-            {
-                "instruction": self.diagnostic_prompt_instruction,
-                "health_issues": self.health_issues if self.health_issues else "",
-                "medical_history": self.medical_history if self.medical_history else ""
+    def diagnosis(self, state, config):
+        prompts = self.prompts.current
+        messages = self.history(state)
+        health_issues = state.get("health_issues")
+        if not self.parallel:
+            # Update medical history, then generate the diagnosis from it
+            medical_history = self.ask(self.medical_history_input(prompts, messages), prompts)
+            return {
+                "medical_history": medical_history,
+                "current_diagnose": self.ask(self.diagnosis_input(prompts, messages, health_issues, medical_history), prompts),
             }
-        )
-        messages[0].content = formatted_prompt.text
-        diagnosis_response = self.model.invoke(messages)
-        self.current_diagnose = diagnosis_response.content
+        # The decision is already known, so if the conversation continues the clarifying
+        # questions can be generated alongside the diagnosis
+        medical_history = state.get("medical_history")
+        update = {"prefetched_questions": None}
+        with ThreadPoolExecutor(max_workers=1) as workers:
+            diagnosis = workers.submit(self.ask, self.diagnosis_input(prompts, messages, health_issues, medical_history), prompts)
+            if self.will_continue(state, config):
+                update["prefetched_questions"] = self.ask(self.question_to_clarify_issue_input(prompts, messages, health_issues, medical_history), prompts)
+            update["current_diagnose"] = diagnosis.result()
+        return update
+
+    async def adiagnosis(self, state, config):
+        prompts = self.prompts.current
+        messages = self.history(state)
+        health_issues = state.get("health_issues")
+        if not self.parallel:
+            medical_history = await self.aask(self.medical_history_input(prompts, messages), prompts)
+            return {
+                "medical_history": medical_history,
+                "current_diagnose": await self.aask(self.diagnosis_input(prompts, messages, health_issues, medical_history), prompts),
+            }
+        medical_history = state.get("medical_history")
+        calls = [self.aask(self.diagnosis_input(prompts, messages, health_issues, medical_history), prompts)]
+        if self.will_continue(state, config):
+            calls.append(self.aask(self.question_to_clarify_issue_input(prompts, messages, health_issues, medical_history), prompts))
+        results = await asyncio.gather(*calls)
+        return {"current_diagnose": results[0], "prefetched_questions": results[1] if len(results) > 1 else None}
+
+    def will_continue(self, state, config):
+        return state.get("decision") != 'yes' and state.get("loop_num", 0) < self.max_loop(config)
+
+    @staticmethod
+    def max_loop(config):
+        return config["configurable"].get("max_loop", 10)
 
     def doctor_message(self, state):
         pass  # Implement as needed
@@ -343,50 +572,154 @@ class AIConversation:
     def patient_message(self, state):
         pass  # Implement as needed
 
-    def final_conclusion(self, state):
-        formatted_final_summary = self.final_summary_prompt.invoke(
-            {
-                "instruction": self.final_summary_prompt_instruction,
-                "diagnosis": self.current_diagnose,
-                "medical_history": self.medical_history
-            }
-        )
-        final_answer = self.model.invoke({"messages": [{"content": formatted_final_summary.text, "role": "system"}]})
-        return {"messages": [final_answer]}
+    def final_conclusion(self, state, config):
+        prompts = self.prompts.current
+        final_input = self.final_summary_input(prompts, state)
+        # Streaming requests pass a callback that receives the summary token by token
+        on_token = config["configurable"].get("on_token")
+        # Questions from the previous loop are cleared so the handler sees the consultation has ended
+        if on_token is None:
+            return {"messages": [AIMessage(content=self.ask(final_input, prompts))], "questions": ""}
+        key = self.cache_key(final_input, prompts)
+        content = self.cache.get(key) if key is not None else None
+        if content is not None:
+            # A cached summary is delivered as a single token
+            on_token(content)
+            return {"messages": [AIMessage(content=content)], "questions": ""}
+        content = ""
+        for chunk in self.model.stream(final_input):
+            if chunk.content:
+                on_token(chunk.content)
+                content += chunk.content
+        if key is not None:
+            self.cache.put(key, content)
+        return {"messages": [AIMessage(content=content)], "questions": ""}
+
+    async def afinal_conclusion(self, state, config):
+        prompts = self.prompts.current
+        final_input = self.final_summary_input(prompts, state)
+        on_token = config["configurable"].get("on_token")
+        if on_token is None:
+            return {"messages": [AIMessage(content=await self.aask(final_input, prompts))], "questions": ""}
+        key = self.cache_key(final_input, prompts)
+        content = await self.cache.aget(key) if key is not None else None
+        if content is not None:
+            on_token(content)
+            return {"messages": [AIMessage(content=content)], "questions": ""}
+        content = ""
+        async for chunk in self.model.astream(final_input):
+            if chunk.content:
+                on_token(chunk.content)
+                content += chunk.content
+        if key is not None:
+            await self.cache.aput(key, content)
+        return {"messages": [AIMessage(content=content)], "questions": ""}
+
+
+# AIConversation class: a handle on one conversation's thread in the shared graph
+class AIConversation:
+    def __init__(self, id, max_loop=10, graph=None) -> None:
+        self.graph = graph if graph is not None else get_graph()
+        self.app = self.graph.app
+        self.config = {"configurable": {"thread_id": str(id), "max_loop": max_loop}}
+
+    def update_prompts(self):
+        self.graph.update_prompts()
 
     def invoke(self):
         mes = {"messages": [{"content": "Start conversation", "role": "system"}]}
         self.app.invoke(mes, config=self.config)
 
+    async def ainvoke(self):
+        mes = {"messages": [{"content": "Start conversation", "role": "system"}]}
+        await self.app.ainvoke(mes, config=self.config)
+
+    def values(self):
+        return self.app.get_state(self.config).values
+
+    async def avalues(self):
+        return (await self.app.aget_state(self.config)).values
+
+    @property
+    def health_issues(self):
+        return self.values().get("health_issues")
+
+    @property
+    def medical_history(self):
+        return self.values().get("medical_history", "")
 
-# Initialize the conversation instance and a lock for thread safety
-conv = None
-conv_lock = Lock()
+    @property
+    def current_diagnose(self):
+        return self.values().get("current_diagnose", "")
 
-# Function to load or create a new conversation instance
-def get_conversation(conversation_id=None):
-    global conv
-    with conv_lock:
-        if conv is None or (conversation_id and conv.config.get("configurable") != conversation_id):
-            uuid1 = uuid.uuid1()
-            conv = AIConversation(uuid1, max_loop=10)
-            conv.invoke()
-        return conv
+    @property
+    def questions(self):
+        return self.values().get("questions", {})
+
+    @property
+    def loop_num(self):
+        return self.values().get("loop_num", 0)
+
+    @property
+    def prompt_version(self):
+        return self.values().get("prompt_version", self.graph.prompts.current.version)
+
+
+# The shared graph is built on first use
+graph = None
+graph_lock = Lock()
+
+def get_graph():
+    global graph
+    if graph is None:
+        with graph_lock:
+            if graph is None:
+                graph = ConsultationGraph()
+    return graph
+
+
+# Function to create a new conversation instance
+def new_conversation(session_id):
+    conversation = AIConversation(session_id, max_loop=10)
+    # A thread already in the checkpointer (e.g. before a restart) resumes where it stopped
+    if not conversation.app.get_state(conversation.config).values:
+        conversation.invoke()
+    return conversation
+
+# Conversations of all clinicians served by this process, keyed by conversationId
+sessions = SessionManager(
+    new_conversation,
+    max_sessions=int(os.getenv('DIALOG_MAX_SESSIONS', '100')),
+    idle_ttl_seconds=float(os.getenv('DIALOG_SESSION_IDLE_TTL', '1800')),
+    # In-memory checkpoints of an evicted session can never be resumed, so free them
+    on_evict=(lambda session_id: delete_thread(checkpointer, session_id)) if isinstance(checkpointer, MemorySaver) else None,
+)
 
 # API endpoint to receive the human's message
 @app.route('/api/ask', methods=['POST'])
 def receive_human_answer():
-    global conv
-
     data = request.json
-
+    try:
+        with sessions.session(data.get('conversationId')) as session:
+            return answer(session, data)
+    except SessionLimitReached as e:
+        return jsonify({"error": str(e)}), 503
+
+@app.route('/api/sessions', methods=['GET'])
+def session_stats():
+    stats = sessions.stats()
+    stats["checkpoints"] = checkpointer.stats() if hasattr(checkpointer, "stats") else None
+    stats["llm_cache"] = llm_cache.stats() if llm_cache is not None else None
+    return jsonify(stats)
+
+def end_conversation(session_id):
+    sessions.discard(session_id)
+    delete_thread(checkpointer, session_id)
+
+def human_messages(data):
     # Extract data from the request
     doctor_message_content = data.get('doctorMessage', "")
     patient_message_content = data.get('patientMessage', "")
-    conversation_id = data.get('conversationId')
-
-    # Get or create a conversation instance
-    conv = get_conversation(conversation_id)
 
     # Define messages with roles
     doctor_message = HumanMessage(
@@ -404,9 +737,10 @@ def receive_human_answer():
         content="",
         additional_kwargs={"role": "patient"}
     )
+    return doctor_message, patient_message
 
-    # Update instructions from YAML before processing
-    conv.update_prompts()
+def add_human_messages(conv, data):
+    doctor_message, patient_message = human_messages(data)
 
     # Process doctor message
     for event in conv.app.stream({"messages": [doctor_message]}, conv.config, stream_mode="values"):
@@ -418,43 +752,118 @@ def receive_human_answer():
         event["messages"][-1].pretty_print()
     conv.app.update_state(conv.config, {"messages": patient_message}, as_node="patient_message")
 
+def answer(session, data):
+    conv = session.conversation
+    add_human_messages(conv, data)
+
     # Stream the next steps
     for event in conv.app.stream(None, conv.config, stream_mode="values"):
         event["messages"][-1].pretty_print()
     feedbackFromAI = event["messages"][-1].content
 
-    if 'question_to_clarify' in conv.questions:
+    response_data, status = build_response(session.session_id, conv.values(), feedbackFromAI)
+    return jsonify(response_data), status
+
+def build_response(session_id, values, feedbackFromAI, end=end_conversation):
+    """Response body and status for a finished turn, from the conversation's graph state values."""
+    prompt_version = values.get("prompt_version", get_graph().prompts.current.version)
+    if 'question_to_clarify' in values.get("questions", ""):
         try:
             # Combine JSON data
-            diagnosis = json.loads(conv.current_diagnose).get("diagnoses", {})
-            questions = json.loads(conv.questions).get("question_to_clarify", {})
+            diagnosis = json.loads(values.get("current_diagnose", "")).get("diagnoses", {})
+            questions = json.loads(values["questions"]).get("question_to_clarify", {})
             response_data = {
                 "diagnosis": diagnosis,
-                "heath_issue_summarization": conv.medical_history,
+                "heath_issue_summarization": values.get("medical_history", ""),
                 "question_to_clarify": questions,
-                "conversationId": conv.config.get("configurable"),
+                "conversationId": {"thread_id": session_id},
+                "promptVersion": prompt_version,
             }
-            print("response_data",response_data)
-            return jsonify(response_data)
+            return response_data, 200
         except json.JSONDecodeError:
-            return jsonify({"error": "Invalid JSON format in AI response."}), 500
+            return {"error": "Invalid JSON format in AI response."}, 500
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
+            return {"error": str(e)}, 500
     else:
         try:
             # Combine JSON data
             response_data = {
                 "diagnosis": feedbackFromAI,
-                "health_issue_summarization": conv.medical_history,
+                "health_issue_summarization": values.get("medical_history", ""),
                 "question_to_clarify": {},
-                "conversationId": conv.config.get("configurable"),
+                "conversationId": {"thread_id": session_id},
+                "promptVersion": prompt_version,
             }
-            with conv_lock:
-                del conv  # Remove the old instance
-                conv = None  # Reset to allow new conversation
-            return jsonify(response_data)
+            end(session_id)  # The consultation is over; the next request starts a new one
+            return response_data, 200
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
+            return {"error": str(e)}, 500
+
+# Progress event sent when a node finishes, and the state fields it reports
+PROGRESS_EVENTS = {
+    "identify_issue": ("issues_identified", ("health_issues", "medical_history")),
+    "diagnosis": ("diagnosis_ready", ("current_diagnose", "medical_history")),
+    "question_to_clarify_issue": ("questions_ready", ("questions",)),
+    "final_conclusion": ("final_conclusion_ready", ()),
+}
+
+def progress_event(node, values):
+    """Payload of the progress event for a node's state update, or None for nodes that report nothing."""
+    if node not in PROGRESS_EVENTS:
+        return None
+    stage, fields = PROGRESS_EVENTS[node]
+    payload = {"node": node, "stage": stage}
+    payload.update({field: values[field] for field in fields if values and values.get(field) is not None})
+    return payload
+
+def sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def run_turn_with_events(conv, data, events):
+    """Run one turn, putting (event, payload) pairs on the events queue; ends with ("done", feedback)."""
+    try:
+        add_human_messages(conv, data)
+        config = {"configurable": {**conv.config["configurable"], "on_token": lambda text: events.put(("token", {"text": text}))}}
+        for update in conv.app.stream(None, config, stream_mode="updates"):
+            for node, values in update.items():
+                payload = progress_event(node, values)
+                if payload is not None:
+                    events.put(("progress", payload))
+        events.put(("done", conv.values()["messages"][-1].content))
+    except Exception as e:
+        events.put(("error", {"error": str(e)}))
+
+# Streaming variant of /api/ask: server-sent events with node progress, summary tokens and the final response
+@app.route('/api/ask/stream', methods=['POST'])
+def stream_human_answer():
+    data = request.json
+
+    def generate():
+        try:
+            with sessions.session(data.get('conversationId')) as session:
+                conv = session.conversation
+                yield sse("session", {"conversationId": {"thread_id": session.session_id}})
+                events = queue.Queue()
+                worker = Thread(target=run_turn_with_events, args=(conv, data, events), daemon=True)
+                worker.start()
+                try:
+                    while True:
+                        event, payload = events.get()
+                        if event == "done":
+                            response_data, status = build_response(session.session_id, conv.values(), payload)
+                            yield sse("result" if status == 200 else "error", response_data)
+                            return
+                        yield sse(event, payload)
+                        if event == "error":
+                            return
+                finally:
+                    # Keep the session locked until the turn finishes, even if the client went away
+                    worker.join()
+        except SessionLimitReached as e:
+            yield sse("error", {"error": str(e)})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # Removed the /api/update_prompts endpoint since prompts.yaml is updated manually
 
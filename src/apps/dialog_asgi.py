@@ -0,0 +1,144 @@
+# dialog_asgi.py
+#
+# ASGI serving mode for the dialog3 consultation graph: same endpoints and responses as the Flask
+# app, but each turn runs through ainvoke/astream on the graph and ChatOpenAI, so a turn waiting on
+# the model holds no thread and one process can keep hundreds of them in flight.
+#
+#     uvicorn apps.dialog_asgi:app --app-dir src --host 0.0.0.0 --port 5001
+
+import asyncio
+import os
+import sys
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from apps.dialog3 import AIConversation, build_response, checkpointer, human_messages, llm_cache, progress_event, sse
+from langgraph.checkpoint.memory import MemorySaver
+from utils.checkpoints import delete_thread
+from utils.sessions import AsyncSessionManager, SessionLimitReached
+
+
+async def new_conversation(session_id):
+    conversation = AIConversation(session_id, max_loop=10)
+    # A thread already in the checkpointer (e.g. before a restart) resumes where it stopped
+    if not await conversation.avalues():
+        await conversation.ainvoke()
+    return conversation
+
+# Conversations of all clinicians served by this process, keyed by conversationId
+sessions = AsyncSessionManager(
+    new_conversation,
+    max_sessions=int(os.getenv('DIALOG_MAX_SESSIONS', '100')),
+    idle_ttl_seconds=float(os.getenv('DIALOG_SESSION_IDLE_TTL', '1800')),
+    # In-memory checkpoints of an evicted session can never be resumed, so free them
+    on_evict=(lambda session_id: in_background(delete_thread, checkpointer, session_id)) if isinstance(checkpointer, MemorySaver) else None,
+)
+# Tasks started by in_background, referenced until they finish so they are not garbage collected
+background_tasks = set()
+
+def in_background(function, *args):
+    # For blocking calls made from synchronous code on the event loop (e.g. the eviction callback)
+    task = asyncio.get_running_loop().create_task(asyncio.to_thread(function, *args))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def end_conversation(session_id):
+    sessions.discard(session_id)
+    # Deleting checkpoints is blocking SQLite I/O with a durable checkpointer
+    await asyncio.to_thread(delete_thread, checkpointer, session_id)
+
+async def finish_turn(session_id, values, feedbackFromAI):
+    """build_response for the event loop: a finished consultation is ended without blocking it."""
+    ended = []
+    response_data, status = build_response(session_id, values, feedbackFromAI, end=ended.append)
+    for ended_id in ended:
+        await end_conversation(ended_id)
+    return response_data, status
+
+async def add_human_messages(conv, data):
+    doctor_message, patient_message = human_messages(data)
+    await conv.app.ainvoke({"messages": [doctor_message]}, conv.config)
+    await conv.app.aupdate_state(conv.config, {"messages": doctor_message}, as_node="doctor_message")
+    await conv.app.ainvoke({"messages": [patient_message]}, conv.config)
+    await conv.app.aupdate_state(conv.config, {"messages": patient_message}, as_node="patient_message")
+
+async def receive_human_answer(request):
+    data = await request.json()
+    try:
+        async with sessions.session(data.get('conversationId')) as session:
+            conv = session.conversation
+            await add_human_messages(conv, data)
+            values = await conv.app.ainvoke(None, conv.config)
+            feedbackFromAI = values["messages"][-1].content
+            response_data, status = await finish_turn(session.session_id, await conv.avalues(), feedbackFromAI)
+            return JSONResponse(response_data, status_code=status)
+    except SessionLimitReached as e:
+        return JSONResponse({"error": str(e)}, status_code=503)
+
+async def run_turn_with_events(conv, data, events):
+    """Run one turn, putting (event, payload) pairs on the events queue; ends with ("done", feedback)."""
+    try:
+        await add_human_messages(conv, data)
+        config = {"configurable": {**conv.config["configurable"], "on_token": lambda text: events.put_nowait(("token", {"text": text}))}}
+        async for update in conv.app.astream(None, config, stream_mode="updates"):
+            for node, values in update.items():
+                payload = progress_event(node, values)
+                if payload is not None:
+                    events.put_nowait(("progress", payload))
+        events.put_nowait(("done", (await conv.avalues())["messages"][-1].content))
+    except Exception as e:
+        events.put_nowait(("error", {"error": str(e)}))
+
+async def stream_human_answer(request):
+    data = await request.json()
+
+    async def generate():
+        try:
+            async with sessions.session(data.get('conversationId')) as session:
+                conv = session.conversation
+                yield sse("session", {"conversationId": {"thread_id": session.session_id}})
+                events = asyncio.Queue()
+                turn = asyncio.create_task(run_turn_with_events(conv, data, events))
+                try:
+                    while True:
+                        event, payload = await events.get()
+                        if event == "done":
+                            response_data, status = await finish_turn(session.session_id, await conv.avalues(), payload)
+                            yield sse("result" if status == 200 else "error", response_data)
+                            return
+                        yield sse(event, payload)
+                        if event == "error":
+                            return
+                finally:
+                    # Keep the session locked until the turn finishes, even if the client went away
+                    await asyncio.shield(turn)
+        except SessionLimitReached as e:
+            yield sse("error", {"error": str(e)})
+
+    return StreamingResponse(generate(), media_type='text/event-stream',
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def session_stats(request):
+    stats = sessions.stats()
+    stats["checkpoints"] = checkpointer.stats() if hasattr(checkpointer, "stats") else None
+    stats["llm_cache"] = llm_cache.stats() if llm_cache is not None else None
+    return JSONResponse(stats)
+
+
+app = Starlette(
+    routes=[
+        Route('/api/ask', receive_human_answer, methods=['POST']),
+        Route('/api/ask/stream', stream_human_answer, methods=['POST']),
+        Route('/api/sessions', session_stats, methods=['GET']),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+)
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=5001)
@@ -0,0 +1,513 @@
+"""Data warehousing for the consultation chatbot.
+
+Incremental extraction of consultations from the SQL Server source (or a local SQLite stand-in)
+into a Parquet store:
+
+    python src/datasets/warehousing.py extract --odbc "$CONSULTATION_DB_CONN" --store ./consultation_table
+    python src/datasets/warehousing.py extract --sqlite ./standin.db --store ./consultation_table
+
+There is one row per call transcription (a consultation can have several). Only rows past the
+stored (CreatedDate, TranscriptionId) watermark are fetched, in fetchmany chunks, and each chunk
+is appended as a new Parquet part file; --merge compacts the parts afterwards. A SQLite stand-in
+with the source schema, optionally filled with sample consultations, is created by:
+
+    python src/datasets/warehousing.py init-standin --sqlite ./standin.db --sample 100
+
+Incremental ingestion of transcript files into the conDB Chroma collection:
+
+    python src/datasets/warehousing.py ingest --source ../Consultations20240916 --persist-directory ./consultation_db
+
+Every chunk gets a content-addressed id, so re-running only embeds chunks that are new or changed,
+deletes chunks whose text or source file is gone, and leaves everything else untouched. A manifest
+of file sizes/mtimes/hashes lets unchanged files be skipped without even being read.
+
+Files are streamed through read/split -> embed -> write stages connected by bounded queues, so
+peak memory does not grow with the corpus and embedding overlaps with file I/O and splitting.
+"""
+import argparse
+import datetime
+import glob
+import hashlib
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from utils.query_cache import CollectionVersion
+
+# Same splitting parameters as datasets/VectorDB.ipynb
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 20
+
+
+def open_vector_store(persist_directory, collection_name, embedding):
+    # Ensure pysqlite3 is used for sqlite3
+    __import__('pysqlite3')
+    sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+    from langchain_community.vectorstores import Chroma
+    return Chroma(collection_name=collection_name, embedding_function=embedding, persist_directory=persist_directory)
+
+
+def make_splitter():
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+
+
+def sha256_text(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def chunk_id(source, content):
+    # Content-addressed: the same text from the same file always gets the same id
+    return sha256_text(f"{source}\0{content}")
+
+
+def read_text(path):
+    with open(path, encoding='utf-8', errors='replace') as file:
+        return file.read()
+
+
+def split_document(source, text, splitter):
+    """Split one file into (id, text, metadata) chunks, dropping duplicate chunks."""
+    chunks = {}
+    for content in splitter.split_text(text):
+        cid = chunk_id(source, content)
+        if cid not in chunks:
+            chunks[cid] = (cid, content, {"source": source, "content_hash": sha256_text(content)})
+    return list(chunks.values())
+
+
+class Manifest:
+    """Per-file record of what was last ingested: {source: {size, mtime, sha256, chunk_ids}}."""
+    def __init__(self, path):
+        self.path = path
+        self.exists = os.path.exists(path)
+        self.files = {}
+        if self.exists:
+            with open(path) as file:
+                self.files = json.load(file)
+
+    def unchanged(self, source, stat):
+        entry = self.files.get(source)
+        return entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(self.files, file)
+        os.replace(tmp_path, self.path)
+
+
+class IncrementalIngestor:
+    def __init__(self, vector_store, manifest, collection_version, batch_size=64, workers=4):
+        self.collection = vector_store._collection
+        self.embedding = vector_store.embeddings
+        self.manifest = manifest
+        self.collection_version = collection_version
+        self.batch_size = batch_size
+        self.workers = workers
+        self.splitter = make_splitter()
+
+    def existing_ids(self, source):
+        return set(self.collection.get(where={"source": source}, include=[])["ids"])
+
+    def iter_changes(self, source_dir, pattern, stats):
+        """Walk the source files one at a time, yielding ("delete", ids) and ("add", chunk) items."""
+        seen = set()
+        for path in glob.iglob(os.path.join(source_dir, pattern), recursive=True):
+            if not os.path.isfile(path):
+                continue
+            # Relative to the source folder, so the same file keeps its ids however --source is spelled
+            source = os.path.relpath(path, source_dir)
+            seen.add(source)
+            stats["files"] += 1
+            stat = os.stat(path)
+            if self.manifest.unchanged(source, stat):
+                stats["skipped"] += 1
+                continue
+            text = read_text(path)
+            digest = sha256_text(text)
+            entry = self.manifest.files.get(source)
+            if entry is not None and entry["sha256"] == digest:
+                # Touched but not modified
+                entry.update(size=stat.st_size, mtime=stat.st_mtime_ns)
+                stats["skipped"] += 1
+                continue
+
+            stats["changed"] += 1
+            chunks = split_document(source, text, self.splitter)
+            new_ids = {cid for cid, _, _ in chunks}
+            # Without a manifest entry, ask the collection what it holds for this file
+            old_ids = set(entry["chunk_ids"]) if entry is not None else self.existing_ids(source)
+            if old_ids - new_ids:
+                yield "delete", sorted(old_ids - new_ids)
+            for chunk in chunks:
+                if chunk[0] not in old_ids:
+                    yield "add", chunk
+            self.manifest.files[source] = {"size": stat.st_size, "mtime": stat.st_mtime_ns,
+                                           "sha256": digest, "chunk_ids": sorted(new_ids)}
+
+        # Files that disappeared since the last run
+        if self.manifest.exists:
+            removed = [source for source in self.manifest.files if source not in seen]
+            for source in removed:
+                yield "delete", self.manifest.files.pop(source)["chunk_ids"]
+        else:
+            metadatas = self.collection.get(include=["metadatas"])
+            removed = {}
+            for cid, metadata in zip(metadatas["ids"], metadatas["metadatas"]):
+                source = (metadata or {}).get("source")
+                if source not in seen:
+                    removed.setdefault(source, []).append(cid)
+            for ids in removed.values():
+                yield "delete", ids
+        stats["removed"] = len(removed)
+
+    def produce(self, source_dir, pattern, stats, embed_queue, write_queue):
+        # Stage 1: read and split files, grouping new chunks into embedding batches
+        try:
+            batch = []
+            for kind, item in self.iter_changes(source_dir, pattern, stats):
+                if kind == "delete":
+                    write_queue.put(("delete", item))
+                    continue
+                batch.append(item)
+                if len(batch) == self.batch_size:
+                    embed_queue.put(batch)
+                    batch = []
+            if batch:
+                embed_queue.put(batch)
+        except Exception as e:
+            write_queue.put(("error", e))
+        finally:
+            for _ in range(self.workers):
+                embed_queue.put(None)
+
+    def embed(self, embed_queue, write_queue):
+        # Stage 2: embed batches; several of these run side by side
+        try:
+            while True:
+                batch = embed_queue.get()
+                if batch is None:
+                    break
+                embeddings = self.embedding.embed_documents([text for _, text, _ in batch])
+                write_queue.put(("add", (batch, embeddings)))
+        except Exception as e:
+            write_queue.put(("error", e))
+        finally:
+            write_queue.put(("done", None))
+
+    def run(self, source_dir, pattern="**/*.txt", queue_size=8):
+        """Pipelined ingestion: reading/splitting, embedding and writing overlap, and the bounded
+        queues between the stages keep memory flat however large the corpus is."""
+        started = time.monotonic()
+        stats = {"files": 0, "skipped": 0, "changed": 0, "removed": 0, "added": 0, "deleted": 0}
+        embed_queue = queue.Queue(maxsize=queue_size)
+        write_queue = queue.Queue(maxsize=queue_size)
+        threads = [threading.Thread(target=self.produce, args=(source_dir, pattern, stats, embed_queue, write_queue), daemon=True)]
+        threads += [threading.Thread(target=self.embed, args=(embed_queue, write_queue), daemon=True)
+                    for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        # Stage 3: all writes happen on this thread so SQLite sees a single writer
+        running = self.workers
+        while running:
+            kind, item = write_queue.get()
+            if kind == "done":
+                running -= 1
+            elif kind == "error":
+                raise item
+            elif kind == "delete":
+                for start in range(0, len(item), 5000):
+                    self.collection.delete(ids=item[start:start + 5000])
+                stats["deleted"] += len(item)
+            else:
+                batch, embeddings = item
+                self.collection.upsert(
+                    ids=[cid for cid, _, _ in batch],
+                    embeddings=embeddings,
+                    documents=[text for _, text, _ in batch],
+                    metadatas=[metadata for _, _, metadata in batch],
+                )
+                stats["added"] += len(batch)
+        for thread in threads:
+            thread.join()
+
+        self.manifest.save()
+        if stats["added"] or stats["deleted"]:
+            # Invalidate retriever caches and lexical index
+            self.collection_version.bump()
+        stats["seconds"] = round(time.monotonic() - started, 2)
+        return stats
+
+
+# Same join as datasets/connect_db.ipynb, ordered by the watermark columns
+CONSULTATION_QUERY = """
+SELECT
+    pp.Gender,
+    pp.DateOfBirth,
+    pp.Allergies,
+    cr.ConditionDescription,
+    cr.ConsultationType,
+    ct.TranscriptionText,
+    ct.Id AS TranscriptionId,
+    ct.ConsultationId,
+    ct.CreatedDate
+FROM
+    PatientProfiles pp
+JOIN
+    ConsultationRequests cr ON pp.Id = cr.PatientProfileId
+JOIN
+    Consultations c ON cr.Id = c.ConsultationRequestId
+LEFT JOIN
+    ConsultationCallTranscriptions ct ON c.Id = ct.ConsultationId
+WHERE
+    ct.TranscriptionText IS NOT NULL
+    {watermark_filter}
+ORDER BY
+    ct.CreatedDate, ct.Id
+"""
+WATERMARK_FILTER = "AND (ct.CreatedDate > ? OR (ct.CreatedDate = ? AND ct.Id > ?))"
+
+# Minimal schema of the source tables, for a local SQLite stand-in
+STANDIN_SCHEMA = """
+CREATE TABLE IF NOT EXISTS PatientProfiles (Id INTEGER PRIMARY KEY, LastName TEXT, Gender TEXT, DateOfBirth TEXT, Allergies TEXT);
+CREATE TABLE IF NOT EXISTS ConsultationRequests (Id INTEGER PRIMARY KEY, PatientProfileId INTEGER, ConditionDescription TEXT, ConsultationType TEXT);
+CREATE TABLE IF NOT EXISTS Consultations (Id INTEGER PRIMARY KEY, ConsultationRequestId INTEGER, StartDate TEXT);
+CREATE TABLE IF NOT EXISTS ConsultationCallTranscriptions (Id INTEGER PRIMARY KEY, ConsultationId INTEGER, TranscriptionText TEXT, CreatedDate TEXT);
+"""
+
+
+def to_watermark_value(value):
+    # Dates are stored as ISO strings, which both pyodbc and sqlite3 accept as parameters
+    return value.isoformat(sep=' ') if hasattr(value, 'isoformat') else value
+
+
+# Date columns of the extract; pyodbc returns them as datetime/date, the SQLite stand-in as ISO text
+TIMESTAMP_COLUMNS = ("DateOfBirth", "CreatedDate")
+
+
+def consultation_schema():
+    """Fixed Arrow schema of every part file, so a chunk whose column is all NULL still gets its real type."""
+    import pyarrow as pa
+    return pa.schema([
+        ("Gender", pa.string()),
+        ("DateOfBirth", pa.timestamp("us")),
+        ("Allergies", pa.string()),
+        ("ConditionDescription", pa.string()),
+        ("ConsultationType", pa.string()),
+        ("TranscriptionText", pa.string()),
+        ("TranscriptionId", pa.int64()),
+        ("ConsultationId", pa.int64()),
+        ("CreatedDate", pa.timestamp("us")),
+    ])
+
+
+def to_timestamp(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime.combine(value, datetime.time())
+    return datetime.datetime.fromisoformat(str(value))
+
+
+class Watermark:
+    """Last extracted (CreatedDate, TranscriptionId), kept as JSON next to the Parquet store."""
+    def __init__(self, path):
+        self.path = path
+        self.created_date = None
+        self.transcription_id = None
+        if os.path.exists(path):
+            with open(path) as file:
+                data = json.load(file)
+            self.created_date = data["CreatedDate"]
+            # Watermarks written before rows were keyed per transcription re-fetch that CreatedDate;
+            # merge() drops the duplicates
+            self.transcription_id = data.get("TranscriptionId", 0)
+
+    def advance(self, created_date, transcription_id):
+        self.created_date = to_watermark_value(created_date)
+        self.transcription_id = transcription_id
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump({"CreatedDate": self.created_date, "TranscriptionId": self.transcription_id}, file)
+        os.replace(tmp_path, self.path)
+
+
+class ConsultationExtractor:
+    def __init__(self, connection, store_dir, chunk_size=5000):
+        self.connection = connection
+        self.store_dir = store_dir
+        self.chunk_size = chunk_size
+        os.makedirs(store_dir, exist_ok=True)
+        self.watermark = Watermark(os.path.join(store_dir, "_watermark.json"))
+
+    def query(self):
+        if self.watermark.created_date is None:
+            return CONSULTATION_QUERY.format(watermark_filter=""), ()
+        params = (self.watermark.created_date, self.watermark.created_date, self.watermark.transcription_id)
+        return CONSULTATION_QUERY.format(watermark_filter=WATERMARK_FILTER), params
+
+    def run(self):
+        """Append every row past the watermark to the store; returns the number of rows moved."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = consultation_schema()
+        sql, params = self.query()
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        columns = [column[0] for column in cursor.description]
+        run_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        total = 0
+        part = 0
+        while True:
+            rows = cursor.fetchmany(self.chunk_size)
+            if not rows:
+                break
+            table = pa.Table.from_pydict({
+                name: [to_timestamp(row[i]) if name in TIMESTAMP_COLUMNS else row[i] for row in rows]
+                for i, name in enumerate(columns)
+            }, schema=schema)
+            pq.write_table(table, os.path.join(self.store_dir, f"part-{run_id}-{part:05d}.parquet"))
+            # The watermark only moves once the chunk is safely on disk, so a crash just re-fetches it
+            last = rows[-1]
+            self.watermark.advance(last[columns.index("CreatedDate")], last[columns.index("TranscriptionId")])
+            total += len(rows)
+            part += 1
+        cursor.close()
+        return total
+
+    def merge(self):
+        """Compact all part files into one, keeping one row per transcription."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        parts = sorted(glob.glob(os.path.join(self.store_dir, "part-*.parquet")))
+        if len(parts) <= 1:
+            return len(parts)
+        # Read part by part and cast to the fixed schema, which also converts parts written with
+        # ISO-string dates or all-NULL (null-typed) columns
+        schema = consultation_schema()
+        table = pa.concat_tables([pq.read_table(path).select(schema.names).cast(schema) for path in parts])
+        frame = table.to_pandas()
+        frame = frame.sort_values(["CreatedDate", "TranscriptionId"]).drop_duplicates("TranscriptionId", keep="last")
+        merged_path = os.path.join(self.store_dir, f"part-{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}-merged.parquet")
+        pq.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False), merged_path)
+        for path in parts:
+            if path != merged_path:
+                os.remove(path)
+        return len(parts)
+
+
+def connect(args):
+    if args.sqlite:
+        import sqlite3
+        return sqlite3.connect(args.sqlite)
+    import pyodbc
+    return pyodbc.connect(args.odbc or os.environ["CONSULTATION_DB_CONN"])
+
+
+def init_standin(args):
+    """Create the stand-in schema; --sample adds consultations, some with two transcriptions."""
+    import random
+    import sqlite3
+
+    connection = sqlite3.connect(args.sqlite)
+    try:
+        connection.executescript(STANDIN_SCHEMA)
+        start = connection.execute("SELECT COALESCE(MAX(Id), 0) FROM Consultations").fetchone()[0]
+        transcription = connection.execute("SELECT COALESCE(MAX(Id), 0) FROM ConsultationCallTranscriptions").fetchone()[0]
+        for n in range(start + 1, start + 1 + args.sample):
+            connection.execute("INSERT INTO PatientProfiles VALUES (?, ?, ?, ?, ?)",
+                               (n, f"Patient{n}", random.choice(["F", "M"]), f"19{random.randint(40, 99)}-01-01", ""))
+            connection.execute("INSERT INTO ConsultationRequests VALUES (?, ?, ?, ?)",
+                               (n, n, random.choice(["Headache", "Cough", "Rash", "Back pain"]), random.choice(["GP", "Specialist"])))
+            connection.execute("INSERT INTO Consultations VALUES (?, ?, ?)", (n, n, f"2024-09-{n % 28 + 1:02d}"))
+            for _ in range(random.choice([1, 1, 2])):
+                transcription += 1
+                connection.execute("INSERT INTO ConsultationCallTranscriptions VALUES (?, ?, ?, ?)",
+                                   (transcription, n, f"Doctor: What brings you in? Patient: consultation {n}, call {transcription}.",
+                                    f"2024-09-{n % 28 + 1:02d} 10:00:00"))
+        connection.commit()
+    finally:
+        connection.close()
+    print(f"Initialized {args.sqlite} with {args.sample} sample consultations")
+
+
+def extract(args):
+    connection = connect(args)
+    try:
+        extractor = ConsultationExtractor(connection, args.store, chunk_size=args.chunk_size)
+        rows = extractor.run()
+        print(f"Extracted {rows} new transcriptions into {args.store}")
+        if args.merge:
+            print(f"Merged {extractor.merge()} part files")
+    finally:
+        connection.close()
+
+
+def make_embedding(args):
+    if args.openai:
+        from langchain_openai.embeddings import OpenAIEmbeddings
+        return OpenAIEmbeddings()
+    from utils.APIs import APIEmbedding
+    # The pipeline's --workers embed threads are the only concurrency: each sends one batch at a time,
+    # so at most --workers requests reach the embedding server, over a pool with a connection each
+    return APIEmbedding(args.embedding_url, batch_size=args.batch_size, max_workers=1, pool_maxsize=args.workers,
+                        response_format=args.response_format)
+
+
+def ingest(args):
+    vector_store = open_vector_store(args.persist_directory, args.collection, make_embedding(args))
+    manifest = Manifest(args.manifest or os.path.join(args.persist_directory, f"{args.collection}.manifest.json"))
+    collection_version = CollectionVersion(os.path.join(args.persist_directory, f"{args.collection}.version"))
+    ingestor = IncrementalIngestor(vector_store, manifest, collection_version, batch_size=args.batch_size, workers=args.workers)
+    print(ingestor.run(args.source, args.pattern, queue_size=args.queue_size))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Consultation data warehousing")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = commands.add_parser("ingest", help="Incrementally load transcript files into the vector store")
+    ingest_parser.add_argument('--source', required=True, help="Folder of consultation transcripts")
+    ingest_parser.add_argument('--pattern', default="**/*.txt")
+    ingest_parser.add_argument('--persist-directory', default="./consultation_db")
+    ingest_parser.add_argument('--collection', default="conDB")
+    ingest_parser.add_argument('--manifest', help="Defaults to <persist-directory>/<collection>.manifest.json")
+    ingest_parser.add_argument('--embedding-url', default="http://localhost:8001/get_embedding")
+    ingest_parser.add_argument('--openai', action='store_true', help="Embed with OpenAIEmbeddings instead of the embedding server")
+    ingest_parser.add_argument('--response-format', default="float32", choices=['float32', 'float16', 'npy', 'json'],
+                               help="Wire format of embedding server responses")
+    ingest_parser.add_argument('--batch-size', type=int, default=64)
+    ingest_parser.add_argument('--workers', type=int, default=4, help="Embed threads, i.e. concurrent embedding requests")
+    ingest_parser.add_argument('--queue-size', type=int, default=8, help="Batches buffered between pipeline stages")
+    ingest_parser.set_defaults(func=ingest)
+
+    extract_parser = commands.add_parser("extract", help="Incrementally copy new consultations into a Parquet store")
+    source = extract_parser.add_mutually_exclusive_group()
+    source.add_argument('--odbc', help="ODBC connection string (defaults to $CONSULTATION_DB_CONN)")
+    source.add_argument('--sqlite', help="Path to a SQLite stand-in for the SQL Server source")
+    extract_parser.add_argument('--store', default="./consultation_table", help="Parquet store directory")
+    extract_parser.add_argument('--chunk-size', type=int, default=5000, help="Rows per fetchmany call and per part file")
+    extract_parser.add_argument('--merge', action='store_true', help="Compact part files after extracting")
+    extract_parser.set_defaults(func=extract)
+
+    standin_parser = commands.add_parser("init-standin", help="Create a SQLite stand-in with the source schema")
+    standin_parser.add_argument('--sqlite', required=True, help="Path of the SQLite database to create or extend")
+    standin_parser.add_argument('--sample', type=int, default=0, help="Sample consultations to insert")
+    standin_parser.set_defaults(func=init_standin)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
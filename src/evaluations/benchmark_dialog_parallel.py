@@ -0,0 +1,127 @@
+"""Compare per-turn wall-clock time of dialog3's serial and parallel node execution.
+
+The chat model is replaced by a stand-in that sleeps for a fixed latency per call, so the numbers
+reflect how many model round trips sit on the critical path of a turn rather than OpenAI's
+variance. No API key is needed. With --conversations N the same comparison is repeated with N
+consultations running their turns at the same time on one shared graph, as in the server.
+
+    python src/evaluations/benchmark_dialog_parallel.py --turns 5 --latency 1.5 --conversations 60
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.memory import MemorySaver
+
+from apps.dialog3 import AIConversation, ConsultationGraph
+from utils.history import estimate_tokens
+
+TURNS = [
+    ("What brings you in today?", "I have had a headache for three days."),
+    ("Where is the pain?", "Mostly behind my eyes, it gets worse in bright light."),
+    ("Any nausea or vomiting?", "Some nausea in the mornings, no vomiting."),
+    ("Have you had a fever?", "No fever, but my neck feels stiff."),
+    ("Any history of migraines?", "My mother had migraines, I never had them before."),
+]
+
+
+class SleepingModel:
+    """Stand-in for ChatOpenAI: waits `latency` seconds, plus `token_latency` seconds per 1000
+    prompt tokens, then answers by the kind of prompt."""
+    def __init__(self, latency, token_latency=0.0):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.calls = 0
+        self.prompt_tokens = 0
+
+    def delay(self, messages):
+        tokens = sum(estimate_tokens(message["content"] if isinstance(message, dict) else message.content) for message in messages)
+        self.calls += 1
+        self.prompt_tokens += tokens
+        return self.latency + self.token_latency * tokens / 1000
+
+    def invoke(self, messages):
+        time.sleep(self.delay(messages))
+        return self.answer(messages)
+
+    async def ainvoke(self, messages):
+        await asyncio.sleep(self.delay(messages))
+        return self.answer(messages)
+
+    @staticmethod
+    def answer(messages):
+        first = messages[0]
+        prompt = first["content"] if isinstance(first, dict) else first.content
+        if "Previous_health_issues" in prompt:
+            return AIMessage(content='{"headache": {"duration": "3 days", "severity": ""}}')
+        if "question_to_clarify" in prompt:
+            return AIMessage(content='{"question_to_clarify": {"1": "Is the pain throbbing?"}}')
+        if "diagnoses" in prompt:
+            return AIMessage(content='{"diagnoses": {"1": {"name": "Migraine", "justification": "", "link": ""}}}')
+        if "'yes' or 'no'" in prompt:
+            return AIMessage(content="no")
+        return AIMessage(content="Headache for three days with photophobia.")
+
+
+def run_turn(conv, doctor_text, patient_text):
+    # Same sequence as the /api/ask handler
+    doctor_message = HumanMessage(content=doctor_text, additional_kwargs={"role": "doctor"})
+    patient_message = HumanMessage(content=patient_text, additional_kwargs={"role": "patient"})
+    for _ in conv.app.stream({"messages": [doctor_message]}, conv.config, stream_mode="values"):
+        pass
+    conv.app.update_state(conv.config, {"messages": doctor_message}, as_node="doctor_message")
+    for _ in conv.app.stream({"messages": [patient_message]}, conv.config, stream_mode="values"):
+        pass
+    conv.app.update_state(conv.config, {"messages": patient_message}, as_node="patient_message")
+    for _ in conv.app.stream(None, conv.config, stream_mode="values"):
+        pass
+
+
+def consultation(graph, name, args):
+    conv = AIConversation(name, max_loop=args.turns + 1, graph=graph)
+    conv.invoke()
+    timings = []
+    for doctor_text, patient_text in (TURNS * args.turns)[:args.turns]:
+        started = time.perf_counter()
+        run_turn(conv, doctor_text, patient_text)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def benchmark(parallel, args, conversations=1):
+    # No answer cache: every simulated call has to be paid for, as on a first run
+    graph = ConsultationGraph(parallel=parallel, checkpointer=MemorySaver(), cache=None, compactor=None)
+    graph.model = SleepingModel(args.latency)
+    mode = 'parallel' if parallel else 'serial'
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=conversations) as pool:
+        results = list(pool.map(lambda i: consultation(graph, f"benchmark-{mode}-{i}", args), range(conversations)))
+    elapsed = time.perf_counter() - started
+    return np.concatenate(results), graph.model.calls / (args.turns * conversations), elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--turns', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=1.0, help="Seconds per simulated model call")
+    parser.add_argument('--conversations', type=int, default=1, help="Consultations running at the same time")
+    args = parser.parse_args()
+
+    for conversations in sorted({1, args.conversations}):
+        print(f"{conversations} concurrent consultation(s)")
+        print(f"{'mode':<10} {'calls/turn':>11} {'mean s':>8} {'p50 s':>8} {'max s':>8} {'total s':>8}")
+        results = {}
+        for parallel in (False, True):
+            timings, calls, elapsed = benchmark(parallel, args, conversations)
+            mode = 'parallel' if parallel else 'serial'
+            results[mode] = timings.mean()
+            print(f"{mode:<10} {calls:>11.1f} {timings.mean():>8.2f} {np.median(timings):>8.2f} {timings.max():>8.2f} {elapsed:>8.2f}")
+        print(f"Per-turn reduction: {1 - results['parallel'] / results['serial']:.0%}")
@@ -0,0 +1,57 @@
+"""Compare prompt tokens and turn time of dialog3 with and without rolling history compaction.
+
+Runs one long consultation against the SleepingModel of benchmark_dialog_parallel.py, whose
+latency grows with the prompt size (`--token-latency` seconds per 1000 prompt tokens), and
+reports the estimated prompt tokens per model call and the wall-clock time of every turn.
+
+    python src/evaluations/benchmark_history_compaction.py --turns 10 --keep 3 --budget 1500
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+from langgraph.checkpoint.memory import MemorySaver
+
+from apps.dialog3 import AIConversation, ConsultationGraph
+from evaluations.benchmark_dialog_parallel import TURNS, SleepingModel, run_turn
+from utils.history import HistoryCompactor
+
+# Patient answers in a real consultation are longer than the one-liners of TURNS
+DETAIL = (" It started after a long shift at work, I have been taking paracetamol twice a day"
+          " and it only helps for a few hours. I sleep badly and I have been drinking more coffee.")
+
+
+def benchmark(compactor, args):
+    graph = ConsultationGraph(checkpointer=MemorySaver(), cache=None, compactor=compactor)
+    graph.model = SleepingModel(args.latency, args.token_latency)
+    conv = AIConversation(f"benchmark-{'compacted' if compactor else 'full'}", max_loop=args.turns + 1, graph=graph)
+    conv.invoke()
+    rows = []
+    for doctor_text, patient_text in (TURNS * args.turns)[:args.turns]:
+        calls, tokens = graph.model.calls, graph.model.prompt_tokens
+        started = time.perf_counter()
+        run_turn(conv, doctor_text, patient_text + DETAIL)
+        elapsed = time.perf_counter() - started
+        rows.append(((graph.model.prompt_tokens - tokens) / (graph.model.calls - calls), elapsed))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--turns', type=int, default=10)
+    parser.add_argument('--keep', type=int, default=3, help="Exchanges kept verbatim")
+    parser.add_argument('--budget', type=int, default=3000, help="Prompt token budget per node")
+    parser.add_argument('--latency', type=float, default=0.2, help="Seconds per simulated model call")
+    parser.add_argument('--token-latency', type=float, default=0.5, help="Extra seconds per 1000 prompt tokens")
+    args = parser.parse_args()
+
+    full = benchmark(None, args)
+    compacted = benchmark(HistoryCompactor(args.keep, args.budget), args)
+    print(f"{'turn':>4} {'full tok/call':>14} {'compact tok/call':>17} {'full s':>8} {'compact s':>10}")
+    for turn, ((full_tokens, full_s), (compact_tokens, compact_s)) in enumerate(zip(full, compacted), 1):
+        print(f"{turn:>4} {full_tokens:>14.0f} {compact_tokens:>17.0f} {full_s:>8.2f} {compact_s:>10.2f}")
+    print(f"Prompt tokens, last turn: {1 - compacted[-1][0] / full[-1][0]:.0%} fewer per call")
@@ -0,0 +1,100 @@
+"""Compare query latency, memory and cold-start time of the Chroma and mmap vector-store backends.
+
+Each backend is measured in a fresh subprocess so its start-up time and RSS are its own. Query
+vectors are perturbed copies of stored vectors, so no embedding server is needed.
+
+    python src/utils/mmap_store.py --out ./consultation_mmap              # export once
+    python src/evaluations/benchmark_vector_store.py --queries 500 --k 3
+
+Cold start is measured with whatever is already in the OS page cache; drop caches first
+(echo 3 > /proc/sys/vm/drop_caches) for a truly cold number.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+
+def open_backend(backend, args):
+    if backend == 'chroma':
+        # Ensure pysqlite3 is used for sqlite3
+        __import__('pysqlite3')
+        sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+        import chromadb
+        return chromadb.PersistentClient(path=args.persist_directory).get_collection(args.collection)
+    from utils.mmap_store import MmapVectorStore
+    return MmapVectorStore(args.mmap_dir, use_hnsw=backend == 'mmap-hnsw')
+
+
+def sample_queries(args):
+    # Queries come from the mmap export so every backend answers the same ones
+    from utils.mmap_store import MmapVectorStore
+    store = MmapVectorStore(args.mmap_dir, use_hnsw=False)
+    rng = np.random.default_rng(args.seed)
+    positions = rng.integers(0, store.count, size=args.queries)
+    queries = np.stack([store.row(position) for position in positions])
+    return queries + rng.normal(scale=args.noise, size=queries.shape).astype(np.float32)
+
+
+def run_worker(backend, args):
+    queries = np.load(args.query_file)
+    started = time.perf_counter()
+    collection = open_backend(backend, args)
+    opened = time.perf_counter()
+    collection.query(query_embeddings=queries[:1].tolist(), n_results=args.k, include=["documents", "distances"])
+    first_query = time.perf_counter()
+
+    latencies = []
+    for query in queries:
+        t0 = time.perf_counter()
+        collection.query(query_embeddings=[query.tolist()], n_results=args.k, include=["documents", "distances"])
+        latencies.append((time.perf_counter() - t0) * 1000)
+    latencies = np.array(latencies)
+    print(json.dumps({
+        "backend": backend,
+        "open_s": opened - started,
+        "cold_start_s": first_query - started,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "mean_ms": float(latencies.mean()),
+        # ru_maxrss is reported in kilobytes on Linux
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', default=['chroma', 'mmap'], choices=['chroma', 'mmap', 'mmap-hnsw'])
+    parser.add_argument('--persist-directory', default='./consultation_db')
+    parser.add_argument('--collection', default='conDB')
+    parser.add_argument('--mmap-dir', default='./consultation_mmap')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--noise', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--query-file', default='./benchmark_queries.npy')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args)
+        sys.exit(0)
+
+    np.save(args.query_file, sample_queries(args))
+    results = []
+    for backend in args.backends:
+        output = subprocess.run([sys.executable, __file__, '--worker', backend, *sys.argv[1:]],
+                                check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    os.remove(args.query_file)
+
+    print(f"{'backend':<10} {'open s':>8} {'cold start s':>13} {'p50 ms':>8} {'p95 ms':>8} {'max RSS MB':>11}")
+    for result in results:
+        print(f"{result['backend']:<10} {result['open_s']:>8.3f} {result['cold_start_s']:>13.3f} "
+              f"{result['p50_ms']:>8.3f} {result['p95_ms']:>8.3f} {result['max_rss_mb']:>11.1f}")
@@ -0,0 +1,142 @@
+"""Load test the dialog service: Flask (threaded, blocking invoke) against ASGI (uvicorn, ainvoke).
+
+Each server runs in its own process with dialog3's chat model replaced by the SleepingModel of
+benchmark_dialog_parallel.py, so every model call waits `--latency` seconds without costing an
+API call. `--conversations` clients then post `--turns` turns each to /api/ask at the same time.
+Reported per server: wall-clock time, throughput, turn latency and the server's peak thread count
+and resident memory.
+
+Both servers run the graph in the same mode (--parallel-nodes, DIALOG_PARALLEL_NODES), so the
+comparison isolates the serving model. Since the model calls only wait, throughput ends up about
+the same; what differs is the cost of holding turns in flight: threaded Flask needs a thread per
+request plus workers per parallel step, while the ASGI server waits on the event loop.
+
+    python src/evaluations/load_test_dialog.py --conversations 200 --turns 2 --latency 2
+"""
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+from evaluations.benchmark_dialog_parallel import TURNS, SleepingModel
+
+
+def serve(kind, port, latency):
+    """Server process: run dialog3 with the sleeping model behind Flask or uvicorn."""
+    from apps.dialog3 import get_graph
+    get_graph().model = SleepingModel(latency)
+    if kind == 'flask':
+        from apps.dialog3 import app
+        app.run(host='127.0.0.1', port=port, threaded=True)
+    else:
+        import uvicorn
+        from apps.dialog_asgi import app
+        uvicorn.run(app, host='127.0.0.1', port=port, log_level='warning', backlog=4096)
+
+
+def process_status(pid):
+    """Current thread count and peak resident memory (MB) of a process, read from /proc."""
+    status = {}
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            key, _, value = line.partition(':')
+            status[key] = value.split()
+    return int(status["Threads"][0]), int(status["VmHWM"][0]) / 1024
+
+
+def start_server(kind, port, latency, parallel_nodes, timeout=60):
+    # All consultations send the same turns, so the answer cache is off to keep every call a real wait
+    env = {**os.environ, "DIALOG_MAX_SESSIONS": "100000", "DIALOG_LLM_CACHE_SIZE": "0", "DIALOG_PARALLEL_NODES": parallel_nodes}
+    server = subprocess.Popen(
+        [sys.executable, os.path.realpath(__file__), '--serve', kind, '--port', str(port), '--latency', str(latency)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"http://127.0.0.1:{port}/api/sessions", timeout=1)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f"{kind} server did not start on port {port}")
+
+
+def conversation(url, turns):
+    """Post `turns` turns of one consultation; returns the latency of each turn."""
+    session = requests.Session()
+    conversation_id, timings = None, []
+    for doctor_text, patient_text in (TURNS * turns)[:turns]:
+        data = {"doctorMessage": doctor_text, "patientMessage": patient_text}
+        if conversation_id is not None:
+            data["conversationId"] = conversation_id
+        started = time.perf_counter()
+        response = session.post(f"{url}/api/ask", json=data, timeout=600)
+        timings.append(time.perf_counter() - started)
+        response.raise_for_status()
+        conversation_id = response.json()["conversationId"]
+    return timings
+
+
+def load_test(kind, args):
+    server = start_server(kind, args.port, args.latency, args.parallel_nodes)
+    peak = {"threads": 0, "rss": 0.0}
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            threads, rss = process_status(server.pid)
+            peak["threads"] = max(peak["threads"], threads)
+            peak["rss"] = max(peak["rss"], rss)
+            done.wait(0.1)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.conversations) as pool:
+            results = list(pool.map(lambda _: conversation(f"http://127.0.0.1:{args.port}", args.turns), range(args.conversations)))
+        elapsed = time.perf_counter() - started
+    finally:
+        done.set()
+        sampler.join()
+        server.terminate()
+        server.wait()
+    timings = np.concatenate(results)
+    return elapsed, len(timings) / elapsed, np.percentile(timings, 50), np.percentile(timings, 95), peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--conversations', type=int, default=100, help="Concurrent consultations")
+    parser.add_argument('--turns', type=int, default=2, help="Turns per consultation")
+    parser.add_argument('--latency', type=float, default=1.0, help="Seconds per simulated model call")
+    parser.add_argument('--parallel-nodes', choices=['0', '1'], default='1', help="DIALOG_PARALLEL_NODES of both servers")
+    parser.add_argument('--port', type=int, default=5101)
+    parser.add_argument('--serve', choices=['flask', 'asgi'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port, args.latency)
+        sys.exit(0)
+
+    print(f"{args.conversations} concurrent consultations x {args.turns} turns, {args.latency}s per model call, "
+          f"{'parallel' if args.parallel_nodes == '1' else 'serial'} nodes")
+    print(f"{'server':<8} {'total s':>8} {'turns/s':>8} {'p50 s':>8} {'p95 s':>8} {'threads':>8} {'rss MB':>8}")
+    results = {}
+    for kind in ('flask', 'asgi'):
+        elapsed, throughput, p50, p95, peak = load_test(kind, args)
+        results[kind] = (throughput, peak)
+        print(f"{kind:<8} {elapsed:>8.2f} {throughput:>8.2f} {p50:>8.2f} {p95:>8.2f} {peak['threads']:>8} {peak['rss']:>8.0f}")
+    (flask_throughput, flask_peak), (asgi_throughput, asgi_peak) = results['flask'], results['asgi']
+    print(f"ASGI vs Flask: {asgi_throughput / flask_throughput:.1f}x throughput, "
+          f"{asgi_peak['threads']} vs {flask_peak['threads']} peak threads, {asgi_peak['rss']:.0f} vs {flask_peak['rss']:.0f} MB peak RSS")
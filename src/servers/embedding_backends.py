@@ -0,0 +1,286 @@
+import os
+import sys
+import argparse
+import tempfile
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from utils.embedding_cache import EmbeddingCache
+
+# Local inference backends for all-MiniLM-L6-v2, selected with EMBEDDING_BACKEND:
+#   torch      - full-precision SentenceTransformer (the original path)
+#   torch-int8 - SentenceTransformer with Linear layers dynamically quantized to int8, CPU only
+#   onnx       - the same model exported to ONNX and run with onnxruntime
+#   onnx-int8  - the ONNX export with dynamically quantized int8 weights
+BACKENDS = ('torch', 'torch-int8', 'onnx', 'onnx-int8')
+# Where the local model and the caches live by default
+DEFAULT_MODEL_DIR = '/home/lou/Data/Liang_13060835/projects/llmops/servers/all-MiniLM-L6-v2'
+CACHE_HOME = os.getenv('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+# The ONNX exports are written here (EMBEDDING_ONNX_DIR), not into the model directory, which may be
+# a read-only Hugging Face snapshot
+DEFAULT_ONNX_DIR = os.path.join(CACHE_HOME, 'dr_ai', 'onnx')
+
+
+class ONNXEmbeddings:
+    """Mean-pooled, L2-normalized sentence embeddings from an ONNX export of a SentenceTransformer.
+
+    The export (model.onnx) and its int8 version (model.int8.onnx) are written to a directory per
+    model under onnx_dir on first use and reused afterwards.
+    """
+    def __init__(self, model_dir, quantize=False, intra_op_threads=0, inter_op_threads=0, batch_size=32, max_length=256, onnx_dir=None):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.batch_size = batch_size
+        self.max_length = max_length
+        model_path = export_onnx(model_dir, onnx_dir)
+        if quantize:
+            model_path = quantize_onnx(model_path)
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def embed_documents(self, texts):
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.append(self._embed(texts[start:start + self.batch_size]))
+        return np.concatenate(vectors).tolist() if vectors else []
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def _embed(self, texts):
+        encoded = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_length, return_tensors='np')
+        inputs = {name: value.astype(np.int64) for name, value in encoded.items() if name in self.input_names}
+        token_embeddings = self.session.run(None, inputs)[0]
+        mask = encoded['attention_mask'][..., None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+
+class TorchInt8Embeddings:
+    """SentenceTransformer on CPU with its Linear layers dynamically quantized to int8."""
+    def __init__(self, model_dir, intra_op_threads=0, inter_op_threads=0):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        set_torch_threads(intra_op_threads, inter_op_threads)
+        model = SentenceTransformer(model_dir, device='cpu')
+        self.model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    def embed_documents(self, texts):
+        return self.model.encode(list(texts), convert_to_numpy=True).tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def set_torch_threads(intra_op_threads=0, inter_op_threads=0):
+    import torch
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads:
+        # Only allowed before the first parallel op runs; ignore if torch is already warm
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            print(f"Could not set inter-op threads: {e}")
+
+
+def onnx_export_dir(model_dir, onnx_dir=None):
+    """Directory holding the ONNX exports of model_dir: a subdirectory of onnx_dir named after the model."""
+    onnx_dir = onnx_dir or os.getenv('EMBEDDING_ONNX_DIR') or DEFAULT_ONNX_DIR
+    return os.path.join(onnx_dir, os.path.basename(os.path.normpath(os.path.realpath(model_dir))))
+
+
+def export_onnx(model_dir, onnx_dir=None):
+    """Export the transformer of a SentenceTransformer directory to model.onnx (once)."""
+    export_dir = onnx_export_dir(model_dir, onnx_dir)
+    onnx_path = os.path.join(export_dir, 'model.onnx')
+    if os.path.exists(onnx_path):
+        return onnx_path
+    os.makedirs(export_dir, exist_ok=True)
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    model = AutoModel.from_pretrained(model_dir).eval()
+    sample = tokenizer(["export sample"], return_tensors='pt')
+    input_names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids') if name in sample]
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+    dynamic_axes['last_hidden_state'] = {0: 'batch', 1: 'sequence'}
+    # Export to a temporary file first so a crashed export never leaves a truncated model.onnx
+    descriptor, partial_path = tempfile.mkstemp(suffix='.onnx', dir=export_dir)
+    os.close(descriptor)
+    try:
+        with torch.no_grad():
+            torch.onnx.export(
+                model,
+                tuple(sample[name] for name in input_names),
+                partial_path,
+                input_names=input_names,
+                output_names=['last_hidden_state'],
+                dynamic_axes=dynamic_axes,
+                opset_version=14,
+            )
+        os.replace(partial_path, onnx_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    return onnx_path
+
+
+def quantize_onnx(onnx_path):
+    """Write a dynamically int8-quantized copy of an ONNX model next to it (once)."""
+    quantized_path = onnx_path.replace('.onnx', '.int8.onnx')
+    if not os.path.exists(quantized_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(onnx_path, quantized_path, weight_type=QuantType.QInt8)
+    return quantized_path
+
+
+def load_backend(backend, model_dir, intra_op_threads=0, inter_op_threads=0, onnx_dir=None):
+    """Build the embeddings object for a local backend name from BACKENDS."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{backend}', expected one of {BACKENDS}.")
+    try:
+        if backend == 'torch':
+            import torch
+            from langchain_community.embeddings import SentenceTransformerEmbeddings
+            set_torch_threads(intra_op_threads, inter_op_threads)
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+            return SentenceTransformerEmbeddings(model_name=model_dir, model_kwargs={'device': device})
+        if backend == 'torch-int8':
+            return TorchInt8Embeddings(model_dir, intra_op_threads, inter_op_threads)
+        return ONNXEmbeddings(model_dir, quantize=backend == 'onnx-int8', intra_op_threads=intra_op_threads,
+                              inter_op_threads=inter_op_threads, onnx_dir=onnx_dir)
+    except ImportError as e:
+        raise ImportError(f"Embedding backend '{backend}' needs the optional local-model packages; "
+                          f"install them with: pip install -r requirements-extras.txt ({e})") from e
+
+
+class EmbeddingModel:
+    def __init__(self, use_openai=False, openai_api_key=None, cache_db=None, cache_memory_items=10000, cache_disk_items=1000000,
+                 model_dir=DEFAULT_MODEL_DIR, offline=False, backend='torch', intra_op_threads=0, inter_op_threads=0):
+        self.use_openai = use_openai
+        # Heavy imports are deferred until a model is actually built
+        if self.use_openai:
+            import openai
+            from langchain_openai.embeddings import OpenAIEmbeddings
+            assert openai_api_key is not None, "OpenAI API key is required for OpenAI embeddings."
+            openai.api_key = openai_api_key
+            self.embeddings=OpenAIEmbeddings()
+            self.model_id = f"openai/{self.embeddings.model}"
+        else:
+            if offline:
+                # Load from the local copy only; never contact the hub
+                os.environ['HF_HUB_OFFLINE'] = '1'
+                if not os.path.isdir(model_dir):
+                    raise FileNotFoundError(f"EMBEDDING_OFFLINE is set but model directory '{model_dir}' does not exist.")
+                snapshot_location = model_dir
+            else:
+                from huggingface_hub import snapshot_download
+                snapshot_location = snapshot_download(repo_id="sentence-transformers/all-MiniLM-L6-v2", local_dir=model_dir)
+            self.embeddings = load_backend(backend, snapshot_location, intra_op_threads, inter_op_threads)
+            # Quantized backends give slightly different vectors, so they get their own cache entries
+            self.model_id = "sentence-transformers/all-MiniLM-L6-v2" + ("" if backend == 'torch' else f":{backend}")
+        self.cache = EmbeddingCache(self.model_id, db_path=cache_db, max_memory_items=cache_memory_items, max_disk_items=cache_disk_items)
+
+    def get_embedding(self, text):
+        cached = self.cache.get_many([text])[0]
+        if cached is not None:
+            return cached
+        # Return the vector as cached (float32) so hits and misses agree
+        return self.cache.put_many([text], [self.embeddings.embed_query(text)])[0]
+
+    # langchain Embeddings interface, so the model can be handed to a vector store directly
+    def embed_query(self, text):
+        return self.get_embedding(text)
+
+    def embed_documents(self, texts):
+        return self.get_embeddings(list(texts))
+
+    def get_embeddings(self, texts):
+        results = self.cache.get_many(texts)
+        # Only embed texts the cache doesn't know about, once each
+        missing = list(dict.fromkeys(text for text, result in zip(texts, results) if result is None))
+        if missing:
+            embeddings = self.cache.put_many(missing, self.embeddings.embed_documents(missing))
+            computed = dict(zip(missing, embeddings))
+            results = [result if result is not None else computed[text] for text, result in zip(texts, results)]
+        return results
+
+
+def embedding_model_from_env():
+    """EmbeddingModel configured by the EMBEDDING_* environment variables.
+
+    Importing this module has no side effects, so the retriever can build a model in-process
+    without the embedding server's threads. EMBEDDING_USE_OPENAI (default 1) and OPENAI_API_KEY
+    select OpenAI embeddings; otherwise the local MiniLM model runs on EMBEDDING_BACKEND with
+    EMBEDDING_INTRA_OP_THREADS / EMBEDDING_INTER_OP_THREADS (0 = library default), loaded from
+    EMBEDDING_MODEL_DIR, without a hub check when EMBEDDING_OFFLINE=1. The cache's disk tier is
+    EMBEDDING_CACHE_DB (default ~/.cache/dr_ai/embedding_cache.db, empty for memory only), sized by
+    EMBEDDING_CACHE_MEMORY_ITEMS and EMBEDDING_CACHE_DISK_ITEMS.
+    """
+    # PyTorch memory management
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'max_split_size_mb:128')
+    return EmbeddingModel(
+        use_openai=os.getenv('EMBEDDING_USE_OPENAI', '1') == '1',
+        openai_api_key=os.getenv('OPENAI_API_KEY'),
+        cache_db=os.getenv('EMBEDDING_CACHE_DB', os.path.join(CACHE_HOME, 'dr_ai', 'embedding_cache.db')),
+        cache_memory_items=int(os.getenv('EMBEDDING_CACHE_MEMORY_ITEMS', '10000')),
+        cache_disk_items=int(os.getenv('EMBEDDING_CACHE_DISK_ITEMS', '1000000')),
+        model_dir=os.getenv('EMBEDDING_MODEL_DIR', DEFAULT_MODEL_DIR),
+        offline=os.getenv('EMBEDDING_OFFLINE', '0') == '1',
+        backend=os.getenv('EMBEDDING_BACKEND', 'torch'),
+        intra_op_threads=int(os.getenv('EMBEDDING_INTRA_OP_THREADS', '0')),
+        inter_op_threads=int(os.getenv('EMBEDDING_INTER_OP_THREADS', '0')),
+    )
+
+
+def check_parity(reference, candidate, texts):
+    """Compare candidate embeddings against the fp32 reference on the same texts."""
+    expected = np.asarray(reference.embed_documents(texts), dtype=np.float32)
+    actual = np.asarray(candidate.embed_documents(texts), dtype=np.float32)
+    cosine = (expected * actual).sum(axis=1) / (
+        np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1))
+    return {
+        "texts": len(texts),
+        "min_cosine": float(cosine.min()),
+        "mean_cosine": float(cosine.mean()),
+        "max_abs_diff": float(np.abs(expected - actual).max()),
+    }
+
+
+if __name__ == "__main__":
+    # Parity check, e.g.:
+    # python src/servers/embedding_backends.py --model-dir ./all-MiniLM-L6-v2 --backend onnx-int8
+    parser = argparse.ArgumentParser(description="Check a quantized/ONNX backend against the fp32 torch embeddings.")
+    parser.add_argument('--model-dir', required=True)
+    parser.add_argument('--backend', choices=BACKENDS[1:], default='onnx-int8')
+    parser.add_argument('--texts', help="Text file with one sample per line (defaults to a few built-in phrases)")
+    parser.add_argument('--min-cosine', type=float, default=0.98)
+    parser.add_argument('--intra-op-threads', type=int, default=0)
+    parser.add_argument('--inter-op-threads', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.texts:
+        with open(args.texts) as file:
+            texts = [line.strip() for line in file if line.strip()]
+    else:
+        texts = [
+            "I have had a dry cough and a sore chest for three days.",
+            "Patient reports muscle pain and mild fever since the weekend.",
+            "Requesting a repeat script for my blood pressure medication.",
+            "No known allergies. Currently taking metformin 500mg twice daily.",
+        ]
+    reference = load_backend('torch', args.model_dir, args.intra_op_threads, args.inter_op_threads)
+    candidate = load_backend(args.backend, args.model_dir, args.intra_op_threads, args.inter_op_threads)
+    report = check_parity(reference, candidate, texts)
+    print(report)
+    sys.exit(0 if report["min_cosine"] >= args.min_cosine else 1)
@@ -1,39 +1,133 @@
 import os
-from flask import Flask, request, jsonify
-from langchain_community.embeddings import SentenceTransformerEmbeddings
-from huggingface_hub import snapshot_download
-import torch
-import openai
-from langchain_openai.embeddings import OpenAIEmbeddings
-__import__('pysqlite3')
+import queue
+import threading
+import time
+from concurrent.futures import Future
 import sys
+from flask import Flask, Response, request, jsonify
+# Ensure pysqlite3 is used for sqlite3, before anything below imports it
+__import__('pysqlite3')
 sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
-import sqlite3
-print(sqlite3.sqlite_version)
-# Set environment variable for PyTorch memory management
-os.environ['PYTORCH_CUDA_ALLOC_CONF'] = 'max_split_size_mb:128'
-openai_api_key = os.getenv('OPENAI_API_KEY')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from utils.embedding_codec import JSON_MIMETYPE, BINARY_MIMETYPES, DTYPE_HEADER, encode_embeddings
+from servers.embedding_backends import embedding_model_from_env
+# The model itself (OpenAI or a local backend, plus its cache) is configured by the EMBEDDING_*
+# variables read in servers/embedding_backends.py.
+use_openai = os.getenv('EMBEDDING_USE_OPENAI', '1') == '1'
+# Startup settings: the model is built when the server starts (python embedding_server.py, or the
+# first request under a WSGI server), never at import. With EMBEDDING_LAZY_START=1 the heavy imports
+# and the model load happen in a background warm-up thread instead. EMBEDDING_WARM_UP=1 runs one
+# text through the model before /ready reports ready; it defaults to on for local backends and off
+# for OpenAI, where it would be a billed request.
+lazy_start = os.getenv('EMBEDDING_LAZY_START', '0') == '1'
+warm_up_embed = os.getenv('EMBEDDING_WARM_UP', '0' if use_openai else '1') == '1'
+# Micro-batching settings: concurrent /get_embedding requests are merged into one forward pass
+max_batch_size = int(os.getenv('EMBEDDING_MAX_BATCH_SIZE', '32'))
+max_wait_ms = float(os.getenv('EMBEDDING_MAX_WAIT_MS', '5'))
+# Serve on a Unix domain socket instead of TCP port 8001 when set (for co-located retrievers)
+server_socket = os.getenv('EMBEDDING_SERVER_SOCKET')
 # Initialize Flask app
 app = Flask(__name__)
 
-class EmbeddingModel:
-    def __init__(self, use_openai=False, openai_api_key=None):
-        self.use_openai = use_openai
-        if self.use_openai:
-            assert openai_api_key is not None, "OpenAI API key is required for OpenAI embeddings."
-            openai.api_key = openai_api_key
-            self.embeddings=OpenAIEmbeddings()
-        else:
-            model_dir = '/home/lou/Data/Liang_13060835/projects/llmops/servers/all-MiniLM-L6-v2'
-            snapshot_location = snapshot_download(repo_id="sentence-transformers/all-MiniLM-L6-v2", local_dir=model_dir)
-            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-            self.embeddings = SentenceTransformerEmbeddings(model_name=snapshot_location, model_kwargs={'device': device})
-
-    def get_embedding(self, text):
-        return self.embeddings.embed_query(text)
-
-# Initialize the embedding model (set use_openai=True to use OpenAI embeddings)
-embedding_model = EmbeddingModel(use_openai=True, openai_api_key=openai_api_key)
+class MicroBatcher:
+    """Collects single-text requests from concurrent handlers and embeds them together.
+
+    A background thread takes the first pending text, then keeps collecting until either
+    max_batch_size texts are queued or max_wait_ms has passed, and runs one get_embeddings call.
+    """
+    def __init__(self, embed_fn, max_batch_size=32, max_wait_ms=5):
+        self.embed_fn = embed_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.pending = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def embed(self, text):
+        future = Future()
+        self.pending.put((text, future))
+        return future.result()
+
+    def _collect(self):
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [text for text, _ in batch]
+            try:
+                vectors = self.embed_fn(texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+# The embedding model is created once, by start() (default) or by the warm-up thread (lazy start)
+embedding_model = None
+model_lock = threading.Lock()
+ready = threading.Event()
+batcher = None
+started = False
+start_lock = threading.Lock()
+
+def get_embedding_model():
+    global embedding_model
+    if embedding_model is None:
+        with model_lock:
+            if embedding_model is None:
+                embedding_model = embedding_model_from_env()
+    return embedding_model
+
+def warm_up():
+    try:
+        began = time.monotonic()
+        model = get_embedding_model()
+        if warm_up_embed:
+            # Run one real batch through the backend (bypassing the cache) so the first request isn't slow
+            model.embeddings.embed_documents(["warm-up"])
+        ready.set()
+        print(f"Embedding model ready after {time.monotonic() - began:.2f}s")
+    except Exception as e:
+        print(f"Embedding model warm-up failed: {e}")
+
+def start():
+    """Start the micro-batcher and build (or, with lazy start, begin building) the model; runs once."""
+    global batcher, started
+    if started:
+        return
+    with start_lock:
+        if started:
+            return
+        batcher = MicroBatcher(lambda texts: get_embedding_model().get_embeddings(texts), max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+        if not lazy_start:
+            get_embedding_model()
+        threading.Thread(target=warm_up, daemon=True).start()
+        started = True
+
+@app.before_request
+def ensure_started():
+    # Under a WSGI server there is no __main__, so the first request starts the server
+    start()
+
+def embedding_response(vectors, key):
+    # Content negotiation: JSON unless the client asks for raw little-endian bytes or .npy
+    mimetype = request.accept_mimetypes.best_match([JSON_MIMETYPE, *BINARY_MIMETYPES], default=JSON_MIMETYPE)
+    if mimetype == JSON_MIMETYPE:
+        return jsonify({key: vectors})
+    body, headers = encode_embeddings(vectors, mimetype, dtype=request.headers.get(DTYPE_HEADER, 'float32'))
+    return Response(body, mimetype=mimetype, headers=headers)
 
 @app.route('/get_embedding', methods=['POST'])
 def get_embedding():
@@ -42,18 +136,62 @@ def get_embedding():
         data = request.get_json()
         text = data['text']
 
-        # Generate the embedding
-        query_result = embedding_model.get_embedding(text)
-        # Return the embedding as a JSON response
-        return jsonify({"embedding": query_result})
+        # Generate the embedding (merged with other in-flight requests by the batcher)
+        query_result = batcher.embed(text)
+        # Return the embedding as JSON or in the binary format the client asked for
+        return embedding_response(query_result, "embedding")
     
     except Exception as e:
         # Handle any errors that occur during the process
         return jsonify({"error": str(e)})
 
+@app.route('/get_embeddings', methods=['POST'])
+def get_embeddings():
+    try:
+        # Get the list of texts from the request
+        data = request.get_json()
+        texts = data['texts']
+        if not isinstance(texts, list):
+            return jsonify({"error": "'texts' must be a list of strings."}), 400
+
+        # Embed the whole list in one forward pass
+        query_results = get_embedding_model().get_embeddings(texts) if texts else []
+        return embedding_response(query_results, "embeddings")
+
+    except Exception as e:
+        # Handle any errors that occur during the process
+        return jsonify({"error": str(e)})
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    # Hit/miss counters for sizing the embedding cache
+    return jsonify(get_embedding_model().cache.stats())
+
+@app.route('/health', methods=['GET'])
+def health():
+    # Liveness: the process is up and serving HTTP
+    return jsonify({"status": "ok"})
+
+@app.route('/ready', methods=['GET'])
+def readiness():
+    # Readiness: flips once the model has served the warm-up batch
+    if ready.is_set():
+        return jsonify({"ready": True})
+    return jsonify({"ready": False}), 503
+
 if __name__ == "__main__":
+    start()
     # Run the Flask app
-    app.run(host='0.0.0.0', port=8001)
+    if server_socket:
+        if os.path.exists(server_socket):
+            os.remove(server_socket)
+        app.run(host=f"unix://{server_socket}")
+    else:
+        app.run(host='0.0.0.0', port=8001)
 
 
-# curl -X POST http://localhost:8001/get_embedding -H "Content-Type: application/json" -d '{"text": "Your sample text here"}'
\ No newline at end of file
+# curl -X POST http://localhost:8001/get_embedding -H "Content-Type: application/json" -d '{"text": "Your sample text here"}'
+# curl -X POST http://localhost:8001/get_embedding -H "Content-Type: application/json" -H "Accept: application/octet-stream" -H "X-Embedding-Dtype: float16" -d '{"text": "Your sample text here"}' -o embedding.bin
+# curl http://localhost:8001/cache_stats
+# curl http://localhost:8001/ready
+# curl -X POST http://localhost:8001/get_embeddings -H "Content-Type: application/json" -d '{"texts": ["first text", "second text"]}'
\ No newline at end of file
@@ -1,50 +1,254 @@
 import os
 import sys
+import threading
 import requests
 from flask import Flask, request, jsonify
 from langchain_community.vectorstores import Chroma
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+import numpy as np
 sys.path.insert(0, 'src')
-from utils.APIs import APIEmbedding
+from utils.APIs import APIEmbedding, unix_socket_url
+from utils.query_cache import CollectionVersion, QueryCache
+from utils.bm25 import BM25Index, reciprocal_rank_fusion
 # Ensure pysqlite3 is used for sqlite3
 __import__('pysqlite3')
 sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
-embedding_model=APIEmbedding("http://localhost:8001/get_embedding")
-# Initialize the Chroma vector store
-vector_store = Chroma(
-    collection_name="conDB",
-    embedding_function=embedding_model,
-    persist_directory="./consultation_db"
-)
+# How queries get embedded (RETRIEVER_EMBEDDING_MODE):
+#   http      - POST to the embedding server at EMBEDDING_SERVER_URL (default)
+#   uds       - POST to an embedding server listening on the Unix socket EMBEDDING_SERVER_SOCKET
+#   inprocess - host the EmbeddingModel inside this process (configured by the EMBEDDING_* variables)
+embedding_mode = os.getenv('RETRIEVER_EMBEDDING_MODE', 'http')
+# Wire format of embedding server responses (RETRIEVER_EMBEDDING_FORMAT): float32, float16, npy or json
+embedding_format = os.getenv('RETRIEVER_EMBEDDING_FORMAT', 'float32')
+if embedding_mode == 'http':
+    embedding_model=APIEmbedding(os.getenv('EMBEDDING_SERVER_URL', "http://localhost:8001/get_embedding"), response_format=embedding_format)
+elif embedding_mode == 'uds':
+    embedding_model=APIEmbedding(unix_socket_url(os.getenv('EMBEDDING_SERVER_SOCKET', '/tmp/embedding_server.sock'), '/get_embedding'),
+                                 response_format=embedding_format)
+elif embedding_mode == 'inprocess':
+    from servers.embedding_backends import embedding_model_from_env
+    embedding_model=embedding_model_from_env()
+else:
+    raise ValueError(f"Unknown RETRIEVER_EMBEDDING_MODE '{embedding_mode}', expected http, uds or inprocess.")
+# Vector store backend (RETRIEVER_BACKEND):
+#   chroma - the Chroma collection persisted in ./consultation_db (default)
+#   mmap   - a memory-mapped export of it (see utils/mmap_store.py) in RETRIEVER_MMAP_DIR,
+#            shared through the page cache by every worker process that opens it, and reopened
+#            when a re-export bumps the collection version
+collection_name = "conDB"
+retriever_backend = os.getenv('RETRIEVER_BACKEND', 'chroma')
+if retriever_backend == 'chroma':
+    # Initialize the Chroma vector store
+    persist_directory = "./consultation_db"
+    vector_store = Chroma(
+        collection_name=collection_name,
+        embedding_function=embedding_model,
+        persist_directory=persist_directory
+    )
+    collection = vector_store._collection
+    relevance_score_fn = vector_store._select_relevance_score_fn()
+elif retriever_backend == 'mmap':
+    from utils.mmap_store import MmapVectorStore
+    persist_directory = os.getenv('RETRIEVER_MMAP_DIR', "./consultation_mmap")
+    collection = MmapVectorStore(persist_directory)
+    relevance_score_fn = collection.relevance_score_fn
+else:
+    raise ValueError(f"Unknown RETRIEVER_BACKEND '{retriever_backend}', expected chroma or mmap.")
+# Query result cache; ingestion bumps the collection version file, which invalidates it
+collection_version = CollectionVersion(os.path.join(persist_directory, f"{collection_name}.version"))
+query_cache = QueryCache(max_items=int(os.getenv('RETRIEVER_CACHE_SIZE', '1024')),
+                         ttl_seconds=float(os.getenv('RETRIEVER_CACHE_TTL', '300')))
+# Version of the collection the open mmap store belongs to
+collection_opened_version = collection_version.current()
+collection_lock = threading.Lock()
+# Lexical (BM25) index over the same chunks, built on first use and rebuilt when the collection version changes
+lexical_index = None
+lexical_version = None
+lexical_lock = threading.Lock()
 # Initialize Flask app
 app = Flask(__name__)
 
+def build_where(data):
+    """Combine the raw Chroma `where` filter with the `source` shortcut of a query request.
+
+    Ingested chunks carry `source` (the transcript file) and `content_hash` metadata; any other
+    condition goes into `where` in Chroma's syntax, e.g. {"source": {"$in": ["a.txt", "b.txt"]}}.
+    """
+    clauses = []
+    if data.get('where'):
+        clauses.append(data['where'])
+    if data.get('source'):
+        clauses.append({"source": data['source']})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+def parse_query_options(data):
+    k = int(data.get('k', 3))
+    mode = data.get('mode', 'vector')
+    if mode not in ('vector', 'lexical', 'hybrid'):
+        raise ValueError(f"Unknown mode '{mode}', expected vector, lexical or hybrid.")
+    if data.get('min_similarity') is not None and mode != 'vector':
+        # BM25 and fused scores are not similarities, so a cut-off on them would mean something else
+        raise ValueError("min_similarity is only supported in vector mode.")
+    return {
+        "k": k,
+        "mode": mode,
+        # In hybrid mode each side contributes its own candidate list to the fusion
+        "vector_k": int(data.get('vector_k', k)),
+        "lexical_k": int(data.get('lexical_k', max(10, 2 * k))),
+        "where": build_where(data),
+        "min_similarity": float(data['min_similarity']) if data.get('min_similarity') is not None else None,
+        "mmr": bool(data.get('mmr', False)),
+        "fetch_k": int(data.get('fetch_k', max(20, 4 * k))),
+        "lambda_mult": float(data.get('lambda_mult', 0.5)),
+    }
+
+# What the returned scores are in each mode: vector distances (lower is closer), BM25 scores or
+# reciprocal-rank-fusion scores (higher is better for both)
+SCORE_TYPES = {"vector": "distance", "lexical": "bm25", "hybrid": "rrf"}
+
+def search_by_vectors(query_embeddings, options):
+    """Run one filtered nearest-neighbour query for all embeddings; returns [(contexts, scores), ...]."""
+    n_results = options["fetch_k"] if options["mmr"] else options["k"]
+    include = ["documents", "distances"] + (["embeddings"] if options["mmr"] else [])
+    results = collection.query(
+        query_embeddings=query_embeddings,
+        n_results=n_results,
+        where=options["where"],
+        include=include,
+    )
+    outputs = []
+    for i, query_embedding in enumerate(query_embeddings):
+        docs = results["documents"][i]
+        scores = results["distances"][i]
+        if options["mmr"] and docs:
+            # Diversify the fetch_k candidates, keeping their distances as scores
+            selected = maximal_marginal_relevance(
+                np.array(query_embedding, dtype=np.float32),
+                results["embeddings"][i],
+                k=options["k"],
+                lambda_mult=options["lambda_mult"],
+            )
+            docs = [docs[j] for j in selected]
+            scores = [scores[j] for j in selected]
+        if options["min_similarity"] is not None:
+            kept = [(doc, score) for doc, score in zip(docs, scores) if relevance_score_fn(score) >= options["min_similarity"]]
+            docs = [doc for doc, _ in kept]
+            scores = [score for _, score in kept]
+        outputs.append((docs, scores))
+    return outputs
+
+def reopen_collection(version):
+    """Switch to the latest mmap export once its version shows up; Chroma sees writes directly."""
+    global collection, collection_opened_version
+    if retriever_backend != 'mmap' or version == collection_opened_version:
+        return
+    with collection_lock:
+        if version != collection_opened_version:
+            collection = MmapVectorStore(persist_directory)
+            collection_opened_version = version
+
+def get_lexical_index(version):
+    global lexical_index, lexical_version
+    with lexical_lock:
+        if lexical_index is None or lexical_version != version:
+            contents = collection.get(include=["documents", "metadatas"])
+            lexical_index = BM25Index(contents["documents"], contents["metadatas"])
+            lexical_version = version
+        return lexical_index
+
+def search_lexical(index, query_text, options):
+    """BM25 search over the collection's chunks; needs no embedding call."""
+    limit = options["lexical_k"] if options["mode"] == "hybrid" else options["k"]
+    hits = index.search(query_text, k=limit, where=options["where"])
+    return [index.documents[position] for position, _ in hits], [score for _, score in hits]
+
+def fuse_results(vector_result, lexical_result, k):
+    # Reciprocal rank fusion; chunks are matched by their text
+    fused = reciprocal_rank_fusion([vector_result[0], lexical_result[0]])[:k]
+    return [doc for doc, _ in fused], [score for _, score in fused]
+
+def cached_search(query_texts, options):
+    """Answer each query from the cache where possible; embed and search only the misses."""
+    version = collection_version.current()
+    reopen_collection(version)
+    keys = [query_cache.make_key(text, options) for text in query_texts]
+    results = [query_cache.get(key, version) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        texts = [query_texts[i] for i in missing]
+        mode = options["mode"]
+        if mode != "lexical":
+            if len(texts) == 1:
+                query_embeddings = [embedding_model.embed_query(texts[0])]
+            else:
+                # Embed every query in one batch, then run a single nearest-neighbour search for all of them
+                query_embeddings = embedding_model.embed_documents(texts)
+            vector_results = search_by_vectors(query_embeddings, {**options, "k": options["vector_k"]} if mode == "hybrid" else options)
+        if mode != "vector":
+            index = get_lexical_index(version)
+            lexical_results = [search_lexical(index, text, options) for text in texts]
+        for j, i in enumerate(missing):
+            if mode == "vector":
+                result = vector_results[j]
+            elif mode == "lexical":
+                result = lexical_results[j]
+            else:
+                result = fuse_results(vector_results[j], lexical_results[j], options["k"])
+            results[i] = result
+            query_cache.put(keys[i], version, result)
+    return results
+
 @app.route('/query', methods=['POST'])
 def query_vector_store():
     try:
         # Get the input data from the request
         data = request.get_json()
         query_text = data['text']
-        # Retrieve nearest neighbors from the vector store
-        results = vector_store.similarity_search_with_score(query_text, k=3)
-        scores=[]
-        docs=[]
-        for doc, score in results:
-            page_content = doc.page_content
-            docs.append(page_content)
-            scores.append(score)
-
-        ouputs={"contexts":docs,"scores":scores}
-        # Prepare the results to return
-        # retrieved_texts = [result.page_content for result in results]
+        options = parse_query_options(data)
+        # Retrieve nearest neighbors from the vector store (or the cache), filtered inside the vector store
+        docs, scores = cached_search([query_text], options)[0]
+
+        ouputs={"contexts":docs,"scores":scores,"score_type":SCORE_TYPES[options["mode"]]}
         return jsonify(ouputs)
     
     except Exception as e:
         # Handle any errors that occur during the process
         return jsonify({"error": str(e)})
 
+@app.route('/query_batch', methods=['POST'])
+def query_vector_store_batch():
+    try:
+        # Get the list of queries from the request
+        data = request.get_json()
+        query_texts = data['texts']
+        options = parse_query_options(data)
+        if not isinstance(query_texts, list):
+            return jsonify({"error": "'texts' must be a list of strings."}), 400
+        if not query_texts:
+            return jsonify({"results": [], "score_type": SCORE_TYPES[options["mode"]]})
+
+        outputs = [
+            {"contexts": docs, "scores": scores}
+            for docs, scores in cached_search(query_texts, options)
+        ]
+        return jsonify({"results": outputs, "score_type": SCORE_TYPES[options["mode"]]})
+
+    except Exception as e:
+        # Handle any errors that occur during the process
+        return jsonify({"error": str(e)})
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify(query_cache.stats())
+
 if __name__ == "__main__":
     # Run the Flask app
     app.run(host='0.0.0.0', port=8002)
 
 # Example curl command to test the API:
 # curl -X POST http://localhost:8002/query -H 'Content-Type: application/json' -d '{"text":"This is a query text."}'
+# curl -X POST http://localhost:8002/query -H 'Content-Type: application/json' -d '{"text":"persistent cough", "k": 5, "where": {"source": {"$in": ["a.txt", "b.txt"]}}, "min_similarity": 0.3, "mmr": true}'
+# curl -X POST http://localhost:8002/query -H 'Content-Type: application/json' -d '{"text":"SNOMED 6142004", "mode": "hybrid", "k": 3, "vector_k": 2}'
+# curl -X POST http://localhost:8002/query_batch -H 'Content-Type: application/json' -d '{"texts":["first query", "second query"], "k": 3}'
@@ -1,29 +1,152 @@
 import os
 import sys
+import socket
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+import numpy as np
 from flask import Flask, request, jsonify
 from langchain_community.vectorstores import Chroma
+from utils.embedding_codec import RAW_MIMETYPE, NPY_MIMETYPE, BINARY_MIMETYPES, DTYPE_HEADER, decode_embeddings
 # Ensure pysqlite3 is used for sqlite3
 __import__('pysqlite3')
 sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
 
+# HTTP over a Unix domain socket, for co-located servers.
+# URLs look like http+unix://%2Ftmp%2Fembedding_server.sock/get_embedding (socket path percent-encoded).
+class UnixHTTPConnection(HTTPConnection):
+    def __init__(self, socket_path, *args, **kwargs):
+        super().__init__('localhost', *args, **kwargs)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+class UnixHTTPConnectionPool(HTTPConnectionPool):
+    def __init__(self, socket_path, **kwargs):
+        super().__init__('localhost', **kwargs)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        return UnixHTTPConnection(self.socket_path, timeout=self.timeout.connect_timeout)
+
+class UnixSocketAdapter(HTTPAdapter):
+    def __init__(self, pool_maxsize=10, **kwargs):
+        self.unix_pool_maxsize = pool_maxsize
+        self.unix_pools = {}
+        super().__init__(pool_maxsize=pool_maxsize, **kwargs)
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.get_connection(request.url, proxies)
+
+    def get_connection(self, url, proxies=None):
+        socket_path = unquote(urlparse(url).netloc)
+        if socket_path not in self.unix_pools:
+            self.unix_pools[socket_path] = UnixHTTPConnectionPool(socket_path, maxsize=self.unix_pool_maxsize)
+        return self.unix_pools[socket_path]
+
+    def request_url(self, request, proxies):
+        return request.path_url
+
+    def close(self):
+        for pool in self.unix_pools.values():
+            pool.close()
+        self.unix_pools.clear()
+        super().close()
+
+def unix_socket_url(socket_path, route):
+    return f"http+unix://{socket_path.replace('/', '%2F')}{route}"
+
 # Custom APIEmbedding class
 class APIEmbedding:
-    def __init__(self, api_url):
+    """Embedding client for embedding_server.py.
+
+    embed_documents sends texts in chunks of batch_size to the batch endpoint
+    (by default the /get_embeddings route next to api_url), with at most max_workers
+    requests in flight. All requests share one keep-alive connection pool of pool_maxsize
+    connections (default max_workers); callers that run embed_documents from several threads
+    size it for all of them. Set batch_size=1 to fall back to one /get_embedding request per text.
+
+    response_format picks the wire format: 'json', or the binary 'float32', 'float16' and
+    'npy' formats, which are decoded into NumPy arrays without copying. Embeddings are
+    returned as lists unless return_numpy=True.
+    """
+    def __init__(self, api_url, batch_api_url=None, batch_size=64, max_workers=4, response_format='json', return_numpy=False,
+                 pool_maxsize=None):
         self.api_url = api_url
+        if batch_api_url is None and api_url.rstrip('/').endswith('/get_embedding'):
+            batch_api_url = api_url.rstrip('/') + 's'
+        self.batch_api_url = batch_api_url
+        self.batch_size = max(1, batch_size)
+        self.max_workers = max(1, max_workers)
+        self.return_numpy = return_numpy
+        self.headers = {"Content-Type": "application/json"}
+        if response_format in ('float32', 'float16'):
+            self.headers.update({"Accept": RAW_MIMETYPE, DTYPE_HEADER: response_format})
+        elif response_format == 'npy':
+            self.headers["Accept"] = NPY_MIMETYPE
+        elif response_format != 'json':
+            raise ValueError(f"Unsupported response_format '{response_format}'.")
+        # Pooled keep-alive session, sized so every worker can hold its own connection
+        pool_maxsize = max(1, pool_maxsize or self.max_workers)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.mount('http+unix://', UnixSocketAdapter(pool_maxsize=pool_maxsize))
 
     def embed_query(self, text):
-        return self._get_embedding(text)
+        embedding = self._get_embedding(text)
+        return np.asarray(embedding) if self.return_numpy else self._to_list(embedding)
 
     def embed_documents(self, texts):
-        return [self._get_embedding(text) for text in texts]
+        texts = list(texts)
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32) if self.return_numpy else []
+        if self.batch_api_url is None or self.batch_size == 1:
+            results = [[self._get_embedding(text)] for text in texts]
+        else:
+            chunks = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+            # map() keeps the chunk order, so the output lines up with the input texts
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(chunks))) as executor:
+                results = list(executor.map(self._get_embeddings, chunks))
+        if self.return_numpy:
+            return np.concatenate([np.asarray(chunk) for chunk in results])
+        return [embedding for chunk in results for embedding in self._to_list(chunk)]
+
+    @staticmethod
+    def _to_list(embeddings):
+        # A decoded binary batch is one ndarray; single-text requests give a list of 1-D arrays
+        if isinstance(embeddings, np.ndarray):
+            return embeddings.tolist()
+        return [embedding.tolist() if isinstance(embedding, np.ndarray) else embedding for embedding in embeddings]
+
+    def _decode(self, response, key):
+        mimetype = response.headers.get("Content-Type", "").split(";")[0].strip()
+        if mimetype in BINARY_MIMETYPES:
+            return decode_embeddings(response.content, mimetype, response.headers)
+        return response.json()[key]
 
     def _get_embedding(self, text):
-        headers = {"Content-Type": "application/json"}
         data = {"text": text}
-        response = requests.post(self.api_url, json=data, headers=headers)
+        response = self.session.post(self.api_url, json=data, headers=self.headers)
+        if response.status_code == 200:
+            return self._decode(response, "embedding")
+        else:
+            raise Exception(f"Error: {response.status_code}, {response.text}")
+
+    def _get_embeddings(self, texts):
+        data = {"texts": texts}
+        response = self.session.post(self.batch_api_url, json=data, headers=self.headers)
         if response.status_code == 200:
-            return response.json()["embedding"]
+            return self._decode(response, "embeddings")
         else:
             raise Exception(f"Error: {response.status_code}, {response.text}")
         
@@ -0,0 +1,103 @@
+import heapq
+import math
+import re
+from collections import Counter, defaultdict
+
+# Word characters only, lower-cased: keeps drug names and SNOMED codes such as 6142004 intact
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def matches_where(metadata, where):
+    """Evaluate a Chroma-style `where` filter against one metadata dict."""
+    if not where:
+        return True
+    for key, condition in where.items():
+        if key == '$and':
+            if not all(matches_where(metadata, clause) for clause in condition):
+                return False
+        elif key == '$or':
+            if not any(matches_where(metadata, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for operator, operand in condition.items():
+                if not _compare(value, operator, operand):
+                    return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+
+def _compare(value, operator, operand):
+    if operator == '$eq':
+        return value == operand
+    if operator == '$ne':
+        return value != operand
+    if operator == '$in':
+        return value in operand
+    if operator == '$nin':
+        return value not in operand
+    if value is None:
+        return False
+    if operator == '$gt':
+        return value > operand
+    if operator == '$gte':
+        return value >= operand
+    if operator == '$lt':
+        return value < operand
+    if operator == '$lte':
+        return value <= operand
+    raise ValueError(f"Unsupported where operator '{operator}'.")
+
+
+class BM25Index:
+    """Okapi BM25 over an in-memory inverted index.
+
+    documents and metadatas are parallel lists; search() returns (position, score) pairs,
+    best first, where position indexes into documents.
+    """
+    def __init__(self, documents, metadatas=None, k1=1.5, b=0.75):
+        self.documents = list(documents)
+        self.metadatas = list(metadatas) if metadatas is not None else [{}] * len(self.documents)
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(list)
+        self.doc_lengths = []
+        for position, document in enumerate(self.documents):
+            terms = Counter(tokenize(document))
+            self.doc_lengths.append(sum(terms.values()))
+            for term, frequency in terms.items():
+                self.postings[term].append((position, frequency))
+        self.avg_doc_length = (sum(self.doc_lengths) / len(self.doc_lengths)) if self.doc_lengths else 0.0
+        count = len(self.documents)
+        self.idf = {
+            term: math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self.postings.items()
+        }
+
+    def search(self, query, k=10, where=None):
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for position, frequency in self.postings[term]:
+                length_norm = 1 - self.b + self.b * self.doc_lengths[position] / self.avg_doc_length
+                scores[position] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+        if where:
+            scores = {position: score for position, score in scores.items()
+                      if matches_where(self.metadatas[position] or {}, where)}
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Fuse several best-first rankings of keys; returns [(key, fused score), ...], best first."""
+    fused = defaultdict(float)
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            fused[key] += 1.0 / (k + rank + 1)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
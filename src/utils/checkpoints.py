@@ -0,0 +1,135 @@
+import asyncio
+import os
+import sqlite3
+
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+
+class PruningSqliteSaver(SqliteSaver):
+    """SqliteSaver that keeps only the newest keep_last checkpoints of each thread.
+
+    LangGraph writes a checkpoint after every step, so a long consultation accumulates hundreds
+    of them while only the latest is needed to resume. Older checkpoints and their pending
+    writes are deleted as new ones arrive. Checkpoint ids are time-ordered (uuid6), which is the
+    ordering SqliteSaver itself relies on for "latest".
+    """
+    def __init__(self, conn, keep_last=20):
+        super().__init__(conn)
+        if keep_last < 1:
+            raise ValueError("keep_last must be at least 1.")
+        self.keep_last = keep_last
+        self.path = None
+
+    @classmethod
+    def open(cls, path, keep_last=20):
+        """Saver on the SQLite file at path, or on a private in-memory database for ':memory:'."""
+        # One connection shared by all request threads; SqliteSaver.cursor() serializes access
+        if path == ':memory:':
+            conn = sqlite3.connect(path, check_same_thread=False)
+        else:
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        saver = cls(conn, keep_last=keep_last)
+        saver.path = path
+        saver.setup()
+        return saver
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        saved_config = super().put(config, checkpoint, metadata, new_versions)
+        self.prune(saved_config["configurable"]["thread_id"], saved_config["configurable"]["checkpoint_ns"])
+        return saved_config
+
+    # SqliteSaver has no async methods; the queries are local and short, so the async graph API
+    # (used by dialog_asgi.py) runs them in a worker thread
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        checkpoints = await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for checkpoint in checkpoints:
+            yield checkpoint
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id):
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id)
+
+    def prune(self, thread_id, checkpoint_ns=''):
+        with self.cursor() as cur:
+            cur.execute(
+                "SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+                "ORDER BY checkpoint_id DESC LIMIT 1 OFFSET ?",
+                (str(thread_id), checkpoint_ns, self.keep_last - 1),
+            )
+            row = cur.fetchone()
+            if row is None:
+                return 0
+            older = (str(thread_id), checkpoint_ns, row[0])
+            cur.execute("DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id < ?", older)
+            cur.execute("DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id < ?", older)
+            return cur.rowcount
+
+    def delete_thread(self, thread_id):
+        with self.cursor() as cur:
+            for table in ("checkpoints", "writes"):
+                cur.execute(f"DELETE FROM {table} WHERE thread_id = ?", (str(thread_id),))
+
+    def has_thread(self, thread_id):
+        with self.cursor(transaction=False) as cur:
+            cur.execute("SELECT 1 FROM checkpoints WHERE thread_id = ? LIMIT 1", (str(thread_id),))
+            return cur.fetchone() is not None
+
+    @property
+    def durable(self):
+        return self.path is not None and self.path != ':memory:'
+
+    def stats(self):
+        with self.cursor(transaction=False) as cur:
+            cur.execute("SELECT COUNT(*), COUNT(DISTINCT thread_id) FROM checkpoints")
+            checkpoints, threads = cur.fetchone()
+            cur.execute("SELECT COUNT(*) FROM writes")
+            writes = cur.fetchone()[0]
+        sizes = {}
+        for suffix in ("", "-wal"):
+            try:
+                sizes[suffix] = os.path.getsize(f"{self.path}{suffix}") if self.durable else 0
+            except FileNotFoundError:
+                sizes[suffix] = 0
+        return {
+            "path": self.path,
+            "keep_last": self.keep_last,
+            "threads": threads,
+            "checkpoints": checkpoints,
+            "writes": writes,
+            "db_bytes": sizes[""],
+            "wal_bytes": sizes["-wal"],
+        }
+
+
+def delete_thread(saver, thread_id):
+    """Drop every checkpoint of thread_id from a PruningSqliteSaver or a MemorySaver."""
+    if hasattr(saver, "delete_thread"):
+        saver.delete_thread(thread_id)
+        return
+    # MemorySaver keeps checkpoints in storage[thread_id] and writes under (thread_id, ns, checkpoint_id)
+    thread_id = str(thread_id)
+    saver.storage.pop(thread_id, None)
+    for key in [key for key in saver.writes if key[0] == thread_id]:
+        saver.writes.pop(key, None)
+
+
+def open_checkpointer(path=None, keep_last=None, default=None):
+    """Checkpointer configured by DIALOG_CHECKPOINT_DB / DIALOG_CHECKPOINT_KEEP.
+
+    Without DIALOG_CHECKPOINT_DB it is opened on default (e.g. ':memory:' for a pruned in-memory
+    saver), or None is returned when there is no default.
+    """
+    path = path if path is not None else os.getenv('DIALOG_CHECKPOINT_DB', '') or default
+    if not path:
+        return None
+    keep_last = keep_last if keep_last is not None else int(os.getenv('DIALOG_CHECKPOINT_KEEP', '20'))
+    return PruningSqliteSaver.open(path, keep_last=keep_last)
@@ -0,0 +1,198 @@
+import hashlib
+import os
+import re
+import sqlite3
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from threading import Lock
+
+
+def normalize_text(text):
+    """Normalize text before hashing so trivial whitespace/unicode differences share an entry."""
+    text = unicodedata.normalize('NFC', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def text_hash(text):
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """Two-tier embedding cache keyed by (model id, normalized text hash).
+
+    The memory tier is an LRU of up to max_memory_items vectors. The optional disk tier is
+    a SQLite table at db_path holding up to max_disk_items vectors; when it grows past that,
+    the least recently used rows are deleted. Vectors are stored as float32, and put_many
+    returns them rounded the same way so a text gets the same vector whether it was cached or not.
+    Disk hits do not update last_access right away: the access times are collected and written
+    with the next put_many, or once access_flush_items of them are pending or access_flush_seconds
+    have passed, so reads stay out of write transactions.
+    """
+    def __init__(self, model_id, db_path=None, max_memory_items=10000, max_disk_items=1000000,
+                 access_flush_items=1000, access_flush_seconds=60.0):
+        self.model_id = model_id
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self.access_flush_items = access_flush_items
+        self.access_flush_seconds = access_flush_seconds
+        self.memory = OrderedDict()
+        self.lock = Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+        # text_hash -> last access time of disk rows read since the last flush
+        self.accessed = {}
+        self.accessed_since = time.monotonic()
+
+        self.db = None
+        if db_path:
+            directory = os.path.dirname(os.path.abspath(db_path))
+            os.makedirs(directory, exist_ok=True)
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model_id TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    last_access REAL NOT NULL,
+                    PRIMARY KEY (model_id, text_hash)
+                ) WITHOUT ROWID
+            """)
+            self.db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)")
+            self.db.commit()
+            self.disk_items = self.db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get_many(self, texts):
+        """Return a list aligned with texts holding the cached vector or None for misses."""
+        keys = [text_hash(text) for text in texts]
+        results = [None] * len(texts)
+        missing = {}
+        with self.lock:
+            for i, key in enumerate(keys):
+                vector = self.memory.get(key)
+                if vector is not None:
+                    self.memory.move_to_end(key)
+                    self.memory_hits += 1
+                    results[i] = vector.tolist()
+                else:
+                    missing.setdefault(key, []).append(i)
+
+            if missing and self.db is not None:
+                found = self._read_disk(list(missing))
+                for key, vector in found.items():
+                    self._remember(key, vector)
+                    for i in missing.pop(key):
+                        self.disk_hits += 1
+                        results[i] = vector.tolist()
+
+            self.misses += sum(len(indexes) for indexes in missing.values())
+        return results
+
+    def put_many(self, texts, vectors):
+        """Cache vectors for texts; returns them as stored (float32) lists."""
+        rows = []
+        stored = []
+        now = time.time()
+        with self.lock:
+            for text, vector in zip(texts, vectors):
+                key = text_hash(text)
+                packed = array('f', vector)
+                self._remember(key, packed)
+                rows.append((self.model_id, key, packed.tobytes(), now))
+                stored.append(packed.tolist())
+            if rows and self.db is not None:
+                self._write_disk(rows)
+        return stored
+
+    def flush(self):
+        """Write pending last_access updates of disk hits."""
+        if self.db is None:
+            return
+        with self.lock:
+            self._flush_access()
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "model_id": self.model_id,
+                "memory_items": len(self.memory),
+                "max_memory_items": self.max_memory_items,
+                "disk_items": self.disk_items if self.db is not None else None,
+                "max_disk_items": self.max_disk_items if self.db is not None else None,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_evictions": self.memory_evictions,
+                "disk_evictions": self.disk_evictions,
+                "evictions": self.memory_evictions + self.disk_evictions,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+    def _remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+            self.memory_evictions += 1
+
+    def _read_disk(self, keys):
+        found = {}
+        # Stay below SQLite's bound-parameter limit
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.db.execute(
+                f"SELECT text_hash, vector FROM embeddings WHERE model_id = ? AND text_hash IN ({placeholders})",
+                [self.model_id, *chunk],
+            ).fetchall()
+            for key, blob in rows:
+                vector = array('f')
+                vector.frombytes(blob)
+                found[key] = vector
+        if found:
+            now = time.time()
+            for key in found:
+                self.accessed[key] = now
+            if (len(self.accessed) >= self.access_flush_items
+                    or time.monotonic() - self.accessed_since >= self.access_flush_seconds):
+                self._flush_access()
+                self.db.commit()
+        return found
+
+    def _flush_access(self):
+        if self.accessed:
+            self.db.executemany(
+                "UPDATE embeddings SET last_access = ? WHERE model_id = ? AND text_hash = ?",
+                [(accessed, self.model_id, key) for key, accessed in self.accessed.items()],
+            )
+            self.accessed = {}
+        self.accessed_since = time.monotonic()
+
+    def _write_disk(self, rows):
+        # Recent reads must count before evicting by last_access
+        self._flush_access()
+        before = self.db.total_changes
+        self.db.executemany(
+            "INSERT OR IGNORE INTO embeddings (model_id, text_hash, vector, last_access) VALUES (?, ?, ?, ?)",
+            rows,
+        )
+        self.disk_items += self.db.total_changes - before
+        if self.disk_items > self.max_disk_items:
+            # Evict down to 90% of the limit so we don't pay for a delete on every insert
+            target = int(self.max_disk_items * 0.9)
+            cursor = self.db.execute(
+                "DELETE FROM embeddings WHERE (model_id, text_hash) IN "
+                "(SELECT model_id, text_hash FROM embeddings ORDER BY last_access LIMIT ?)",
+                (self.disk_items - target,),
+            )
+            self.disk_evictions += cursor.rowcount
+            self.disk_items -= cursor.rowcount
+        self.db.commit()
@@ -0,0 +1,47 @@
+import io
+import numpy as np
+
+# Media types understood by embedding_server.py and APIEmbedding
+JSON_MIMETYPE = 'application/json'
+RAW_MIMETYPE = 'application/octet-stream'
+NPY_MIMETYPE = 'application/x-npy'
+BINARY_MIMETYPES = (RAW_MIMETYPE, NPY_MIMETYPE)
+
+# Header naming the element type of a binary body; raw bodies also carry their shape
+DTYPE_HEADER = 'X-Embedding-Dtype'
+SHAPE_HEADER = 'X-Embedding-Shape'
+DTYPES = {'float32': '<f4', 'float16': '<f2'}
+
+
+def encode_embeddings(vectors, mimetype, dtype='float32'):
+    """Serialize a vector or a matrix of vectors to a little-endian binary body.
+
+    Returns (body, headers). Raw bodies are the bare array bytes, with the shape and dtype
+    sent in headers; .npy bodies are self-describing.
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"Unsupported dtype '{dtype}', expected one of {sorted(DTYPES)}.")
+    array = np.asarray(vectors, dtype=DTYPES[dtype])
+    headers = {DTYPE_HEADER: dtype, SHAPE_HEADER: ','.join(str(n) for n in array.shape)}
+    if mimetype == NPY_MIMETYPE:
+        buffer = io.BytesIO()
+        np.save(buffer, array, allow_pickle=False)
+        return buffer.getvalue(), headers
+    return array.tobytes(), headers
+
+
+def decode_embeddings(content, mimetype, headers):
+    """Decode a binary body from encode_embeddings into a read-only NumPy view of content."""
+    if mimetype == NPY_MIMETYPE:
+        # Parse the .npy header ourselves so the data itself is not copied
+        buffer = io.BytesIO(content)
+        version = np.lib.format.read_magic(buffer)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(buffer)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(buffer)
+        array = np.frombuffer(content, dtype=dtype, offset=buffer.tell())
+        return array.reshape(shape, order='F' if fortran_order else 'C')
+    dtype = DTYPES[headers.get(DTYPE_HEADER, 'float32')]
+    shape = tuple(int(n) for n in headers[SHAPE_HEADER].split(',') if n)
+    return np.frombuffer(content, dtype=dtype).reshape(shape)
@@ -0,0 +1,106 @@
+import math
+import os
+
+from langchain_core.messages import SystemMessage
+
+
+def estimate_tokens(text):
+    """Rough token count of a text (about 4 characters per token for English with GPT-4)."""
+    return math.ceil(len(text or "") / 4)
+
+
+def message_tokens(message):
+    return estimate_tokens(message.content) + 4  # role and message framing
+
+
+def speaker(message):
+    return message.additional_kwargs.get("role", message.type)
+
+
+def transcript(messages):
+    """Messages as 'Doctor: ...' / 'Patient: ...' lines, the form the summary prompt reads."""
+    return "\n".join(f"{speaker(message).capitalize()}: {message.content}" for message in messages)
+
+
+class History:
+    """Conversation as the nodes send it to the model: the opening system message, a summary of
+    the turns that were folded away and the recent messages verbatim."""
+    def __init__(self, system, summary, recent):
+        self.system = system
+        self.summary = summary
+        self.recent = recent
+
+
+class HistoryCompactor:
+    """Keeps prompts from growing with the length of a consultation.
+
+    The last keep_exchanges doctor/patient exchanges are sent verbatim; older ones are folded,
+    a few messages at a time, into a summary kept in the graph state (history_summary, with
+    summarized_messages counting the messages it covers). When building a node's input the
+    history is further cut to the node's token budget: the newest exchange always goes in, then
+    the summary, then older verbatim messages from newest to oldest while they fit.
+    """
+    def __init__(self, keep_exchanges=3, token_budget=3000, budgets=None):
+        if keep_exchanges < 1:
+            raise ValueError("keep_exchanges must be at least 1.")
+        self.keep_exchanges = keep_exchanges
+        self.token_budget = token_budget
+        self.budgets = budgets or {}
+
+    def budget(self, name):
+        return self.budgets.get(name, self.token_budget)
+
+    @staticmethod
+    def exchange_starts(body):
+        # An exchange starts with the doctor's message
+        return [index for index, message in enumerate(body) if speaker(message) == "doctor"]
+
+    def pending(self, messages, summarized):
+        """Messages that fell out of the verbatim window and are not in the summary yet."""
+        body = messages[1:]
+        starts = self.exchange_starts(body)
+        if len(starts) <= self.keep_exchanges:
+            return []
+        return body[summarized:starts[-self.keep_exchanges]]
+
+    def view(self, messages, summary=None, summarized=0):
+        return History(messages[0], summary, list(messages[1 + summarized:]))
+
+    def fit(self, history, instruction, name):
+        """Model input for node `name`: instruction as system message plus as much history as its budget allows."""
+        system = history.system.model_copy(update={"content": instruction})
+        left = self.budget(name) - message_tokens(system)
+        # Whole exchanges only, so an answer is never sent without its question
+        bounds = [0] + [start for start in self.exchange_starts(history.recent) if start > 0] + [len(history.recent)]
+        exchanges = [history.recent[start:end] for start, end in zip(bounds, bounds[1:]) if end > start]
+        kept = exchanges.pop() if exchanges else []
+        left -= sum(message_tokens(message) for message in kept)
+        summary = []
+        if history.summary:
+            summary_message = SystemMessage(content=f"Summary of the earlier consultation:\n{history.summary}")
+            if message_tokens(summary_message) <= left:
+                summary = [summary_message]
+                left -= message_tokens(summary_message)
+        older = []
+        for exchange in reversed(exchanges):
+            left -= sum(message_tokens(message) for message in exchange)
+            if left < 0:
+                break
+            older = exchange + older
+        return [system] + summary + older + kept
+
+
+def open_history_compactor(keep_exchanges=None, token_budget=None, budgets=None):
+    """Compactor configured by DIALOG_HISTORY_KEEP_EXCHANGES (0 disables), DIALOG_HISTORY_TOKEN_BUDGET
+    and DIALOG_HISTORY_BUDGETS ('decision=800,diagnostic=2500'); None when disabled."""
+    keep_exchanges = keep_exchanges if keep_exchanges is not None else int(os.getenv('DIALOG_HISTORY_KEEP_EXCHANGES', '3'))
+    if keep_exchanges <= 0:
+        return None
+    token_budget = token_budget if token_budget is not None else int(os.getenv('DIALOG_HISTORY_TOKEN_BUDGET', '3000'))
+    if budgets is None:
+        budgets = {}
+        for item in os.getenv('DIALOG_HISTORY_BUDGETS', '').split(','):
+            if item.strip():
+                name, _, value = item.partition('=')
+                budgets[name.strip()] = int(value)
+    return HistoryCompactor(keep_exchanges, token_budget, budgets)
@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Message fields ChatOpenAI actually sends; anything else (ids, additional_kwargs) does not change the answer
+ROLES = {"system": "system", "human": "user", "ai": "assistant", "tool": "tool"}
+
+
+def canonical_messages(messages):
+    """The parts of a model input that reach the API, as plain dicts in a stable form."""
+    canonical = []
+    for message in messages:
+        if isinstance(message, dict):
+            role, content, name = message.get("role"), message.get("content"), message.get("name")
+        else:
+            role, content, name = ROLES.get(message.type, message.type), message.content, getattr(message, "name", None)
+        canonical.append({"role": role, "content": content, "name": name})
+    return canonical
+
+
+def cache_key(model_name, prompt_version, messages):
+    payload = json.dumps(
+        {"model": model_name, "prompt_version": prompt_version, "messages": canonical_messages(messages)},
+        sort_keys=True, ensure_ascii=False, separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryCache:
+    """Exact-match tier: least recently used answers kept in process memory."""
+    def __init__(self, max_entries=1024, ttl_seconds=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, created = entry
+            if self.ttl_seconds is not None and time.time() - created > self.ttl_seconds:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, created=None):
+        with self.lock:
+            self.entries[key] = (value, created if created is not None else time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SqliteCache:
+    """On-disk tier shared by processes and restarts; entries expire after ttl_seconds and the
+    least recently used ones are dropped once there are more than max_entries."""
+    def __init__(self, path, ttl_seconds=7 * 24 * 3600, max_entries=100_000):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed)")
+        self.conn.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT value, created FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl_seconds is not None and now - row[1] > self.ttl_seconds:
+                self.conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self.conn.commit()
+                return None
+            self.conn.execute("UPDATE llm_cache SET accessed = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            return row[0]
+
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            self.evict(now)
+            self.conn.commit()
+
+    def evict(self, now):
+        if self.ttl_seconds is not None:
+            self.conn.execute("DELETE FROM llm_cache WHERE created < ?", (now - self.ttl_seconds,))
+        self.conn.execute(
+            "DELETE FROM llm_cache WHERE key IN "
+            "(SELECT key FROM llm_cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+
+class LLMCache:
+    """Model answers keyed on model name, prompt version and the canonical message list.
+
+    Lookups go to the memory tier first, then to the optional disk tier (any object with
+    get(key) and put(key, value), e.g. SqliteCache); a disk hit is copied into memory. Only the
+    answer text is stored.
+    """
+    def __init__(self, memory=None, disk=None):
+        self.memory = memory if memory is not None else MemoryCache()
+        self.disk = disk
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.put(key, value)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    # The disk tier does blocking I/O, so the asyncio callers run it in a worker thread
+    async def aget(self, key):
+        if self.disk is None:
+            return self.get(key)
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key, value):
+        if self.disk is None:
+            return self.put(key, value)
+        return await asyncio.to_thread(self.put, key, value)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_entries": len(self.memory),
+            "disk_entries": len(self.disk) if self.disk is not None else None,
+        }
+
+
+def open_llm_cache(size=None, path=None, ttl_seconds=None, max_disk_entries=None):
+    """Cache configured by DIALOG_LLM_CACHE_SIZE, DIALOG_LLM_CACHE_DB, DIALOG_LLM_CACHE_TTL and
+    DIALOG_LLM_CACHE_MAX; None when disabled.
+
+    Off unless DIALOG_LLM_CACHE_SIZE is set above 0: a hit replays an earlier sampled answer, and
+    entries are shared by every conversation whose prompt matches, which a deployment has to
+    opt into for clinical prompts.
+    """
+    size = size if size is not None else int(os.getenv('DIALOG_LLM_CACHE_SIZE', '0'))
+    if size <= 0:
+        return None
+    path = path if path is not None else os.getenv('DIALOG_LLM_CACHE_DB', '')
+    ttl_seconds = ttl_seconds if ttl_seconds is not None else float(os.getenv('DIALOG_LLM_CACHE_TTL', str(7 * 24 * 3600)))
+    disk = None
+    if path:
+        max_disk_entries = max_disk_entries if max_disk_entries is not None else int(os.getenv('DIALOG_LLM_CACHE_MAX', '100000'))
+        disk = SqliteCache(path, ttl_seconds=ttl_seconds, max_entries=max_disk_entries)
+    return LLMCache(MemoryCache(size, ttl_seconds=ttl_seconds), disk)
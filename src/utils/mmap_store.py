@@ -0,0 +1,253 @@
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import time
+import uuid
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from utils.bm25 import matches_where
+from utils.query_cache import CollectionVersion
+
+# On-disk layout of a store directory:
+#   meta.json      - dim, count, dtype (float32 or int8), whether an HNSW graph exists
+#   vectors.bin    - (count, dim) row-major matrix, memory-mapped read-only
+#   scales.npy     - per-row dequantization scale (int8 stores only)
+#   sq_norms.npy   - squared L2 norm of every (dequantized) row
+#   records.bin    - one JSON record {"id", "document", "metadata"} per chunk, back to back
+#   offsets.npy    - count + 1 byte offsets into records.bin
+#   hnsw.bin       - optional hnswlib graph over the same vectors
+#   <name>.version - collection version, bumped on every rebuild
+# The store path itself is a symlink to the current generation, <path>.<timestamp>. A rebuild
+# writes a new generation and swaps the symlink atomically, so readers that still have the old
+# files mapped keep a consistent view until they reopen.
+BLOCK_ROWS = 65536
+# Generations kept besides the current one, for readers that are still opening the previous store
+KEEP_GENERATIONS = 1
+# Filtered HNSW queries pass a filter callback to knn_query, which hnswlib added in 0.7.0
+HNSWLIB_MIN_VERSION = (0, 7, 0)
+
+
+def import_hnswlib():
+    """hnswlib, an optional dependency (requirements-extras.txt) needed for HNSW graphs."""
+    from importlib.metadata import version
+    try:
+        import hnswlib
+    except ImportError as e:
+        raise ImportError("HNSW graphs need hnswlib>=0.7.0; install it with: pip install -r requirements-extras.txt") from e
+    installed = version('hnswlib')
+    if tuple(int(part) for part in re.findall(r'\d+', installed)[:3]) < HNSWLIB_MIN_VERSION:
+        raise ImportError(f"HNSW graphs need hnswlib>=0.7.0 for filtered queries, found {installed}.")
+    return hnswlib
+
+
+class MmapVectorStore:
+    """Read-only vector store over memory-mapped files.
+
+    Exposes the subset of the Chroma collection API that retriever_server.py uses (query and get),
+    with squared-L2 distances like Chroma's default space. Several worker processes that open
+    the same directory share one copy of the vectors through the OS page cache.
+    """
+    def __init__(self, path, use_hnsw=True, ef_search=64):
+        # Resolve the generation once, so a rebuild swapping the symlink mid-open cannot mix files
+        path = os.path.realpath(path)
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as file:
+            self.meta = json.load(file)
+        self.dim = self.meta['dim']
+        self.count = self.meta['count']
+        self.vectors = np.memmap(os.path.join(path, 'vectors.bin'), dtype=self.meta['dtype'], mode='r',
+                                 shape=(self.count, self.dim))
+        self.scales = np.load(os.path.join(path, 'scales.npy'), mmap_mode='r') if self.meta['dtype'] == 'int8' else None
+        self.sq_norms = np.load(os.path.join(path, 'sq_norms.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.records = np.memmap(os.path.join(path, 'records.bin'), dtype=np.uint8, mode='r')
+        self.metadatas = None
+        self.hnsw = None
+        if use_hnsw and self.meta.get('hnsw'):
+            hnswlib = import_hnswlib()
+            self.hnsw = hnswlib.Index(space='l2', dim=self.dim)
+            self.hnsw.load_index(os.path.join(path, 'hnsw.bin'), max_elements=self.count)
+            self.hnsw.set_ef(ef_search)
+
+    @staticmethod
+    def relevance_score_fn(distance):
+        # Same conversion langchain's Chroma wrapper uses for the l2 space
+        return 1.0 - distance / np.sqrt(2)
+
+    def record(self, position):
+        start, end = int(self.offsets[position]), int(self.offsets[position + 1])
+        return json.loads(bytes(self.records[start:end]))
+
+    def row(self, position):
+        vector = np.asarray(self.vectors[position], dtype=np.float32)
+        return vector * self.scales[position] if self.scales is not None else vector
+
+    def query(self, query_embeddings, n_results=10, where=None, include=("documents", "distances")):
+        allowed = self._allowed_positions(where)
+        output = {key: [] for key in ("ids", *include)}
+        for query in np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self.dim):
+            positions, distances = self._nearest(query, n_results, allowed)
+            records = [self.record(position) for position in positions]
+            output["ids"].append([record["id"] for record in records])
+            if "documents" in include:
+                output["documents"].append([record["document"] for record in records])
+            if "metadatas" in include:
+                output["metadatas"].append([record["metadata"] for record in records])
+            if "distances" in include:
+                output["distances"].append(distances.tolist())
+            if "embeddings" in include:
+                output["embeddings"].append([self.row(position).tolist() for position in positions])
+        return output
+
+    def get(self, include=("documents", "metadatas")):
+        records = [self.record(position) for position in range(self.count)]
+        output = {"ids": [record["id"] for record in records]}
+        if "documents" in include:
+            output["documents"] = [record["document"] for record in records]
+        if "metadatas" in include:
+            output["metadatas"] = [record["metadata"] for record in records]
+        return output
+
+    def _allowed_positions(self, where):
+        if not where:
+            return None
+        if self.metadatas is None:
+            self.metadatas = [self.record(position)["metadata"] or {} for position in range(self.count)]
+        return np.array([i for i, metadata in enumerate(self.metadatas) if matches_where(metadata, where)], dtype=np.int64)
+
+    def _nearest(self, query, k, allowed):
+        if self.hnsw is not None:
+            allowed_set = set(allowed.tolist()) if allowed is not None else None
+            k = min(k, self.count if allowed_set is None else len(allowed_set))
+            if k == 0:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+            labels, distances = self.hnsw.knn_query(
+                query, k=k, filter=(lambda label: label in allowed_set) if allowed_set is not None else None)
+            return labels[0].astype(np.int64), distances[0]
+
+        # Exact search, scanning the matrix block by block so int8 rows are dequantized a slice at a time
+        candidates = allowed if allowed is not None else None
+        total = self.count if candidates is None else len(candidates)
+        k = min(k, total)
+        if k == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query_sq_norm = float(query @ query)
+        distances = np.empty(total, dtype=np.float32)
+        for start in range(0, total, BLOCK_ROWS):
+            rows = slice(start, min(start + BLOCK_ROWS, total))
+            positions = candidates[rows] if candidates is not None else rows
+            dots = np.asarray(self.vectors[positions], dtype=np.float32) @ query
+            if self.scales is not None:
+                dots *= self.scales[positions]
+            distances[rows] = self.sq_norms[positions] - 2 * dots + query_sq_norm
+        best = np.argpartition(distances, k - 1)[:k] if k < total else np.arange(total)
+        best = best[np.argsort(distances[best])]
+        positions = candidates[best] if candidates is not None else best
+        return positions.astype(np.int64), np.maximum(distances[best], 0)
+
+
+def build_store(path, ids, embeddings, documents, metadatas, dtype='float32', hnsw=False, hnsw_m=16, ef_construction=200,
+                version_file=None):
+    """Write a new generation of the store and atomically make `path` point at it.
+
+    version_file names the collection version file (e.g. 'conDB.version') carried in the store;
+    the new generation gets the previous version + 1, so retrievers drop cached results and reopen.
+    """
+    if dtype not in ('float32', 'int8'):
+        raise ValueError("dtype must be 'float32' or 'int8'.")
+    path = os.path.abspath(path)
+    generation = f"{path}.{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    os.makedirs(generation)
+    try:
+        write_generation(generation, ids, embeddings, documents, metadatas, dtype, hnsw, hnsw_m, ef_construction)
+        if version_file is not None:
+            version = CollectionVersion(os.path.join(path, version_file)).current() + 1
+            with open(os.path.join(generation, version_file), 'w') as file:
+                file.write(str(version))
+    except BaseException:
+        shutil.rmtree(generation, ignore_errors=True)
+        raise
+    swap_generation(path, generation)
+
+
+def swap_generation(path, generation):
+    if os.path.isdir(path) and not os.path.islink(path):
+        # A store written before generations existed: move it aside (readers briefly see no store)
+        os.rename(path, f"{path}.{time.strftime('%Y%m%dT%H%M%S')}-legacy")
+    link = f"{path}.{os.getpid()}.link"
+    os.symlink(os.path.basename(generation), link)
+    os.replace(link, path)
+    # Old generations can go: open readers keep their mapped files alive after the unlink
+    directory = os.path.dirname(path)
+    pattern = re.compile(re.escape(os.path.basename(path)) + r"\.\d{8}T\d{6}-\w+$")
+    older = [os.path.join(directory, name) for name in os.listdir(directory)
+             if pattern.match(name) and name != os.path.basename(generation)]
+    older = sorted((name for name in older if os.path.isdir(name) and not os.path.islink(name)), key=os.path.getmtime)
+    for name in older[:max(len(older) - KEEP_GENERATIONS, 0)]:
+        shutil.rmtree(name, ignore_errors=True)
+
+
+def write_generation(path, ids, embeddings, documents, metadatas, dtype, hnsw, hnsw_m, ef_construction):
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    count, dim = matrix.shape
+
+    if dtype == 'int8':
+        # Symmetric per-row quantization
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        stored = np.round(matrix / scales[:, None]).astype(np.int8)
+        np.save(os.path.join(path, 'scales.npy'), scales.astype(np.float32))
+        dequantized = stored.astype(np.float32) * scales[:, None]
+    else:
+        stored = matrix
+        dequantized = matrix
+    stored.tofile(os.path.join(path, 'vectors.bin'))
+    np.save(os.path.join(path, 'sq_norms.npy'), (dequantized * dequantized).sum(axis=1).astype(np.float32))
+
+    offsets = [0]
+    with open(os.path.join(path, 'records.bin'), 'wb') as file:
+        for record_id, document, metadata in zip(ids, documents, metadatas):
+            data = json.dumps({"id": record_id, "document": document, "metadata": metadata or {}}).encode('utf-8')
+            file.write(data)
+            offsets.append(offsets[-1] + len(data))
+    np.save(os.path.join(path, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+
+    if hnsw:
+        hnswlib = import_hnswlib()
+        index = hnswlib.Index(space='l2', dim=dim)
+        index.init_index(max_elements=count, M=hnsw_m, ef_construction=ef_construction)
+        index.add_items(dequantized, np.arange(count))
+        index.save_index(os.path.join(path, 'hnsw.bin'))
+
+    with open(os.path.join(path, 'meta.json'), 'w') as file:
+        json.dump({"dim": dim, "count": count, "dtype": dtype, "hnsw": bool(hnsw)}, file)
+
+
+def build_from_chroma(persist_directory, collection_name, path, dtype='float32', hnsw=False):
+    # Ensure pysqlite3 is used for sqlite3
+    __import__('pysqlite3')
+    sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+    import chromadb
+
+    collection = chromadb.PersistentClient(path=persist_directory).get_collection(collection_name)
+    contents = collection.get(include=["embeddings", "documents", "metadatas"])
+    build_store(path, contents["ids"], contents["embeddings"], contents["documents"], contents["metadatas"],
+                dtype=dtype, hnsw=hnsw, version_file=f"{collection_name}.version")
+    return len(contents["ids"])
+
+
+if __name__ == "__main__":
+    # python src/utils/mmap_store.py --persist-directory ./consultation_db --out ./consultation_mmap --dtype int8 --hnsw
+    parser = argparse.ArgumentParser(description="Export a Chroma collection to a memory-mapped vector store.")
+    parser.add_argument('--persist-directory', default='./consultation_db')
+    parser.add_argument('--collection', default='conDB')
+    parser.add_argument('--out', default='./consultation_mmap')
+    parser.add_argument('--dtype', choices=('float32', 'int8'), default='float32')
+    parser.add_argument('--hnsw', action='store_true', help="Also build an HNSW graph (needs hnswlib)")
+    args = parser.parse_args()
+    count = build_from_chroma(args.persist_directory, args.collection, args.out, dtype=args.dtype, hnsw=args.hnsw)
+    print(f"Wrote {count} vectors to {args.out}")
@@ -0,0 +1,80 @@
+import hashlib
+import os
+import threading
+
+import yaml
+
+
+class PromptSnapshot:
+    """Immutable set of prompt templates with their instructions already filled in."""
+    def __init__(self, version, instructions, templates):
+        self.version = version
+        self.instructions = instructions
+        self.templates = templates
+
+
+class PromptRegistry:
+    """Process-wide prompt templates, reloaded from a YAML file only when it changes.
+
+    templates maps a prompt name to a PromptTemplate with an {instruction} placeholder; the YAML
+    file holds one '<name>_prompt_instruction' entry per template. A background thread polls the
+    file's mtime every poll_seconds, parses and validates it on change and swaps in a new
+    snapshot, so readers only ever do an attribute lookup. A file that fails to parse or misses
+    a key is reported and the previous snapshot stays in place.
+    """
+    def __init__(self, path, templates, default_instructions, poll_seconds=2.0):
+        self.path = path
+        self.templates = templates
+        self.poll_seconds = poll_seconds
+        self.mtime = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.current = self._snapshot(default_instructions, "default")
+        self.refresh()
+
+    @staticmethod
+    def instruction_key(name):
+        return f"{name}_prompt_instruction"
+
+    def refresh(self):
+        """Reload the file if its mtime changed; returns True when a new snapshot was installed."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        with self.lock:
+            if mtime == self.mtime:
+                return False
+            self.mtime = mtime
+            try:
+                with open(self.path, 'rb') as file:
+                    content = file.read()
+                prompts = yaml.safe_load(content) or {}
+                instructions = {name: prompts[self.instruction_key(name)] for name in self.templates}
+            except yaml.YAMLError as e:
+                print(f"Error parsing YAML file: {e}")
+                return False
+            except KeyError as e:
+                print(f"Missing key in YAML file: {e}")
+                return False
+            self.current = self._snapshot(instructions, hashlib.sha256(content).hexdigest()[:12])
+            print(f"Prompts have been updated from the YAML file (version {self.current.version}).")
+            return True
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._watch, name="prompt-registry", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _watch(self):
+        while not self.stop_event.wait(self.poll_seconds):
+            self.refresh()
+
+    def _snapshot(self, instructions, version):
+        templates = {name: template.partial(instruction=instructions[name]) for name, template in self.templates.items()}
+        return PromptSnapshot(version, instructions, templates)
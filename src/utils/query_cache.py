@@ -0,0 +1,118 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from utils.embedding_cache import normalize_text
+
+
+class CollectionVersion:
+    """Version counter for a vector collection, stored in a small file next to the persisted store.
+
+    Ingestion calls bump() after writing to the collection. Readers call current(), which costs
+    one os.stat and only re-reads the file when its mtime changed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.version = 0
+        self.lock = Lock()
+
+    def current(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+        if mtime != self.mtime:
+            with self.lock:
+                self.version = self._read()
+                self.mtime = mtime
+        return self.version
+
+    def bump(self):
+        with self.lock:
+            version = self._read() + 1
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as file:
+                file.write(str(version))
+            # Atomic swap so readers never see a half-written file
+            os.replace(tmp_path, self.path)
+            return version
+
+    def _read(self):
+        try:
+            with open(self.path) as file:
+                return int(file.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+
+class QueryCache:
+    """LRU + TTL cache for retrieval results, tied to a collection version.
+
+    Entries are keyed on normalized query text plus the query options (k, filters, ...). When the
+    collection version changes the whole cache is dropped, so results never outlive an ingest.
+    max_items=0 disables the cache.
+    """
+    def __init__(self, max_items=1024, ttl_seconds=300):
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.version = None
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(text, options):
+        return normalize_text(text), json.dumps(options, sort_keys=True, default=str)
+
+    def get(self, key, version):
+        with self.lock:
+            self._check_version(version)
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, value):
+        if self.max_items <= 0:
+            return
+        with self.lock:
+            if version != self.version:
+                # The collection changed while this result was computed; don't keep it
+                return
+            self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_items:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "items": len(self.entries),
+                "max_items": self.max_items,
+                "ttl_seconds": self.ttl_seconds,
+                "collection_version": self.version,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _check_version(self, version):
+        if version != self.version:
+            if self.version is not None:
+                self.invalidations += 1
+            self.entries.clear()
+            self.version = version
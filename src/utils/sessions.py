@@ -0,0 +1,172 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from threading import Lock
+
+
+class SessionLimitReached(RuntimeError):
+    """Raised when every resident session is in use and no more may be created."""
+
+
+class Session:
+    def __init__(self, session_id, conversation, lock=None):
+        self.session_id = session_id
+        self.conversation = conversation
+        self.lock = lock if lock is not None else Lock()  # Serializes turns of the same conversation
+        self.users = 0  # Requests holding or waiting for the lock; in-use sessions are never evicted
+        self.last_used = time.monotonic()
+
+
+class SessionManager:
+    """Holds many concurrent conversations keyed by conversationId.
+
+    factory(session_id) builds a ready-to-use conversation. Sessions idle for longer than
+    idle_ttl_seconds are dropped, and once max_sessions are resident the least recently used
+    idle session makes room for a new one. Each session has its own lock, so different
+    conversations run in parallel while turns of one conversation stay in order.
+    on_evict(session_id), if given, is called for sessions dropped by the TTL or the cap.
+    """
+    def __init__(self, factory, max_sessions=100, idle_ttl_seconds=1800, on_evict=None):
+        self.factory = factory
+        self.on_evict = on_evict
+        self.max_sessions = max_sessions
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.sessions = OrderedDict()
+        self.lock = Lock()
+        self.created = 0
+        self.evicted = 0
+        self.expired = 0
+
+    @staticmethod
+    def normalize_id(conversation_id):
+        # Clients echo back whatever they were given: a plain id or the {"thread_id": ...} config
+        if isinstance(conversation_id, dict):
+            conversation_id = conversation_id.get("thread_id")
+        return str(conversation_id) if conversation_id else None
+
+    @contextmanager
+    def session(self, conversation_id=None):
+        """Yield the Session for conversation_id, creating it if needed, with its lock held."""
+        session = self._checkout(self.normalize_id(conversation_id) or str(uuid.uuid1()))
+        try:
+            with session.lock:
+                if session.conversation is None:
+                    raise RuntimeError(f"Session '{session.session_id}' could not be created.")
+                yield session
+        finally:
+            with self.lock:
+                session.users -= 1
+                session.last_used = time.monotonic()
+
+    def discard(self, session_id):
+        with self.lock:
+            self.sessions.pop(self.normalize_id(session_id), None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "sessions": len(self.sessions),
+                "active": sum(1 for session in self.sessions.values() if session.users),
+                "max_sessions": self.max_sessions,
+                "idle_ttl_seconds": self.idle_ttl_seconds,
+                "created": self.created,
+                "evicted": self.evicted,
+                "expired": self.expired,
+            }
+
+    def _reserve(self, session_id, lock=None):
+        """Return (session, created); a created session is reserved but has no conversation yet."""
+        with self.lock:
+            self._expire()
+            session = self.sessions.get(session_id)
+            if session is not None:
+                self.sessions.move_to_end(session_id)
+                session.users += 1
+                return session, False
+            self._make_room()
+            session = Session(session_id, None, lock)
+            session.users = 1
+            self.sessions[session_id] = session
+            return session, True
+
+    def _checkout(self, session_id):
+        # A new session's lock is taken before it becomes visible, so requests for the same id
+        # wait for the conversation that is built outside the manager lock
+        lock = Lock()
+        lock.acquire()
+        session, created = self._reserve(session_id, lock)
+        if not created:
+            return session
+        try:
+            session.conversation = self.factory(session_id)
+        except Exception:
+            with self.lock:
+                self.sessions.pop(session_id, None)
+            session.lock.release()
+            raise
+        with self.lock:
+            self.created += 1
+        session.lock.release()
+        return session
+
+    def _expire(self):
+        deadline = time.monotonic() - self.idle_ttl_seconds
+        for session_id, session in list(self.sessions.items()):
+            if session.users == 0 and session.last_used < deadline:
+                del self.sessions[session_id]
+                self.expired += 1
+                self._evicted(session_id)
+
+    def _make_room(self):
+        while len(self.sessions) >= self.max_sessions:
+            # Oldest first; skip sessions with a turn in flight
+            idle = next((session_id for session_id, session in self.sessions.items() if session.users == 0), None)
+            if idle is None:
+                raise SessionLimitReached(f"All {self.max_sessions} sessions are in use.")
+            del self.sessions[idle]
+            self.evicted += 1
+            self._evicted(idle)
+
+    def _evicted(self, session_id):
+        if self.on_evict is not None:
+            self.on_evict(session_id)
+
+
+class AsyncSessionManager(SessionManager):
+    """SessionManager for asyncio servers: per-session asyncio locks and an async factory.
+
+    All methods run on the event loop thread, so the manager lock is only ever held for
+    the short bookkeeping sections and never across an await.
+    """
+    @asynccontextmanager
+    async def session(self, conversation_id=None):
+        session = await self._acheckout(self.normalize_id(conversation_id) or str(uuid.uuid1()))
+        try:
+            async with session.lock:
+                if session.conversation is None:
+                    raise RuntimeError(f"Session '{session.session_id}' could not be created.")
+                yield session
+        finally:
+            with self.lock:
+                session.users -= 1
+                session.last_used = time.monotonic()
+
+    async def _acheckout(self, session_id):
+        session, created = self._reserve(session_id, asyncio.Lock())
+        if not created:
+            return session
+        # Nothing awaits between the reservation and this acquire, so no other request can take the lock first
+        await session.lock.acquire()
+        try:
+            session.conversation = await self.factory(session_id)
+        except Exception:
+            with self.lock:
+                self.sessions.pop(session_id, None)
+            session.lock.release()
+            raise
+        with self.lock:
+            self.created += 1
+        session.lock.release()
+        return session
@@ -0,0 +1,73 @@
+import json
+import re
+
+# ```json ... ``` or ``` ... ``` around the whole answer
+CODE_FENCE = re.compile(r"^\s*```[a-zA-Z]*\s*\n?(.*?)\n?\s*```\s*$", re.DOTALL)
+# A comma directly before a closing brace or bracket
+TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+
+
+class StructuredOutputError(ValueError):
+    """Raised when the model keeps answering with JSON that cannot be parsed or validated."""
+
+
+def repair_json(text):
+    """Parse near-valid JSON from a model answer.
+
+    Handles the usual ways an answer misses strict JSON: a code fence around it, prose before or
+    after the object, and trailing commas. Raises json.JSONDecodeError when it still fails.
+    """
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    candidate = text.strip()
+    fenced = CODE_FENCE.match(candidate)
+    if fenced:
+        candidate = fenced.group(1).strip()
+    start, end = candidate.find('{'), candidate.rfind('}')
+    if start != -1 and end > start:
+        candidate = candidate[start:end + 1]
+    candidate = TRAILING_COMMA.sub(r"\1", candidate)
+    return json.loads(candidate)
+
+
+def validate(value, schema):
+    """Check a parsed answer against a schema of {key: expected type}; returns a list of problems."""
+    if not isinstance(value, dict):
+        return [f"expected a JSON object, got {type(value).__name__}"]
+    problems = []
+    for key, expected in (schema or {}).items():
+        if key not in value:
+            problems.append(f"missing key '{key}'")
+        elif not isinstance(value[key], expected):
+            problems.append(f"'{key}' should be {expected.__name__}, got {type(value[key]).__name__}")
+    return problems
+
+
+class StructuredCaller:
+    """Calls a chat model for a JSON answer with local repair and a bounded number of retries.
+
+    json_mode asks OpenAI for a guaranteed JSON object (response_format json_object), which the
+    prompts allow because they all mention JSON. Each answer is repaired locally first, so only
+    answers that are still invalid cost another round trip, and at most max_retries of them.
+    """
+    def __init__(self, model, max_retries=2, json_mode=True):
+        self.model = model.bind(response_format={"type": "json_object"}) if json_mode else model
+        self.max_retries = max_retries
+
+    def invoke(self, messages, schema=None, name="model"):
+        """Return (parsed, text) where text is the parsed answer re-serialized as strict JSON."""
+        problems = []
+        for attempt in range(self.max_retries + 1):
+            content = self.model.invoke(messages).content
+            try:
+                parsed = repair_json(content)
+            except json.JSONDecodeError as e:
+                problems = [f"invalid JSON: {e}"]
+            else:
+                problems = validate(parsed, schema)
+                if not problems:
+                    return parsed, json.dumps(parsed, ensure_ascii=False)
+            print(f"{name}: attempt {attempt + 1} gave unusable JSON ({'; '.join(problems)}).")
+        raise StructuredOutputError(f"{name} returned unusable JSON after {self.max_retries + 1} attempts: {'; '.join(problems)}")
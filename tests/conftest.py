@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules under src/ import each other as top-level packages (utils.*, servers.*)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
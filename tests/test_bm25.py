@@ -0,0 +1,55 @@
+import pytest
+
+from utils.bm25 import BM25Index, matches_where, reciprocal_rank_fusion, tokenize
+
+METADATA = {"source": "a.txt", "chunk": 3, "type": "GP"}
+
+
+def test_tokenize_keeps_codes_and_lowercases():
+    assert tokenize("SNOMED 6142004: Influenza-like") == ["snomed", "6142004", "influenza", "like"]
+
+
+@pytest.mark.parametrize("where, expected", [
+    (None, True),
+    ({"source": "a.txt"}, True),
+    ({"source": "b.txt"}, False),
+    ({"source": {"$in": ["a.txt", "b.txt"]}}, True),
+    ({"source": {"$nin": ["a.txt"]}}, False),
+    ({"chunk": {"$gte": 3, "$lt": 4}}, True),
+    ({"chunk": {"$gt": 3}}, False),
+    ({"missing": {"$gt": 1}}, False),
+    ({"type": {"$ne": "Specialist"}}, True),
+    ({"$and": [{"source": "a.txt"}, {"chunk": {"$lte": 2}}]}, False),
+    ({"$or": [{"source": "b.txt"}, {"type": {"$eq": "GP"}}]}, True),
+])
+def test_matches_where(where, expected):
+    assert matches_where(METADATA, where) is expected
+
+
+def test_matches_where_rejects_unknown_operator():
+    with pytest.raises(ValueError):
+        matches_where(METADATA, {"chunk": {"$between": [1, 5]}})
+
+
+def test_bm25_ranks_rare_terms_and_filters():
+    documents = [
+        "patient reports a dry cough and fever",
+        "repeat script for blood pressure medication",
+        "cough cough cough with chest pain, SNOMED 6142004",
+    ]
+    metadatas = [{"source": "a.txt"}, {"source": "b.txt"}, {"source": "c.txt"}]
+    index = BM25Index(documents, metadatas)
+    hits = index.search("cough 6142004", k=3)
+    assert [position for position, _ in hits] == [2, 0]
+    assert hits[0][1] > hits[1][1] > 0
+    assert index.search("cough", where={"source": "a.txt"}) == [(0, pytest.approx(index.search("cough")[1][1]))]
+    assert index.search("unknown words") == []
+
+
+def test_reciprocal_rank_fusion_rewards_agreement():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["b", "d"]], k=60)
+    keys = [key for key, _ in fused]
+    assert keys[0] == "b"
+    assert set(keys) == {"a", "b", "c", "d"}
+    assert dict(fused)["b"] == pytest.approx(1 / 62 + 1 / 61)
+    assert dict(fused)["a"] == pytest.approx(1 / 61)
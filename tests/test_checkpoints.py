@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.graph import END, START, MessagesState, StateGraph
+
+from utils.checkpoints import PruningSqliteSaver, delete_thread, open_checkpointer
+
+
+class CounterState(MessagesState):
+    count: int
+
+
+def counter_graph(checkpointer):
+    graph = StateGraph(CounterState)
+    graph.add_node("first", lambda state: {"count": state.get("count", 0) + 1})
+    graph.add_node("second", lambda state: {"count": state["count"] + 1})
+    graph.add_edge(START, "first")
+    graph.add_edge("first", "second")
+    graph.add_edge("second", END)
+    return graph.compile(checkpointer=checkpointer)
+
+
+def config(thread_id):
+    return {"configurable": {"thread_id": thread_id}}
+
+
+def run_turns(app, thread_id, turns):
+    for _ in range(turns):
+        app.invoke({"messages": []}, config(thread_id))
+
+
+def test_prunes_each_thread_to_keep_last(tmp_path):
+    saver = PruningSqliteSaver.open(str(tmp_path / "checkpoints.db"), keep_last=3)
+    app = counter_graph(saver)
+    run_turns(app, "a", 5)
+    run_turns(app, "b", 1)
+    assert len(list(saver.list(config("a")))) == 3
+    assert len(list(saver.list(config("b")))) == 3
+    # The newest checkpoint is the one kept, so the thread resumes with its full state
+    assert app.get_state(config("a")).values["count"] == 10
+    stats = saver.stats()
+    assert (stats["threads"], stats["checkpoints"]) == (2, 6)
+    assert stats["db_bytes"] > 0
+
+
+def test_state_survives_reopening(tmp_path):
+    path = str(tmp_path / "checkpoints.db")
+    run_turns(counter_graph(PruningSqliteSaver.open(path)), "a", 2)
+    reopened = PruningSqliteSaver.open(path)
+    assert reopened.durable
+    assert counter_graph(reopened).get_state(config("a")).values["count"] == 4
+
+
+def test_delete_thread_leaves_other_threads():
+    saver = PruningSqliteSaver.open(':memory:', keep_last=2)
+    assert not saver.durable
+    app = counter_graph(saver)
+    run_turns(app, "a", 1)
+    run_turns(app, "b", 1)
+    saver.delete_thread("a")
+    assert not saver.has_thread("a")
+    assert saver.has_thread("b")
+    assert saver.stats()["db_bytes"] == 0
+
+
+def test_async_graph_api():
+    saver = PruningSqliteSaver.open(':memory:', keep_last=2)
+    app = counter_graph(saver)
+
+    async def turns():
+        for _ in range(3):
+            await app.ainvoke({"messages": []}, config("a"))
+        return (await app.aget_state(config("a"))).values["count"]
+
+    assert asyncio.run(turns()) == 6
+    assert len(list(saver.list(config("a")))) == 2
+
+
+def test_delete_thread_on_memory_saver():
+    saver = MemorySaver()
+    app = counter_graph(saver)
+    run_turns(app, "a", 1)
+    run_turns(app, "b", 1)
+    delete_thread(saver, "a")
+    assert list(saver.list(config("a"))) == []
+    assert app.get_state(config("b")).values["count"] == 2
+
+
+def test_rejects_keep_last_below_one():
+    with pytest.raises(ValueError):
+        PruningSqliteSaver.open(':memory:', keep_last=0)
+
+
+def test_open_checkpointer_from_environment(tmp_path, monkeypatch):
+    monkeypatch.delenv("DIALOG_CHECKPOINT_DB", raising=False)
+    assert open_checkpointer() is None
+    assert open_checkpointer(default=':memory:').path == ':memory:'
+
+    monkeypatch.setenv("DIALOG_CHECKPOINT_DB", str(tmp_path / "dialog.db"))
+    monkeypatch.setenv("DIALOG_CHECKPOINT_KEEP", "5")
+    saver = open_checkpointer(default=':memory:')
+    assert saver.durable
+    assert saver.keep_last == 5
@@ -0,0 +1,79 @@
+import time
+from array import array
+
+from utils.embedding_cache import EmbeddingCache, normalize_text, text_hash
+
+
+def float32(values):
+    return array('f', values).tolist()
+
+
+def test_normalize_text_collapses_whitespace_and_unicode_forms():
+    assert normalize_text("  chest\tpain\n\nsince  Monday ") == "chest pain since Monday"
+    # "é" precomposed and as e + combining accent
+    assert text_hash("café") == text_hash("café")
+    assert text_hash("cough") != text_hash("Cough")
+
+
+def test_put_returns_vectors_as_cached():
+    cache = EmbeddingCache("model")
+    stored = cache.put_many(["a"], [[0.1, 0.2]])
+    assert stored == [float32([0.1, 0.2])]
+    assert cache.get_many(["a"]) == stored
+
+
+def test_get_many_aligns_hits_and_misses():
+    cache = EmbeddingCache("model")
+    cache.put_many(["a", "b"], [[1.0], [2.0]])
+    assert cache.get_many(["b", "x", " a "]) == [[2.0], None, [1.0]]
+    stats = cache.stats()
+    assert (stats["memory_hits"], stats["misses"]) == (2, 1)
+
+
+def test_memory_tier_evicts_least_recently_used():
+    cache = EmbeddingCache("model", max_memory_items=2)
+    cache.put_many(["a", "b"], [[1.0], [2.0]])
+    cache.get_many(["a"])
+    cache.put_many(["c"], [[3.0]])
+    assert cache.get_many(["a", "b", "c"]) == [[1.0], None, [3.0]]
+    assert cache.stats()["memory_evictions"] == 1
+
+
+def test_disk_tier_survives_reopen_and_is_per_model(tmp_path):
+    path = str(tmp_path / "cache.db")
+    EmbeddingCache("model", db_path=path).put_many(["a"], [[0.5, 0.25]])
+    reopened = EmbeddingCache("model", db_path=path)
+    assert reopened.get_many(["a"]) == [[0.5, 0.25]]
+    assert reopened.stats()["disk_hits"] == 1
+    assert EmbeddingCache("other-model", db_path=path).get_many(["a"]) == [None]
+
+
+def test_disk_tier_evicts_least_recently_accessed(tmp_path):
+    cache = EmbeddingCache("model", db_path=str(tmp_path / "cache.db"), max_memory_items=1, max_disk_items=10)
+    cache.put_many([f"t{i}" for i in range(10)], [[float(i)] for i in range(10)])
+    # Read t0 back from disk so it counts as recently used, then overflow the disk tier
+    cache.put_many(["t9"], [[9.0]])
+    time.sleep(0.01)
+    assert cache.get_many(["t0"]) == [[0.0]]
+    cache.put_many(["new"], [[10.0]])
+    stats = cache.stats()
+    # Evicted down to 90% of the limit, oldest access first
+    assert stats["disk_items"] == 9
+    assert stats["disk_evictions"] == 2
+    # t0's deferred access time was written before evicting, so it is kept
+    assert cache.get_many(["t0"]) == [[0.0]]
+    assert cache.get_many([f"t{i}" for i in range(1, 10)]).count(None) == 2
+
+
+def test_disk_hits_defer_last_access_writes(tmp_path):
+    cache = EmbeddingCache("model", db_path=str(tmp_path / "cache.db"), max_memory_items=1,
+                           access_flush_items=3, access_flush_seconds=3600)
+    cache.put_many(["a", "b", "c"], [[1.0], [2.0], [3.0]])
+    cache.get_many(["a"])
+    assert list(cache.accessed) == [text_hash("a")]
+    cache.get_many(["b", "c"])
+    # Third pending access reached access_flush_items
+    assert cache.accessed == {}
+    cache.get_many(["a"])
+    cache.flush()
+    assert cache.accessed == {}
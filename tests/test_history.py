@@ -0,0 +1,79 @@
+import pytest
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from utils.history import HistoryCompactor, estimate_tokens, message_tokens, open_history_compactor, transcript
+
+
+def doctor(text):
+    return HumanMessage(content=text, additional_kwargs={"role": "doctor"})
+
+
+def patient(text):
+    return HumanMessage(content=text, additional_kwargs={"role": "patient"})
+
+
+def consultation(exchanges):
+    # 40 characters each, so every message costs 10 + 4 tokens
+    messages = [SystemMessage(content="Opening instruction")]
+    for n in range(exchanges):
+        messages += [doctor(f"Doctor question {n}".ljust(40, ".")), patient(f"Patient answer {n}".ljust(40, "."))]
+    return messages
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens(None) == 0
+    assert estimate_tokens("abcd") == 1
+    assert estimate_tokens("abcde") == 2
+
+
+def test_transcript_uses_speaker_roles():
+    assert transcript([doctor("Where does it hurt?"), patient("My head.")]) == "Doctor: Where does it hurt?\nPatient: My head."
+
+
+def test_pending_is_what_left_the_verbatim_window():
+    compactor = HistoryCompactor(keep_exchanges=2)
+    messages = consultation(2)
+    assert compactor.pending(messages, 0) == []
+    messages = consultation(5)
+    assert compactor.pending(messages, 0) == messages[1:7]
+    # Messages already in the summary are not folded again
+    assert compactor.pending(messages, 4) == messages[5:7]
+
+
+def test_fit_keeps_whole_exchanges_within_budget():
+    messages = consultation(4)
+    instruction = "Decide".ljust(40, ".")
+    system_tokens = message_tokens(SystemMessage(content=instruction))
+    # Room for the newest exchange and one older one, with a little to spare
+    compactor = HistoryCompactor(budgets={"decision": system_tokens + 2 * 28 + 20})
+    fitted = compactor.fit(compactor.view(messages), instruction, "decision")
+    assert fitted[0].content == instruction
+    assert fitted[1:] == messages[5:9]
+    assert sum(message_tokens(message) for message in fitted) <= compactor.budget("decision")
+
+
+def test_fit_always_sends_the_newest_exchange_and_prefers_the_summary():
+    messages = consultation(4)
+    compactor = HistoryCompactor(token_budget=10)
+    fitted = compactor.fit(compactor.view(messages), "Decide", "any")
+    assert fitted[1:] == messages[7:9]
+
+    summary = "Headache for three days."
+    compactor = HistoryCompactor(token_budget=message_tokens(SystemMessage(content="Decide")) + 28 + 40)
+    fitted = compactor.fit(compactor.view(messages, summary=summary, summarized=2), "Decide", "any")
+    assert summary in fitted[1].content
+    assert fitted[2:] == messages[7:9]
+
+
+def test_open_history_compactor(monkeypatch):
+    monkeypatch.delenv("DIALOG_HISTORY_TOKEN_BUDGET", raising=False)
+    monkeypatch.setenv("DIALOG_HISTORY_KEEP_EXCHANGES", "0")
+    assert open_history_compactor() is None
+    monkeypatch.setenv("DIALOG_HISTORY_KEEP_EXCHANGES", "2")
+    monkeypatch.setenv("DIALOG_HISTORY_BUDGETS", "decision=800, diagnostic=2500")
+    compactor = open_history_compactor()
+    assert compactor.keep_exchanges == 2
+    assert (compactor.budget("decision"), compactor.budget("diagnostic"), compactor.budget("other")) == (800, 2500, 3000)
+    with pytest.raises(ValueError):
+        HistoryCompactor(keep_exchanges=0)
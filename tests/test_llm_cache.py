@@ -0,0 +1,75 @@
+import time
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from utils.llm_cache import LLMCache, MemoryCache, SqliteCache, cache_key, open_llm_cache
+
+
+def test_cache_key_ignores_fields_not_sent_to_the_api():
+    messages = [SystemMessage(content="You are a GP."), HumanMessage(content="Headache", additional_kwargs={"role": "patient"}, id="1")]
+    as_dicts = [{"role": "system", "content": "You are a GP."}, {"role": "user", "content": "Headache"}]
+    assert cache_key("gpt-4o", "v1", messages) == cache_key("gpt-4o", "v1", [SystemMessage(content="You are a GP."), HumanMessage(content="Headache")])
+    assert cache_key("gpt-4o", "v1", messages) == cache_key("gpt-4o", "v1", as_dicts)
+    assert cache_key("gpt-4o", "v1", messages) != cache_key("gpt-4o", "v2", messages)
+    assert cache_key("gpt-4o", "v1", messages) != cache_key("gpt-4o-mini", "v1", messages)
+    assert cache_key("gpt-4o", "v1", messages) != cache_key("gpt-4o", "v1", [*messages[:1], AIMessage(content="Headache")])
+
+
+def test_memory_cache_lru_and_ttl():
+    cache = MemoryCache(max_entries=2)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    cache.get("a")
+    cache.put("c", "3")
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == ("1", None, "3")
+
+    expiring = MemoryCache(ttl_seconds=60)
+    expiring.put("old", "1", created=time.time() - 61)
+    expiring.put("new", "2")
+    assert (expiring.get("old"), expiring.get("new")) == (None, "2")
+    assert len(expiring) == 1
+
+
+def test_sqlite_cache_ttl_and_max_entries(tmp_path):
+    cache = SqliteCache(str(tmp_path / "llm.db"), ttl_seconds=None, max_entries=2)
+    cache.put("a", "1")
+    time.sleep(0.01)
+    cache.put("b", "2")
+    time.sleep(0.01)
+    cache.get("a")
+    time.sleep(0.01)
+    cache.put("c", "3")
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == ("1", None, "3")
+    # Shared with other processes and restarts through the file
+    assert SqliteCache(str(tmp_path / "llm.db")).get("c") == "3"
+
+    expiring = SqliteCache(str(tmp_path / "expiring.db"), ttl_seconds=0.01)
+    expiring.put("a", "1")
+    time.sleep(0.02)
+    assert expiring.get("a") is None
+    assert len(expiring) == 0
+
+
+def test_disk_hit_is_promoted_to_memory(tmp_path):
+    disk = SqliteCache(str(tmp_path / "llm.db"))
+    LLMCache(MemoryCache(), disk).put("key", "answer")
+    cache = LLMCache(MemoryCache(), disk)
+    assert cache.memory.get("key") is None
+    assert cache.get("key") == "answer"
+    assert cache.memory.get("key") == "answer"
+    assert cache.get("missing") is None
+    assert cache.stats() == {"hits": 1, "misses": 1, "memory_entries": 1, "disk_entries": 1}
+
+
+def test_open_llm_cache_is_off_by_default(tmp_path, monkeypatch):
+    for name in ("DIALOG_LLM_CACHE_SIZE", "DIALOG_LLM_CACHE_DB", "DIALOG_LLM_CACHE_TTL", "DIALOG_LLM_CACHE_MAX"):
+        monkeypatch.delenv(name, raising=False)
+    assert open_llm_cache() is None
+
+    monkeypatch.setenv("DIALOG_LLM_CACHE_SIZE", "16")
+    cache = open_llm_cache()
+    assert cache.memory.max_entries == 16 and cache.disk is None
+
+    monkeypatch.setenv("DIALOG_LLM_CACHE_DB", str(tmp_path / "llm.db"))
+    monkeypatch.setenv("DIALOG_LLM_CACHE_MAX", "10")
+    assert open_llm_cache().disk.max_entries == 10
@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+import pytest
+
+from utils.mmap_store import MmapVectorStore, build_store
+from utils.query_cache import CollectionVersion
+
+
+def corpus(count=50, dim=16, seed=0):
+    rng = np.random.default_rng(seed)
+    embeddings = rng.normal(size=(count, dim)).astype(np.float32)
+    ids = [f"id{i}" for i in range(count)]
+    documents = [f"document {i}" for i in range(count)]
+    metadatas = [{"source": "even" if i % 2 == 0 else "odd", "chunk": i} for i in range(count)]
+    return ids, embeddings, documents, metadatas
+
+
+def exact_neighbours(embeddings, query, k, positions=None):
+    positions = np.arange(len(embeddings)) if positions is None else np.asarray(positions)
+    distances = ((embeddings[positions] - query) ** 2).sum(axis=1)
+    return positions[np.argsort(distances)[:k]], np.sort(distances)[:k]
+
+
+def test_float32_query_matches_exact_search(tmp_path):
+    ids, embeddings, documents, metadatas = corpus()
+    build_store(tmp_path / "store", ids, embeddings, documents, metadatas)
+    store = MmapVectorStore(tmp_path / "store")
+    result = store.query(embeddings[:2], n_results=5, include=("documents", "metadatas", "distances"))
+    for query, found_ids, distances in zip(embeddings[:2], result["ids"], result["distances"]):
+        positions, expected = exact_neighbours(embeddings, query, 5)
+        assert found_ids == [ids[p] for p in positions]
+        assert distances == pytest.approx(expected.tolist(), abs=1e-4)
+    assert result["documents"][0][0] == "document 0"
+    assert result["metadatas"][0][0] == {"source": "even", "chunk": 0}
+    assert store.get()["ids"] == ids
+
+
+def test_int8_round_trip_stays_close_to_float32(tmp_path):
+    ids, embeddings, documents, metadatas = corpus()
+    build_store(tmp_path / "store", ids, embeddings, documents, metadatas, dtype="int8")
+    store = MmapVectorStore(tmp_path / "store")
+    assert store.vectors.dtype == np.int8
+    rows = np.stack([store.row(position) for position in range(len(ids))])
+    # Per-row symmetric quantization: error at most half a step of that row's scale
+    steps = np.abs(embeddings).max(axis=1, keepdims=True) / 127.0
+    assert np.all(np.abs(rows - embeddings) <= steps / 2 + 1e-6)
+    result = store.query(embeddings[3], n_results=3)
+    assert result["ids"][0][0] == "id3"
+
+
+def test_where_filter_restricts_results(tmp_path):
+    ids, embeddings, documents, metadatas = corpus()
+    build_store(tmp_path / "store", ids, embeddings, documents, metadatas)
+    store = MmapVectorStore(tmp_path / "store")
+    result = store.query(embeddings[0], n_results=4, where={"source": "odd"}, include=("metadatas", "distances"))
+    assert all(metadata["source"] == "odd" for metadata in result["metadatas"][0])
+    positions, _ = exact_neighbours(embeddings, embeddings[0], 4, positions=range(1, len(ids), 2))
+    assert result["ids"][0] == [ids[p] for p in positions]
+    assert store.query(embeddings[0], n_results=4, where={"source": "none"})["ids"] == [[]]
+
+
+def test_rejects_unknown_dtype(tmp_path):
+    with pytest.raises(ValueError):
+        build_store(tmp_path / "store", *corpus(), dtype="float16")
+
+
+def test_rebuild_swaps_generation_and_bumps_version(tmp_path):
+    path = tmp_path / "store"
+    ids, embeddings, documents, metadatas = corpus()
+    build_store(path, ids, embeddings, documents, metadatas, version_file="conDB.version")
+    first = os.path.realpath(path)
+    old = MmapVectorStore(path)
+    assert CollectionVersion(str(path / "conDB.version")).current() == 1
+
+    new_ids = [f"new{i}" for i in range(len(ids))]
+    build_store(path, new_ids, embeddings[::-1], documents, metadatas, version_file="conDB.version")
+    assert os.path.islink(path) and os.path.realpath(path) != first
+    assert CollectionVersion(str(path / "conDB.version")).current() == 2
+    assert MmapVectorStore(path).get()["ids"] == new_ids
+
+    # A third build removes the first generation; the handle opened on it keeps reading its mapping
+    build_store(path, ids, embeddings, documents, metadatas, version_file="conDB.version")
+    assert not os.path.exists(first)
+    assert old.query(embeddings[0], n_results=1)["ids"] == [["id0"]]
+    generations = [name for name in os.listdir(tmp_path) if name.startswith("store.")]
+    assert len(generations) == 2
+
+
+def test_hnsw_with_filter(tmp_path):
+    pytest.importorskip("hnswlib")
+    ids, embeddings, documents, metadatas = corpus(count=200)
+    build_store(tmp_path / "store", ids, embeddings, documents, metadatas, hnsw=True)
+    store = MmapVectorStore(tmp_path / "store", ef_search=200)
+    assert store.hnsw is not None
+    assert store.query(embeddings[7], n_results=1)["ids"] == [["id7"]]
+    result = store.query(embeddings[7], n_results=5, where={"source": "even"}, include=("metadatas",))
+    assert len(result["ids"][0]) == 5
+    assert all(metadata["source"] == "even" for metadata in result["metadatas"][0])
@@ -0,0 +1,64 @@
+import time
+
+from utils.query_cache import CollectionVersion, QueryCache
+
+OPTIONS = {"k": 3, "mode": "vector", "where": None}
+
+
+def test_collection_version_counts_bumps(tmp_path):
+    version = CollectionVersion(str(tmp_path / "conDB.version"))
+    assert version.current() == 0
+    assert version.bump() == 1
+    assert version.bump() == 2
+    # Another reader of the same file sees the latest value
+    assert CollectionVersion(str(tmp_path / "conDB.version")).current() == 2
+
+
+def test_key_normalizes_text_and_includes_options():
+    assert QueryCache.make_key("persistent  cough ", OPTIONS) == QueryCache.make_key("persistent cough", OPTIONS)
+    assert QueryCache.make_key("persistent cough", OPTIONS) != QueryCache.make_key("persistent cough", {**OPTIONS, "k": 5})
+
+
+def test_hit_within_ttl():
+    cache = QueryCache(ttl_seconds=60)
+    key = QueryCache.make_key("cough", OPTIONS)
+    assert cache.get(key, 1) is None
+    cache.put(key, 1, (["doc"], [0.1]))
+    assert cache.get(key, 1) == (["doc"], [0.1])
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (1, 1)
+
+
+def test_entries_expire_after_ttl():
+    cache = QueryCache(ttl_seconds=0.01)
+    key = QueryCache.make_key("cough", OPTIONS)
+    cache.get(key, 1)
+    cache.put(key, 1, "result")
+    time.sleep(0.02)
+    assert cache.get(key, 1) is None
+    assert cache.stats()["items"] == 0
+
+
+def test_new_collection_version_drops_everything():
+    cache = QueryCache()
+    key = QueryCache.make_key("cough", OPTIONS)
+    cache.get(key, 1)
+    cache.put(key, 1, "result")
+    assert cache.get(key, 2) is None
+    assert cache.stats()["invalidations"] == 1
+    # A result computed against the old version is not stored under the new one
+    cache.put(key, 1, "stale")
+    assert cache.get(key, 2) is None
+
+
+def test_lru_bound_and_disabled_cache():
+    cache = QueryCache(max_items=2)
+    keys = [QueryCache.make_key(text, OPTIONS) for text in ("a", "b", "c")]
+    cache.get(keys[0], 1)
+    for key in keys:
+        cache.put(key, 1, key[0])
+    assert [cache.get(key, 1) for key in keys] == [None, "b", "c"]
+
+    disabled = QueryCache(max_items=0)
+    disabled.get(keys[0], 1)
+    disabled.put(keys[0], 1, "a")
+    assert disabled.get(keys[0], 1) is None
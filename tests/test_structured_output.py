@@ -0,0 +1,55 @@
+import json
+
+import pytest
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+from utils.structured_output import StructuredCaller, StructuredOutputError, repair_json, validate
+
+SCHEMA = {"diagnoses": dict}
+
+
+@pytest.mark.parametrize("text", [
+    '{"diagnoses": {"1": "Migraine"}}',
+    '```json\n{"diagnoses": {"1": "Migraine"}}\n```',
+    '```\n{"diagnoses": {"1": "Migraine"}}```',
+    'Here is the answer:\n{"diagnoses": {"1": "Migraine"}}\nLet me know if you need more.',
+    '{"diagnoses": {"1": "Migraine",},}',
+])
+def test_repair_json(text):
+    assert repair_json(text) == {"diagnoses": {"1": "Migraine"}}
+
+
+def test_repair_json_gives_up_on_unrecoverable_text():
+    with pytest.raises(json.JSONDecodeError):
+        repair_json("I am not sure what the diagnosis is.")
+
+
+def test_validate():
+    assert validate({"diagnoses": {}}, SCHEMA) == []
+    assert validate({"diagnoses": {}}, None) == []
+    assert validate({}, SCHEMA) == ["missing key 'diagnoses'"]
+    assert validate({"diagnoses": []}, SCHEMA) == ["'diagnoses' should be dict, got list"]
+    assert validate([], SCHEMA) == ["expected a JSON object, got list"]
+
+
+def test_repairable_answer_costs_no_retry():
+    model = FakeListChatModel(responses=['```json\n{"diagnoses": {"1": "Migraine",}}\n```', "unused"])
+    parsed, text = StructuredCaller(model, json_mode=False).invoke([], schema=SCHEMA)
+    assert parsed == {"diagnoses": {"1": "Migraine"}}
+    assert json.loads(text) == parsed
+    assert model.i == 1
+
+
+def test_retries_until_valid(capsys):
+    model = FakeListChatModel(responses=["no JSON here", '{"questions": {}}', '{"diagnoses": {}}'])
+    parsed, _ = StructuredCaller(model, max_retries=2, json_mode=False).invoke([], schema=SCHEMA, name="diagnose")
+    assert parsed == {"diagnoses": {}}
+    output = capsys.readouterr().out
+    assert "diagnose: attempt 1" in output and "diagnose: attempt 2" in output
+
+
+def test_raises_after_max_retries():
+    model = FakeListChatModel(responses=["no JSON here", '{"diagnoses": []}', '{"diagnoses": {}}'])
+    with pytest.raises(StructuredOutputError, match="after 2 attempts: 'diagnoses' should be dict"):
+        StructuredCaller(model, max_retries=1, json_mode=False).invoke([], schema=SCHEMA, name="diagnose")
+    assert model.i == 2
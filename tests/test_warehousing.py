@@ -0,0 +1,64 @@
+import sqlite3
+
+import pyarrow.parquet as pq
+import pyarrow.types as pat
+
+from datasets.warehousing import Watermark, consultation_schema, main
+
+
+def extract(standin, store, *extra):
+    main(["extract", "--sqlite", str(standin), "--store", str(store), "--chunk-size", "4", *extra])
+
+
+def parts(store):
+    return sorted(store.glob("part-*.parquet"))
+
+
+def test_incremental_extract_and_merge(tmp_path, capsys):
+    standin, store = tmp_path / "standin.db", tmp_path / "consultation_table"
+    main(["init-standin", "--sqlite", str(standin), "--sample", "10"])
+    extract(standin, store)
+    first = pq.read_table(store).to_pandas()
+    connection = sqlite3.connect(standin)
+    total = connection.execute("SELECT COUNT(*) FROM ConsultationCallTranscriptions").fetchone()[0]
+    assert len(first) == total
+    watermark = Watermark(str(store / "_watermark.json"))
+    assert watermark.transcription_id == total
+
+    # A rerun with nothing new moves no rows and writes no parts
+    before = parts(store)
+    extract(standin, store)
+    assert parts(store) == before
+    assert "Extracted 0 new transcriptions" in capsys.readouterr().out
+
+    # More consultations, one whose patient has no date of birth, so a whole chunk can be NULL there
+    main(["init-standin", "--sqlite", str(standin), "--sample", "10"])
+    connection.execute("UPDATE PatientProfiles SET DateOfBirth = NULL WHERE Id > 10")
+    connection.commit()
+    new = connection.execute("SELECT COUNT(*) FROM ConsultationCallTranscriptions").fetchone()[0] - total
+    connection.close()
+    extract(standin, store, "--merge")
+    assert f"Extracted {new} new transcriptions" in capsys.readouterr().out
+
+    [merged] = parts(store)
+    table = pq.read_table(merged)
+    assert table.schema.equals(consultation_schema())
+    assert pat.is_timestamp(table.schema.field("DateOfBirth").type)
+    assert pat.is_timestamp(table.schema.field("CreatedDate").type)
+    frame = table.to_pandas()
+    assert len(frame) == total + new
+    assert frame["TranscriptionId"].is_unique
+    assert frame["DateOfBirth"].isna().sum() == new
+    assert frame["CreatedDate"].is_monotonic_increasing
+
+
+def test_merge_drops_refetched_transcriptions(tmp_path):
+    standin, store = tmp_path / "standin.db", tmp_path / "consultation_table"
+    main(["init-standin", "--sqlite", str(standin), "--sample", "5"])
+    extract(standin, store)
+    # An old-style watermark without TranscriptionId re-fetches every row of its CreatedDate
+    (store / "_watermark.json").write_text('{"CreatedDate": "2024-09-06 10:00:00"}')
+    extract(standin, store, "--merge")
+    frame = pq.read_table(store).to_pandas()
+    assert frame["TranscriptionId"].is_unique
+    assert len(frame) == sqlite3.connect(standin).execute("SELECT COUNT(*) FROM ConsultationCallTranscriptions").fetchone()[0]